@@ -28,6 +28,10 @@ setup(
         'clint',
         'six',
     ],
+    extras_require={
+        # the built-in filter-missingness engine
+        'missingness' : ['numpy'],
+    },
     entry_points='''
         [console_scripts]
         yaps=yaps.cli:cli
@@ -35,6 +39,6 @@ setup(
     packages=find_packages(exclude=('tests', 'docs')),
     package_data={
         '': ['*.md', 'LICENSE'],
-        'yaps' : ['data/*'],
+        'yaps' : ['data/*/*'],
     },
 )
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# Measures what the yaps scheduler layer itself costs, against the fake LSF
+# in fakelsf.py: how fast jobs can be submitted, what a poll costs, and how
+# much longer a run of N chromosomes x M stages takes than the simulated jobs
+# alone would need.  Run it before and after a scheduler change:
+#
+#   python tests/benchmark.py --chroms 24 --stages 4 --json before.json
+#
+# LSF is driven through the asyncio core where there is one; --sync uses the
+# blocking, shell-piped BatchJobManager instead, to compare the two.
+#
+# With --startup it instead checks what `yaps --help` and `yaps <pipeline>
+# --help` cost to start up, exiting non-zero when one goes over its import
+# budget or drags in a module it has no business importing:
+#
+#   python tests/benchmark.py --startup --budget 0.2
+
+from __future__ import print_function, division
+import os, sys, json, time, shutil, logging, tempfile, argparse, subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.dirname(here))
+
+import fakelsf
+
+def setup_fake_lsf(args):
+    home = tempfile.mkdtemp(prefix='yaps-bench-')
+    os.environ['FAKELSF_HOME'] = home
+    os.environ['FAKELSF_RUNTIME'] = str(args.runtime)
+    os.environ['FAKELSF_JITTER'] = str(args.jitter)
+    os.environ['FAKELSF_SUBMIT_LATENCY'] = str(args.submit_latency)
+    os.environ['FAKELSF_QUERY_LATENCY'] = str(args.query_latency)
+    if args.slow:
+        os.environ['FAKELSF_RUNTIMES'] = 'chrom-1$={}'.format(args.runtime * args.slow)
+    bindir = fakelsf.install(os.path.join(home, 'bin'))
+    os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+    return home
+
+def logger():
+    log = logging.getLogger('benchmark')
+    log.addHandler(logging.NullHandler())
+    log.setLevel(logging.CRITICAL)
+    return log
+
+def manager(args, log):
+    from yaps.utils import scheduler
+    if args.backend == 'drmaa':
+        import fakedrmaa
+        return scheduler.job_manager('drmaa', log, drmaa_module=fakedrmaa)
+    if args.sync:
+        return scheduler.BatchJobManager(log)
+    return scheduler.job_manager('lsf', log)
+
+def submission_throughput(args, log):
+    from yaps.utils import scheduler
+    mgr = manager(args, log)
+    params = {'q': 'bench', 'M': 8000000}
+    start = time.time()
+    for i in range(args.chroms):
+        mgr.submit_job('true', 'bench-submit-{}'.format(i), job_params=params)
+    single = time.time() - start
+
+    script = os.path.join(os.environ['FAKELSF_HOME'], 'bench.array.sh')
+    start = time.time()
+    mgr.submit_array(['true'] * args.chroms, 'bench-array', script, job_params=params)
+    array = time.time() - start
+    return {
+        'jobs' : args.chroms,
+        'single_jobs_per_sec' : args.chroms / single,
+        'single_total_secs' : single,
+        'array_total_secs' : array,
+    }
+
+def poll_cost(args, log):
+    from yaps.utils.scheduler import bsub
+    records = getattr(manager(args, log), 'job_records', bsub.job_records)
+    db = fakelsf.database()
+    job_ids = [str(r[0]) for r in db.execute('SELECT id FROM jobs ORDER BY id')]
+    rounds = 5
+    start = time.time()
+    for i in range(rounds):
+        records(job_ids)
+    per_poll = (time.time() - start) / rounds
+    return {
+        'tracked_jobs' : len(job_ids),
+        'secs_per_poll' : per_poll,
+        'msecs_per_tracked_job' : 1000 * per_poll / max(len(job_ids), 1),
+    }
+
+def makespan(args, log):
+    from yaps.utils.jobqueue import DrmaaJobQueue
+    mgr = manager(args, log)
+    queue = DrmaaJobQueue(os.path.join(os.environ['FAKELSF_HOME'], 'queue.db'), log, poller=mgr.poll)
+    params = {'q': 'bench', 'M': 8000000}
+    name = lambda stage, chrom: 'bench-stage-{}-chrom-{}'.format(stage, chrom)
+
+    start = time.time()
+    if args.mode == 'streaming':
+        for chrom in range(1, args.chroms + 1):
+            job_id = None
+            for stage in range(1, args.stages + 1):
+                job_id = mgr.submit_job('true', name(stage, chrom), job_params=params, depends_on=job_id)
+                queue.append(job_id)
+        queue.wait(args.timeout, log)
+    else:
+        for stage in range(1, args.stages + 1):
+            if args.mode == 'arrays':
+                script = os.path.join(os.environ['FAKELSF_HOME'], 'stage-{}.array.sh'.format(stage))
+                for job_id in mgr.submit_array(['true'] * args.chroms, 'bench-stage-{}'.format(stage), script, job_params=params):
+                    queue.append(job_id)
+            else:
+                for chrom in range(1, args.chroms + 1):
+                    queue.append(mgr.submit_job('true', name(stage, chrom), job_params=params))
+            queue.wait(args.timeout, log)
+    elapsed = time.time() - start
+
+    # what the simulated jobs alone needed: the slowest chromosome's chain
+    # when streaming, else the slowest job of each stage back to back
+    runtimes = {}
+    cluster = fakelsf.Cluster(fakelsf.database())
+    for job in cluster.jobs.values():
+        if not job.name.startswith('bench-stage-'):
+            continue
+        stage = int(job.name.split('-')[2])
+        for index in range(1, job.elements + 1):
+            chrom = index if job.elements > 1 else int(job.name.rsplit('-', 1)[1])
+            runtimes[(stage, chrom)] = job.runtime(index) + fakelsf.setting('PEND', 0.0)
+    if args.mode == 'streaming':
+        ideal = max(sum(runtimes[(s, c)] for s in range(1, args.stages + 1))
+                    for c in range(1, args.chroms + 1))
+    else:
+        ideal = sum(max(runtimes[(s, c)] for c in range(1, args.chroms + 1))
+                    for s in range(1, args.stages + 1))
+    return {
+        'mode' : args.mode,
+        'chroms' : args.chroms,
+        'stages' : args.stages,
+        'makespan_secs' : elapsed,
+        'ideal_secs' : ideal,
+        'overhead_secs' : elapsed - ideal,
+        'bsub_calls' : fakelsf.count_calls('bsub', since=start),
+        'bjobs_calls' : fakelsf.count_calls('bjobs', since=start),
+    }
+
+# what a --help has no need of: the pipelines' configs and ruffus
+# pipelines, and the heavy modules they (and the stages) pull in
+startup_banned = (
+    'ruffus', 'clint', 'drmaa', 'numpy', 'pkg_resources',
+    'yaps.configs', 'yaps.pipelines.', 'yaps.utils',
+)
+
+# run in a fresh interpreter: the secs from importing yaps.cli to the help
+# being written out, and the modules that were loaded along the way
+startup_probe = '''
+import sys, json, time
+before = set(sys.modules)
+start = time.time()
+from yaps.cli import cli
+try:
+    cli(sys.argv[1:], prog_name='yaps')
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps({
+    'secs' : time.time() - start,
+    'modules' : sorted(set(sys.modules) - before),
+}) + '\\n')
+'''
+
+def banned_modules(modules):
+    return [ m for m in modules if any(m == b or m.startswith(b.rstrip('.') + '.') for b in startup_banned) ]
+
+def startup_cost(argv, rounds):
+    # the best of a few rounds, since the first pays for a cold disk cache
+    runs = []
+    for i in range(rounds):
+        proc = subprocess.Popen(
+            [sys.executable, '-c', startup_probe] + argv,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=os.path.dirname(here),
+        )
+        (out, err) = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError('yaps {} failed:\n{}'.format(' '.join(argv), err.decode()))
+        runs.append(json.loads(err.decode().strip().splitlines()[-1]))
+    best = min(runs, key=lambda run: run['secs'])
+    banned = banned_modules(best['modules'])
+    return {
+        'secs' : best['secs'],
+        'modules' : len(best['modules']),
+        'banned' : ' '.join(banned) or '-',
+    }
+
+def startup(args):
+    # {command : cost} for `yaps --help` and every pipeline's --help, and
+    # the commands over budget
+    from yaps.pipelines import registry
+    results = {}
+    over = []
+    for argv in [['--help']] + [ [name, '--help'] for name in sorted(registry) ]:
+        command = ' '.join(['yaps'] + argv)
+        results[command] = startup_cost(argv, args.rounds)
+        if results[command]['secs'] > args.budget or results[command]['banned'] != '-':
+            over.append(command)
+    return (results, over)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the yaps scheduling overhead against a fake LSF'
+    )
+    parser.add_argument('--chroms', type=int, default=24)
+    parser.add_argument('--stages', type=int, default=4)
+    parser.add_argument('--runtime', type=float, default=2.0,
+                        help='simulated seconds per job')
+    parser.add_argument('--jitter', type=float, default=0.5,
+                        help='+/- fraction of random runtime noise')
+    parser.add_argument('--slow', type=float, default=0,
+                        help='make chrom-1 this many times slower')
+    parser.add_argument('--submit-latency', type=float, default=0.0)
+    parser.add_argument('--query-latency', type=float, default=0.0)
+    parser.add_argument('--mode', default='barrier', choices=['barrier', 'streaming', 'arrays'])
+    parser.add_argument('--backend', default='lsf', choices=['lsf', 'drmaa'])
+    parser.add_argument('--sync', action='store_true',
+                        help='drive LSF with the blocking BatchJobManager rather than the asyncio core')
+    parser.add_argument('--timeout', type=int, default=3600)
+    parser.add_argument('--json', default=None, help='also write the results here')
+    parser.add_argument('--keep', action='store_true', help='keep the fake LSF state dir')
+    parser.add_argument('--startup', action='store_true',
+                        help="only check the import cost of yaps' --help commands")
+    parser.add_argument('--budget', type=float, default=0.2,
+                        help='most secs a --help may take to import and print')
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.startup:
+        (results, over) = startup(args)
+        report({ 'startup' : results }, args.json)
+        for command in over:
+            print('{} is over its startup budget: {:.3f} of {:.3f} secs, importing {}'.format(
+                command, results[command]['secs'], args.budget, results[command]['banned']
+            ))
+        sys.exit(1 if over else 0)
+
+    home = setup_fake_lsf(args)
+    log = logger()
+    try:
+        results = {
+            'submission' : submission_throughput(args, log),
+            'poll' : poll_cost(args, log),
+            'makespan' : makespan(args, log),
+        }
+    finally:
+        if not args.keep:
+            shutil.rmtree(home, ignore_errors=True)
+
+    report(results, args.json)
+
+def report(results, path=None):
+    for (section, values) in sorted(results.items()):
+        print(section)
+        for (k, v) in sorted(values.items()):
+            if isinstance(v, dict):
+                print('    {}'.format(k))
+                for (kk, vv) in sorted(v.items()):
+                    print('        {:<20} {}'.format(kk, '{:.3f}'.format(vv) if isinstance(vv, float) else vv))
+                continue
+            print('    {:<24} {}'.format(k, '{:.3f}'.format(v) if isinstance(v, float) else v))
+    if path:
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
 import os
 import sys
 
-sys.path.insert(0, os.path.abspath('..'))
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.dirname(here))
 
-import finmetseq
+import yaps
+import fakelsf
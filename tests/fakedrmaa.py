@@ -0,0 +1,132 @@
+# A stand-in for the python-drmaa module, backed by the fake LSF in
+# fakelsf.py, so the DRMAA job manager can be driven off a cluster:
+#
+#   scheduler.job_manager('drmaa', log, drmaa_module=fakedrmaa)
+
+from __future__ import print_function, division
+import os, sys, time, shlex, collections
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakelsf
+
+JobInfo = collections.namedtuple(
+    'JobInfo',
+    'jobId hasExited hasSignal terminatedSignal hasCoreDump wasAborted exitStatus resourceUsage'
+)
+
+class ExitTimeoutException(Exception):
+    pass
+
+class InvalidJobException(Exception):
+    pass
+
+class errors(object):
+    ExitTimeoutException = ExitTimeoutException
+    InvalidJobException = InvalidJobException
+
+class JobControlAction(object):
+    TERMINATE = 'terminate'
+
+class JobTemplate(object):
+    PARAMETRIC_INDEX = '$drmaa_incr_ph$'
+
+    def __init__(self):
+        self.jobName = None
+        self.remoteCommand = None
+        self.args = []
+        self.nativeSpecification = ''
+
+class Session(object):
+    TIMEOUT_WAIT_FOREVER = -1
+    TIMEOUT_NO_WAIT = 0
+    JOB_IDS_SESSION_ALL = 'DRMAA_JOB_IDS_SESSION_ALL'
+    JOB_IDS_SESSION_ANY = 'DRMAA_JOB_IDS_SESSION_ANY'
+
+    def __init__(self):
+        self.jobs = []
+        self.reaped = set()
+
+    def initialize(self, contactString=None):
+        pass
+
+    def exit(self):
+        pass
+
+    def createJobTemplate(self):
+        return JobTemplate()
+
+    def deleteJobTemplate(self, jt):
+        pass
+
+    def _submit(self, jt, name):
+        (flags, rest) = fakelsf.parse_flags(shlex.split(jt.nativeSpecification or ''))
+        flags['J'] = name
+        cmd = ' '.join([jt.remoteCommand] + list(jt.args))
+        (job_id, queue) = fakelsf.submit(flags, cmd)
+        return str(job_id)
+
+    def runJob(self, jt):
+        job_id = self._submit(jt, jt.jobName)
+        self.jobs.append(job_id)
+        return job_id
+
+    def runBulkJobs(self, jt, beginIndex, endIndex, step):
+        job_id = self._submit(jt, '{}[{}-{}]'.format(jt.jobName, beginIndex, endIndex))
+        job_ids = ['{}[{}]'.format(job_id, i) for i in range(1, endIndex - beginIndex + 2, step)]
+        self.jobs.extend(job_ids)
+        return job_ids
+
+    def _states(self, job_ids):
+        cluster = fakelsf.Cluster(fakelsf.database())
+        now = time.time()
+        states = {}
+        for job_id in job_ids:
+            (job, indexes) = cluster.lookup(job_id)
+            states[job_id] = [cluster.status(job, i, now) + (job.max_mem(i),) for i in indexes]
+        return states
+
+    def control(self, jobId, action):
+        if action == JobControlAction.TERMINATE:
+            fakelsf.bkill([jobId])
+
+    def synchronize(self, jobIds, timeout=-1, dispose=False):
+        if self.JOB_IDS_SESSION_ALL in jobIds:
+            jobIds = self.jobs
+        deadline = None if timeout < 0 else time.time() + timeout
+        while True:
+            states = self._states(jobIds)
+            if all(s[0] in ('DONE', 'EXIT') for ss in states.values() for s in ss):
+                return
+            if deadline is not None and time.time() >= deadline:
+                raise ExitTimeoutException('timed out waiting on {}'.format(jobIds))
+            time.sleep(0.1)
+
+    def _any(self, timeout):
+        # the first of the session's jobs to have finished and not been
+        # waited on yet, as DRMAA reaps each job once
+        deadline = None if timeout < 0 else time.time() + timeout
+        while True:
+            unreaped = [j for j in self.jobs if j not in self.reaped]
+            if not unreaped:
+                raise InvalidJobException('no jobs left to wait on')
+            states = self._states(unreaped)
+            for job_id in unreaped:
+                if all(s[0] in ('DONE', 'EXIT') for s in states[job_id]):
+                    return job_id
+            if deadline is not None and time.time() >= deadline:
+                raise ExitTimeoutException('timed out waiting on any job')
+            time.sleep(0.1)
+
+    def wait(self, jobId, timeout=-1):
+        if jobId == self.JOB_IDS_SESSION_ANY:
+            jobId = self._any(timeout)
+        else:
+            self.synchronize([jobId], timeout)
+        self.reaped.add(jobId)
+        (state, start, finish, code, reason, memory) = self._states([jobId])[jobId][0]
+        return JobInfo(
+            jobId, code is not None and reason is None, reason is not None,
+            'SIGTERM' if reason else None, False, False, code,
+            { 'start_time' : str(start or finish), 'end_time' : str(finish),
+              'ru_wallclock' : str(finish - (start or finish)), 'maxvmem' : str(memory) }
+        )
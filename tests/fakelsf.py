@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# A stand-in for the LSF commands yaps shells out to (bsub, bjobs, bkill,
+# bmod, bacct), for exercising and benchmarking the scheduler layer off a
+# cluster.  Nothing is actually run: each job's life is worked out from the
+# clock, its dependencies and the knobs below, and kept in a sqlite db.
+#
+#   python tests/fakelsf.py install <bindir>    # then put <bindir> on PATH
+#
+# Knobs (environment variables):
+#   FAKELSF_HOME            where the job db lives [default=$TMPDIR/fakelsf]
+#   FAKELSF_SUBMIT_LATENCY  seconds each bsub/bmod/bkill takes [default=0]
+#   FAKELSF_QUERY_LATENCY   seconds each bjobs/bacct takes [default=0]
+#   FAKELSF_PEND            seconds a job pends before it starts [default=0]
+#   FAKELSF_RUNTIME         seconds a job runs [default=1]
+#   FAKELSF_JITTER          +/- fraction of random runtime noise [default=0]
+#   FAKELSF_RUNTIMES        per job name overrides, 'regex=secs,...'
+#   FAKELSF_MAX_MEM         MB of memory a job peaks at [default=100]
+#   FAKELSF_MEM             per job name overrides, 'regex=MB,...'
+#   FAKELSF_FAIL_RATE       chance of a job exiting non-zero [default=0]
+#   FAKELSF_FAIL_MATCH      regex of job names that always fail
+#   FAKELSF_HOSTS           number of execution hosts [default=8]
+#   FAKELSF_SLOW_HOSTS      runtime multipliers, 'host=factor,...'
+
+from __future__ import print_function, division
+import os, re, sys, json, time, random, sqlite3, tempfile, getpass
+
+commands = ('bsub', 'bjobs', 'bkill', 'bmod', 'bacct')
+
+schema = (
+    'CREATE TABLE IF NOT EXISTS jobs ( '
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, queue TEXT, '
+    'submit REAL, elements INTEGER, deps TEXT, ti INTEGER, memlimit REAL, '
+    'resreq TEXT, cmd TEXT, killed REAL )'
+)
+
+calls = 'CREATE TABLE IF NOT EXISTS calls ( cmd TEXT, at REAL )'
+
+def setting(name, default):
+    return type(default)(os.environ.get('FAKELSF_' + name, default))
+
+def mapping(name):
+    pairs = [p.rsplit('=', 1) for p in os.environ.get('FAKELSF_' + name, '').split(',') if p]
+    return [(k, float(v)) for (k, v) in pairs]
+
+def database():
+    home = os.environ.get('FAKELSF_HOME', os.path.join(tempfile.gettempdir(), 'fakelsf'))
+    if not os.path.exists(home):
+        os.makedirs(home)
+    db = sqlite3.connect(os.path.join(home, 'lsf.db'), timeout=60)
+    db.execute(schema)
+    db.execute(calls)
+    return db
+
+def count_calls(cmd, since=0):
+    row = database().execute('SELECT COUNT(*) FROM calls WHERE cmd = ? AND at >= ?', (cmd, since))
+    return row.fetchone()[0]
+
+def install(bindir):
+    if not os.path.exists(bindir):
+        os.makedirs(bindir)
+    for cmd in commands:
+        path = os.path.join(bindir, cmd)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "{}" "{}" {} "$@"\n'.format(
+                sys.executable, os.path.abspath(__file__), cmd
+            ))
+        os.chmod(path, 0o755)
+    return bindir
+
+def parse_flags(argv, boolean=('ti', 'N', 'K')):
+    flags, rest = {}, []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg.startswith('-') and len(arg) > 1 and not rest:
+            key = arg[1:]
+            if key in boolean:
+                flags[key] = True
+            else:
+                flags[key] = argv[i + 1]
+                i += 1
+        else:
+            rest.append(arg)
+        i += 1
+    return (flags, rest)
+
+class Job(object):
+    def __init__(self, row):
+        (self.id, self.name, self.queue, self.submit, self.elements, deps,
+         self.ti, self.memlimit, self.resreq, self.cmd, self.killed) = row
+        self.deps = json.loads(deps)
+
+    def label(self, index):
+        return '{}[{}]'.format(self.name, index) if self.elements > 1 else self.name
+
+    def host(self, index):
+        # steer clear of any host excluded with select[hname!=...]
+        hosts = ['fakenode{}'.format(i) for i in range(setting('HOSTS', 8))]
+        avoid = re.findall(r'hname\s*!=\s*([\w.-]+)', self.resreq or '')
+        hosts = [h for h in hosts if h not in avoid] or hosts
+        return hosts[(self.id * 31 + index) % len(hosts)]
+
+    def runtime(self, index):
+        rng = random.Random(self.id * 1000003 + index)
+        runtime = setting('RUNTIME', 1.0)
+        for (pattern, secs) in mapping('RUNTIMES'):
+            if re.search(pattern, self.label(index)):
+                runtime = secs
+        jitter = setting('JITTER', 0.0)
+        runtime *= 1 + rng.uniform(-jitter, jitter)
+        return runtime * dict(mapping('SLOW_HOSTS')).get(self.host(index), 1.0)
+
+    def max_mem(self, index):
+        memory = setting('MAX_MEM', 100.0)
+        for (pattern, mb) in mapping('MEM'):
+            if re.search(pattern, self.label(index)):
+                memory = mb
+        return memory
+
+    def fails(self, index):
+        rng = random.Random(self.id * 7919 + index)
+        pattern = os.environ.get('FAKELSF_FAIL_MATCH')
+        if pattern and re.search(pattern, self.label(index)):
+            return True
+        return rng.random() < setting('FAIL_RATE', 0.0)
+
+class Cluster(object):
+    def __init__(self, db):
+        self.db = db
+        rows = db.execute('SELECT * FROM jobs ORDER BY id').fetchall()
+        self.jobs = dict((row[0], Job(row)) for row in rows)
+        self.memo = {}
+
+    def lookup(self, job_id):
+        m = re.match(r'^(\d+)(?:\[(\d+)\])?$', str(job_id))
+        if not m or int(m.group(1)) not in self.jobs:
+            return (None, None)
+        job = self.jobs[int(m.group(1))]
+        indexes = [int(m.group(2))] if m.group(2) else range(1, job.elements + 1)
+        return (job, list(indexes))
+
+    def life(self, job, index):
+        # (start, finish, state, exit code, exit reason); None = not yet known
+        key = (job.id, index)
+        if key in self.memo:
+            return self.memo[key]
+        ready, orphaned = job.submit, None
+        for dep in job.deps:
+            (dep_job, dep_indexes) = self.lookup(dep)
+            if dep_job is None:
+                continue
+            for i in dep_indexes:
+                (start, finish, state, code, reason) = self.life(dep_job, i)
+                if finish is None:
+                    ready = None
+                elif state != 'DONE':
+                    orphaned = finish if orphaned is None else min(orphaned, finish)
+                elif ready is not None:
+                    ready = max(ready, finish)
+        if orphaned is not None:
+            life = (None, orphaned, 'EXIT', 1, 'TERM_ORPHAN_SYSTEM') if job.ti else (None, None, 'PEND', None, None)
+        elif ready is None:
+            life = (None, None, 'PEND', None, None)
+        else:
+            start = ready + setting('PEND', 0.0)
+            finish = start + job.runtime(index)
+            if job.memlimit and job.max_mem(index) * 1024 > job.memlimit:
+                finish = start + job.runtime(index) / 2
+                life = (start, finish, 'EXIT', 130, 'TERM_MEMLIMIT')
+            elif job.fails(index):
+                life = (start, finish, 'EXIT', 1, None)
+            else:
+                life = (start, finish, 'DONE', 0, None)
+        if job.killed is not None and (life[1] is None or job.killed < life[1]):
+            start = life[0] if life[0] is not None and life[0] < job.killed else None
+            life = (start, job.killed, 'EXIT', 130, 'TERM_OWNER')
+        self.memo[key] = life
+        return life
+
+    def status(self, job, index, now):
+        (start, finish, state, code, reason) = self.life(job, index)
+        if start is None and (finish is None or now < finish):
+            return ('PEND', start, finish, code, reason)
+        if finish is None or now < finish:
+            if now < start:
+                return ('PEND', start, finish, code, reason)
+            return ('RUN', start, finish, code, reason)
+        return (state, start, finish, code, reason)
+
+def lsf_time(t):
+    return time.strftime('%b %d %H:%M:%S %Y', time.localtime(t)) if t else ''
+
+def bsub(argv):
+    (flags, rest) = parse_flags(argv)
+    cmd = ' '.join(rest) if rest else sys.stdin.read().strip()
+    (job_id, queue) = submit(flags, cmd)
+    print('Job <{}> is submitted to queue <{}>.'.format(job_id, queue))
+
+def submit(flags, cmd):
+    time.sleep(setting('SUBMIT_LATENCY', 0.0))
+    name = flags.get('J', 'NONAME').strip('\'"')
+    elements = 1
+    m = re.match(r'^(.*)\[(\d+)-(\d+)\]$', name)
+    if m:
+        name, elements = m.group(1), int(m.group(3)) - int(m.group(2)) + 1
+    deps = re.findall(r'done\(\s*([^)\s]+)\s*\)', flags.get('w', ''))
+    memlimit = float(flags['M']) if 'M' in flags else None
+    queue = flags.get('q', 'normal')
+    db = database()
+    with db:
+        cur = db.execute(
+            'INSERT INTO jobs (name, queue, submit, elements, deps, ti, memlimit, resreq, cmd) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (name, queue, time.time(), elements, json.dumps(deps),
+             1 if flags.get('ti') else 0, memlimit, flags.get('R'), cmd)
+        )
+    return (cur.lastrowid, queue)
+
+def bjobs(argv):
+    time.sleep(setting('QUERY_LATENCY', 0.0))
+    (flags, ids) = parse_flags(argv, boolean=('w', 'a', 'json', 'noheader'))
+    cluster = Cluster(database())
+    now = time.time()
+    if ids:
+        selected = [(j,) + cluster.lookup(j) for j in ids]
+    else:
+        selected = [(str(j.id), j, list(range(1, j.elements + 1))) for j in cluster.jobs.values()]
+
+    if 'o' in flags:
+        fields = [f.lower() for f in flags['o'].split() if '=' not in f]
+        records = []
+        for (asked, job, indexes) in selected:
+            if job is None:
+                records.append({'JOBID': asked, 'ERROR': 'Job <{}> is not found'.format(asked)})
+                continue
+            for index in indexes:
+                (state, start, finish, code, reason) = cluster.status(job, index, now)
+                if not ids and state in ('DONE', 'EXIT') and not flags.get('a'):
+                    continue
+                ran = (min(now, finish) if finish else now) - start if start and start <= now else 0
+                values = {
+                    'jobid' : str(job.id),
+                    'jobindex' : str(index if job.elements > 1 else 0),
+                    'stat' : state,
+                    'exit_code' : str(code) if state == 'EXIT' and code else '',
+                    'exit_reason' : (reason or '') if state == 'EXIT' else '',
+                    'max_mem' : '{:.0f} Mbytes'.format(job.max_mem(index)) if ran else '',
+                    'run_time' : '{} second(s)'.format(int(round(ran))),
+                    'pend_time' : '{} second(s)'.format(int(round((start if start and start <= now else now) - job.submit))),
+                    'exec_host' : job.host(index) if ran else '',
+                    'queue' : job.queue,
+                    'job_name' : job.label(index),
+                    'submit_time' : lsf_time(job.submit),
+                    'start_time' : lsf_time(start if start and start <= now else None),
+                    'finish_time' : lsf_time(finish if state in ('DONE', 'EXIT') else None),
+                }
+                records.append(dict((f.upper(), values.get(f, '')) for f in fields))
+        if flags.get('json'):
+            print(json.dumps({'COMMAND': 'bjobs', 'JOBS': len(records), 'RECORDS': records}, indent=2))
+        else:
+            for r in records:
+                print(' '.join(r.get(f.upper(), '-') or '-' for f in fields))
+        return
+
+    print('JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME')
+    for (asked, job, indexes) in selected:
+        if job is None:
+            sys.stderr.write('Job <{}> is not found\n'.format(asked))
+            continue
+        for index in indexes:
+            (state, start, finish, code, reason) = cluster.status(job, index, now)
+            if state in ('DONE', 'EXIT') and not (ids or flags.get('a')):
+                continue
+            host = job.host(index) if state != 'PEND' else ''
+            print('{:<7} {:<7} {:<5} {:<10} {:<11} {:<11} {} {}'.format(
+                job.id, getpass.getuser(), state, job.queue, 'fakelogin',
+                host, job.label(index), time.strftime('%b %d %H:%M', time.localtime(job.submit))
+            ))
+
+def bkill(argv):
+    time.sleep(setting('SUBMIT_LATENCY', 0.0))
+    (flags, ids) = parse_flags(argv)
+    db = database()
+    cluster = Cluster(db)
+    if 'J' in flags:
+        ids = [str(j.id) for j in cluster.jobs.values() if j.name == flags['J']]
+    now = time.time()
+    for job_id in ids:
+        (job, indexes) = cluster.lookup(job_id)
+        if job is None:
+            print('Job <{}>: No matching job found'.format(job_id))
+            continue
+        if all(cluster.status(job, i, now)[0] in ('DONE', 'EXIT') for i in indexes):
+            print('Job <{}>: Job has already finished'.format(job_id))
+            continue
+        with db:
+            db.execute('UPDATE jobs SET killed = ? WHERE id = ?', (now, job.id))
+        print('Job <{}> is being terminated'.format(job_id))
+
+def bmod(argv):
+    time.sleep(setting('SUBMIT_LATENCY', 0.0))
+    (flags, ids) = parse_flags(argv, boolean=('ti', 'tin', 'N', 'K'))
+    db = database()
+    for job_id in ids:
+        updates = {}
+        if 'w' in flags:
+            updates['deps'] = json.dumps(re.findall(r'done\(\s*([^)\s]+)\s*\)', flags['w']))
+        if 'M' in flags:
+            updates['memlimit'] = float(flags['M'])
+        if 'R' in flags:
+            updates['resreq'] = flags['R']
+        if 'q' in flags:
+            updates['queue'] = flags['q']
+        if 'ti' in flags or 'tin' in flags:
+            updates['ti'] = 1 if 'ti' in flags else 0
+        with db:
+            for (column, value) in updates.items():
+                db.execute('UPDATE jobs SET {} = ? WHERE id = ?'.format(column),
+                           (value, int(job_id.split('[')[0])))
+        print('Parameters of job <{}> are being changed'.format(job_id))
+
+def bacct(argv):
+    time.sleep(setting('QUERY_LATENCY', 0.0))
+    (flags, ids) = parse_flags(argv, boolean=('l', 'w'))
+    cluster = Cluster(database())
+    now = time.time()
+    for job_id in ids:
+        (job, indexes) = cluster.lookup(job_id)
+        if job is None:
+            continue
+        for index in indexes:
+            (state, start, finish, code, reason) = cluster.status(job, index, now)
+            if state not in ('DONE', 'EXIT'):
+                continue
+            print('Job <{}>, Job Name <{}>, Queue <{}>, Status <{}>'.format(
+                job_id, job.label(index), job.queue, state))
+            print('     CPU_T     WAIT     TURNAROUND   STATUS     HOG_FACTOR    MEM    SWAP')
+            print('{:10.2f} {:8.0f} {:14.0f}   {:<8} {:12.4f} {:6.0f}M {:6.0f}M'.format(
+                (finish - start) if start else 0, (start or finish) - job.submit,
+                finish - job.submit, state.lower(), 1.0, job.max_mem(index), 0))
+
+def main(argv):
+    cmd = os.path.basename(argv[0])
+    if cmd not in commands and len(argv) > 1:
+        (cmd, argv) = (argv[1], argv[1:])
+    if cmd == 'install':
+        print(install(argv[1]))
+    elif cmd in commands:
+        db = database()
+        with db:
+            db.execute('INSERT INTO calls VALUES (?, ?)', (cmd, time.time()))
+        globals()[cmd](argv[1:])
+    else:
+        sys.exit('usage: fakelsf.py install <bindir> | {} ...'.format(' | '.join(commands)))
+
+if __name__ == '__main__':
+    main(sys.argv)
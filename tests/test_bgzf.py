@@ -0,0 +1,180 @@
+# yaps bgzip --index: what BgzfWriter writes is read back as it went in,
+# and regions looked up through the .tbi it builds alongside give the same
+# records as going through the whole VCF for them (and as pysam's tabix
+# does, when pysam is installed).
+
+import os, gzip, random, shutil, tempfile, unittest
+
+from context import yaps
+from yaps.utils import bgzf
+from yaps.utils.intervals import read_tabix_index
+from yaps.utils.readiness import is_bgzf, bgzf_complete
+from yaps.cli import cli
+from click.testing import CliRunner
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+header = (
+    b'##fileformat=VCFv4.2\n'
+    b'##INFO=<ID=END,Number=1,Type=Integer,Description="End position">\n'
+    b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\n'
+)
+
+def make_vcf(seed=1):
+    # a few chromosomes of records spread over a few Mb, some of them
+    # deletions and some with an END= reaching over many 16kb windows
+    rand = random.Random(seed)
+    lines = [header]
+    for chrom in (b'1', b'2', b'X'):
+        pos = 0
+        for i in range(6000):
+            pos += rand.randint(1, 600)
+            ref = b'A' * rand.choice((1, 1, 1, 5, 40))
+            info = 'END={}'.format(pos + rand.randint(1, 200000)).encode() if i % 500 == 7 else b'.'
+            lines.append(b'\t'.join([
+                chrom, str(pos).encode(), b'.', ref, b'G', b'50', b'PASS', info, b'GT', b'0/1', b'1/1',
+            ]) + b'\n')
+    return b''.join(lines)
+
+def extent(line):
+    # (chrom, beg, end) of a record, 0-based and half-open, as tabix sees it
+    fields = line.split(b'\t')
+    beg = int(fields[1]) - 1
+    end = beg + len(fields[3])
+    for item in fields[7].split(b';'):
+        if item.startswith(b'END='):
+            end = max(end, int(item[4:]))
+    return (fields[0], beg, end)
+
+def reg2bins(beg, end):
+    # every bin of the binning scheme that can hold a record in [beg, end)
+    end -= 1
+    bins = [0]
+    for (shift, first) in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(first + (beg >> shift), first + (end >> shift) + 1))
+    return bins
+
+def read_span(path, start, end):
+    # the uncompressed data from one virtual offset up to another
+    (cstart, ustart) = bgzf.split_offset(start)
+    (cend, uend) = bgzf.split_offset(end)
+    spans = bgzf.blocks(path, cstart, cend)
+    data = [ bgzf.read_blocks(path, [span]) for span in spans ]
+    if spans[-1][0] == cend:
+        data[-1] = data[-1][:uend]
+    return b''.join(data)[ustart:]
+
+def query(path, index, chrom, beg, end):
+    # tabix's lookup: the chunks of the bins the region can be in, less
+    # those ending before the region's 16kb window begins
+    if chrom not in index.names:
+        return []
+    ref = index.refs[index.names.index(chrom)]
+    ioff = ref['ioff']
+    lowest = ioff[min(beg >> 14, len(ioff) - 1)] if ioff else 0
+    found = set()
+    for bin in reg2bins(beg, end):
+        for (start, stop) in ref['bins'].get(bin, []):
+            if stop <= lowest:
+                continue
+            for line in read_span(path, start, stop).split(b'\n'):
+                if not line:
+                    continue
+                (c, b, e) = extent(line)
+                if c == chrom.encode() and b < end and e > beg:
+                    found.add(line)
+    return sorted(found, key=extent)
+
+def scan(data, chrom, beg, end):
+    # the same, going through every record
+    found = []
+    for line in data.split(b'\n'):
+        if not line or line.startswith(b'#'):
+            continue
+        (c, b, e) = extent(line)
+        if c == chrom.encode() and b < end and e > beg:
+            found.append(line)
+    return sorted(found, key=extent)
+
+regions = [
+    ('1', 0, 1), ('1', 0, 20000), ('1', 16383, 16385), ('1', 100000, 101000),
+    ('1', 500000, 2000000), ('2', 1234567, 1240000), ('2', 0, 1 << 29),
+    ('X', 1000000, 1000001), ('X', 3500000, 1 << 29), ('Y', 0, 1000),
+]
+
+class BgzfTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='yaps-test-')
+        self.data = make_vcf()
+        self.plain = os.path.join(self.dir, 'in.vcf')
+        with open(self.plain, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def compress(self, threads=1):
+        path = os.path.join(self.dir, 'out.{}.vcf.gz'.format(threads))
+        bgzf.compress(self.plain, path, threads=threads, index=True, chunk_size=12345)
+        return path
+
+    def test_compressed_file_reads_back_as_written(self):
+        for threads in (1, 4):
+            path = self.compress(threads)
+            with gzip.open(path, 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+            self.assertTrue(is_bgzf(path))
+            self.assertTrue(bgzf_complete(path))
+            spans = bgzf.blocks(path)
+            self.assertGreater(len(spans), 10)
+            self.assertTrue(all(size <= 0x10000 for (offset, size) in spans))
+            self.assertEqual(bgzf.read_blocks(path, spans), self.data)
+            (head, first) = bgzf.read_header(path)
+            self.assertEqual(head, header)
+            self.assertEqual(first, bgzf.virtual_offset(0, len(header)))
+
+    def test_index_finds_what_a_scan_does(self):
+        path = self.compress(threads=3)
+        index = read_tabix_index(path + '.tbi')
+        self.assertEqual(index.names, ['1', '2', 'X'])
+        for (chrom, beg, end) in regions:
+            expected = scan(self.data, chrom, beg, end)
+            self.assertEqual(query(path, index, chrom, beg, end), expected, (chrom, beg, end))
+        self.assertTrue(any(scan(self.data, chrom, beg, end) for (chrom, beg, end) in regions))
+
+    def test_unsorted_vcf_is_refused_and_removed(self):
+        # out of order early on, and in its last line (which has no newline)
+        lines = self.data.rstrip(b'\n').split(b'\n')
+        for (a, b) in ((len(header.split(b'\n')), len(header.split(b'\n')) + 100), (-2, -1)):
+            swapped = list(lines)
+            (swapped[a], swapped[b]) = (swapped[b], swapped[a])
+            with open(self.plain, 'wb') as f:
+                f.write(b'\n'.join(swapped))
+            for threads in (1, 3):
+                with self.assertRaises(ValueError):
+                    self.compress(threads)
+                self.assertEqual(os.listdir(self.dir), ['in.vcf'])
+
+            # and yaps bgzip says so, without a traceback
+            out = os.path.join(self.dir, 'out.vcf.gz')
+            result = CliRunner().invoke(cli, ['bgzip', '--index', '-o', out, self.plain])
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn('The VCF is not sorted', result.output)
+            self.assertNotIsInstance(result.exception, ValueError)
+            self.assertEqual(os.listdir(self.dir), ['in.vcf'])
+
+    @unittest.skipIf(pysam is None, 'needs pysam')
+    def test_index_agrees_with_pysam(self):
+        path = self.compress()
+        tabix = pysam.TabixFile(path)
+        for (chrom, beg, end) in regions:
+            if chrom not in tabix.contigs:
+                continue
+            expected = sorted((line.encode() for line in tabix.fetch(chrom, beg, end)), key=extent)
+            self.assertEqual(scan(self.data, chrom, beg, end), expected, (chrom, beg, end))
+
+if __name__ == '__main__':
+    unittest.main()
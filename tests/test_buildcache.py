@@ -0,0 +1,105 @@
+# The build cache: what an output is known by, when it counts as fresh,
+# and how a job's finishing (or retry, failure or loss) is recorded against
+# what it was making.
+
+import os, time, shutil, logging, tempfile, unittest
+
+from context import yaps
+from yaps.utils.buildcache import BuildCache
+
+done = { 'state' : 'DONE' }
+failed = { 'state' : 'EXIT' }
+
+class BuildCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='yaps-test-')
+        self.cache = self.open()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self, **kwargs):
+        return BuildCache(os.path.join(self.dir, '.build_cache.db'), logging.getLogger('yaps.tests'), **kwargs)
+
+    def path(self, name, data=None):
+        path = os.path.join(self.dir, name)
+        if data is not None:
+            with open(path, 'w') as f:
+                f.write(data)
+        return path
+
+    def test_output_is_fresh_once_its_job_is_done(self):
+        out = self.path('out.vcf.gz')
+        self.cache.expect(out, 'fp1', '11')
+        self.assertFalse(self.cache.fresh(out, 'fp1'))
+        self.assertEqual(self.cache.building(out), ('fp1', '11'))
+        self.path('out.vcf.gz', 'made')
+        self.cache.finished('11', done)
+        self.assertTrue(self.cache.fresh(out, 'fp1'))
+        self.assertFalse(self.cache.fresh(out, 'fp2'))
+        self.assertIsNone(self.cache.building(out))
+        # the same, after a restart
+        self.assertTrue(self.open().fresh(out, 'fp1'))
+
+    def test_output_changed_since_it_was_made_is_stale(self):
+        out = self.path('out.vcf.gz', 'made')
+        self.cache.expect(out, 'fp1', '11')
+        self.cache.finished('11', done)
+        time.sleep(0.01)
+        self.path('out.vcf.gz', 'made over')
+        self.assertFalse(self.cache.fresh(out, 'fp1'))
+
+    def test_identity(self):
+        made = self.path('made.vcf.gz')
+        given = self.path('given.vcf.gz', 'input')
+        # a built (or being built) output by its fingerprint, before it exists
+        self.cache.expect(made, 'fp1', '11')
+        self.assertEqual(self.cache.identity(made), 'built:fp1')
+        self.assertEqual(self.cache.identity(self.path('nowhere')), 'missing:{}'.format(self.path('nowhere')))
+        st = os.stat(given)
+        self.assertEqual(self.cache.identity(given), 'stat:{}:{}'.format(st.st_size, st.st_mtime))
+        # the SHA-1 of 'input'
+        self.assertEqual(self.open(content_hashes=True).identity(given), 'sha1:140f86aae51ab9e1cda9b4254fe98a74eb54c1a1')
+
+    def test_fingerprint_follows_its_inputs(self):
+        given = self.path('given.vcf.gz', 'input')
+        script = self.path('stage.sh', 'true')
+        fp = self.cache.fingerprint('cmd', [script], [given], {'M' : 1})
+        self.assertEqual(fp, self.cache.fingerprint('cmd', [script], [given], {'M' : 1}))
+        self.assertNotEqual(fp, self.cache.fingerprint('cmd', [script], [given], {'M' : 2}))
+        self.assertNotEqual(fp, self.cache.fingerprint('cmd2', [script], [given], {'M' : 1}))
+        time.sleep(0.01)
+        self.path('given.vcf.gz', 'changed')
+        self.assertNotEqual(fp, self.cache.fingerprint('cmd', [script], [given], {'M' : 1}))
+
+    def test_retry_takes_over_what_its_job_was_making(self):
+        out = self.path('out.vcf.gz')
+        self.cache.expect(out, 'fp1', '11')
+        self.cache.finished('11', dict(failed, retried_as='12'))
+        self.assertEqual(self.cache.building(out), ('fp1', '12'))
+        self.path('out.vcf.gz', 'made')
+        self.cache.finished('12', done)
+        self.assertTrue(self.cache.fresh(out, 'fp1'))
+
+    def test_lost_jobs_outputs_are_not_made_by_a_reused_id(self):
+        # a local run is killed while its job 1 is writing out, and the
+        # next run's own job 1 makes something else
+        out = self.path('out.vcf.gz', 'half')
+        self.cache.expect(out, 'fp1', '1')
+        cache = self.open()
+        cache.lost(['1'])
+        cache.expect(self.path('other.vcf.gz', 'made'), 'fp9', '1')
+        cache.finished('1', done)
+        self.assertFalse(cache.fresh(out, 'fp1'))
+        self.assertIsNone(cache.building(out))
+        self.assertTrue(cache.fresh(self.path('other.vcf.gz'), 'fp9'))
+
+    def test_failed_jobs_outputs_are_not_made_by_a_reused_id(self):
+        out = self.path('out.vcf.gz', 'half')
+        self.cache.expect(out, 'fp1', '1')
+        self.cache.finished('1', failed)
+        self.cache.finished('1', done)
+        self.assertFalse(self.cache.fresh(out, 'fp1'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# Sharding a chromosome into regions: the regions tile it, and sized on
+# data they hold about as many records each however the records are spread
+# along it, where sized on length they don't.  Without a .tbi the header's
+# contig length is all there is to go on.
+
+import os, random, shutil, tempfile, unittest
+
+from context import yaps
+from yaps.utils import bgzf
+from yaps.utils.intervals import shard_intervals, split_by_data, read_tabix_index, linear_window
+
+length = 20000000
+
+header = (
+    b'##fileformat=VCFv4.2\n'
+    b'##contig=<ID=1,length=20000000>\n'
+    b'##contig=<ID=2>\n'
+    b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+)
+
+# crowded into the first 200kb, then thinly spread over the rest
+positions = list(range(1, 200000, 10)) + list(range(200000, length, 990))
+
+def make_vcf():
+    rand = random.Random(1)
+    lines = [header]
+    for pos in positions:
+        # something that doesn't compress away to nothing
+        info = ''.join(rand.choice('ACGT') for i in range(40)).encode()
+        lines.append(b'\t'.join([b'1', str(pos).encode(), b'.', b'A', b'G', b'50', b'PASS', b'SEQ=' + info]) + b'\n')
+    return b''.join(lines)
+
+def span(region):
+    (chrom, interval) = region.split(':')
+    (start, end) = interval.split('-')
+    return (int(start), int(end))
+
+class ShardIntervalsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.data = make_vcf()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='yaps-test-')
+        self.vcf = os.path.join(self.dir, 'in.vcf.gz')
+        with bgzf.BgzfWriter(self.vcf, index='vcf') as out:
+            out.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def counts(self, regions):
+        # the records in each region, checking that they tile the chromosome
+        spans = [span(r) for r in regions]
+        self.assertEqual(spans[0][0], 1)
+        for ((start, end), (next_start, next_end)) in zip(spans, spans[1:]):
+            self.assertLessEqual(start, end)
+            self.assertEqual(next_start, end + 1)
+        self.assertGreaterEqual(spans[-1][1], positions[-1])
+        return [sum(1 for pos in positions if start <= pos <= end) for (start, end) in spans]
+
+    def test_shards_sized_on_data_hold_about_as_much(self):
+        regions = shard_intervals(self.vcf, '1', 4)
+        self.assertEqual(len(regions), 4)
+        counts = self.counts(regions)
+        mean = sum(counts) / 4.0
+        self.assertTrue(all(0.75 * mean <= n <= 1.25 * mean for n in counts), counts)
+        # every boundary is the start of a linear index window
+        index = read_tabix_index(self.vcf + '.tbi')
+        boundaries = split_by_data(index, '1', 4)
+        self.assertEqual([span(r)[0] - 1 for r in regions[1:]], boundaries)
+        self.assertTrue(all(b % linear_window == 0 for b in boundaries))
+
+    def test_shards_sized_on_length_are_as_long(self):
+        regions = shard_intervals(self.vcf, '1', 4, sizing='length')
+        self.assertEqual([span(r) for r in regions], [
+            (1, 5000000), (5000001, 10000000), (10000001, 15000000), (15000001, 20000000),
+        ])
+        counts = self.counts(regions)
+        self.assertGreater(counts[0], 2 * counts[1])
+
+    def test_nothing_to_split(self):
+        self.assertEqual(shard_intervals(self.vcf, '1', 1), ['1'])
+        # in the header, but without records
+        self.assertEqual(shard_intervals(self.vcf, '2', 4), ['2'])
+        self.assertEqual(shard_intervals(self.vcf, 'X', 4), ['X'])
+
+    def test_without_an_index_the_header_length_is_used(self):
+        os.remove(self.vcf + '.tbi')
+        self.assertEqual(shard_intervals(self.vcf, '1', 2), ['1:1-10000000', '1:10000001-20000000'])
+        # no length in the header
+        self.assertEqual(shard_intervals(self.vcf, '2', 2), ['2'])
+
+if __name__ == '__main__':
+    unittest.main()
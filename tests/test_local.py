@@ -0,0 +1,70 @@
+# The local executor's take on 'bsub -w "done(...)" -ti': a job waits on its
+# predecessors, never runs after one of them fails for good, and waits out
+# a predecessor's retry instead.
+
+import os, shutil, logging, tempfile, unittest
+
+from context import yaps
+from yaps.utils import scheduler
+
+params = {'n' : 1, 'M' : 100000, 'R' : 'select[mem>100] rusage[mem=100]'}
+
+class LocalExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='yaps-test-')
+        self.log = logging.getLogger('yaps.tests')
+        self.log.addHandler(logging.NullHandler())
+        self.log.propagate = False
+        self.manager = scheduler.LocalExecutor(self.log, cores=2, memory=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def poll(self, job_ids):
+        # {job id : status} of every attempt the poller reported finished
+        seen = {}
+        def on_finish(job_id, status):
+            seen[job_id] = status
+        self.manager.poll(job_ids, timeout=60, log=self.log, on_finish=on_finish)
+        return seen
+
+    def test_dependent_runs_after_its_predecessor(self):
+        order = self.path('order')
+        first = self.manager.submit_job('sleep 0.5 && echo first >> {}'.format(order), 'first', params)
+        # asks for more cores and memory than there are: runs on all of them
+        then = self.manager.submit_job('echo then >> {}'.format(order), 'then', dict(params, n=4, R='rusage[mem=4000]'), depends_on=first)
+        seen = self.poll([first, then])
+        self.assertEqual(seen[first]['state'], 'DONE')
+        self.assertEqual(seen[then]['state'], 'DONE')
+        with open(order) as f:
+            self.assertEqual(f.read().split(), ['first', 'then'])
+
+    def test_dependent_of_a_failed_job_never_runs(self):
+        broken = self.manager.submit_job('false', 'broken', params)
+        after = self.manager.submit_job('touch {}'.format(self.path('after')), 'after', params, depends_on=[broken])
+        with self.assertRaises(scheduler.JobFailed):
+            self.poll([broken, after])
+        self.assertEqual(self.manager.jobs[after].state, 'EXIT')
+        self.assertIsNone(self.manager.jobs[after].start_time)
+        self.assertFalse(os.path.exists(self.path('after')))
+
+    def test_dependent_waits_out_its_predecessors_retry(self):
+        # fails the first time only
+        flaky = '[ -e {0} ] || {{ touch {0}; exit 1; }}'.format(self.path('tried'))
+        policy = scheduler.RetryPolicy(attempts=2)
+        job = self.manager.submit_job(flaky, 'flaky', params, retry=policy)
+        after = self.manager.submit_job('touch {}'.format(self.path('after')), 'after', params, depends_on=job)
+        seen = self.poll([job, after])
+        self.assertEqual(seen[job]['state'], 'EXIT')
+        retry = seen[job]['retried_as']
+        self.assertEqual(seen[retry]['state'], 'DONE')
+        self.assertEqual(seen[retry]['attempt'], 2)
+        self.assertEqual(self.manager.jobs[after].depends_on, [retry])
+        self.assertEqual(seen[after]['state'], 'DONE')
+        self.assertTrue(os.path.exists(self.path('after')))
+
+if __name__ == '__main__':
+    unittest.main()
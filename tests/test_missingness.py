@@ -0,0 +1,122 @@
+# The built-in filter-missingness engine against a small VCF whose
+# missingness was worked out by hand, whole and by region, and against the
+# same records spread over many BGZF blocks and filtered on a pool.
+
+import io, os, gzip, shutil, tempfile, unittest
+
+from context import yaps
+from yaps.utils import bgzf, missingness
+
+header = (
+    b'##fileformat=VCFv4.2\n'
+    b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\ts3\ts4\n'
+)
+
+# each record with (missing, samples, pct) as worked out by hand
+records = [
+    # a '.' after the GT subfield isn't a missing genotype
+    (b'1\t100\t.\tA\tG\t.\t.\t.\tGT:DP\t0/0:5\t0/1:.\t./.:0\t1/1:7', (1, 4, '25.0000')),
+    # half-missing and haploid-missing calls count as missing
+    (b'1\t200\t.\tC\tT\t.\t.\t.\tGT\t./.\t.\t0/1\t./1', (3, 4, '75.0000')),
+    # over the threshold, but in the db
+    (b'1\t300\t.\tG\tA\t.\t.\t.\tGT:DP\t./.:3\t.:.\t0|1:2\t1|1:1', (2, 4, '50.0000')),
+    # no GT to go on
+    (b'1\t400\t.\tT\tC\t.\t.\t.\tDP:GT\t.:0/0\t.:0/0\t.:0/0\t.:0/0', (0, 0, '0.0000')),
+    (b'2\t50\t.\tA\tC\t.\t.\t.\tGT\t0/0\t0/0\t0/0\t0/0', (0, 4, '0.0000')),
+    # a multi-allelic site, in the db by its second allele
+    (b'2\t60\t.\tA\tC,T\t.\t.\t.\tGT\t1/2\t./.\t./.\t0/0', (2, 4, '50.0000')),
+    (b'2\t70\t.\tA\tC,T\t.\t.\t.\tGT\t1/2\t./.\t./.\t0/0', (2, 4, '50.0000')),
+]
+
+db = (
+    b'##fileformat=VCFv4.2\n'
+    b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+    b'1\t300\t.\tG\tA\t.\t.\t.\n'
+    b'2\t60\t.\tA\tT\t.\t.\t.\n'
+)
+
+threshold = 30.0
+
+def expected(lines):
+    # (kept records, stats rows) for the records on these lines
+    (kept, stats) = ([], [])
+    for (line, (miss, samples, pct)) in lines:
+        fields = line.split(b'\t')
+        in_db = (fields[0], fields[1]) in ((b'1', b'300'), (b'2', b'60'))
+        dropped = float(pct) > threshold and not in_db
+        if not dropped:
+            kept.append(line + b'\n')
+        stats.append(b'\t'.join(fields[:2] + fields[3:5] + [
+            str(miss).encode(), str(samples).encode(), pct.encode(),
+            b'1' if in_db else b'0', b'1' if dropped else b'0',
+        ]) + b'\n')
+    return (b''.join(kept), b''.join(stats))
+
+@unittest.skipIf(missingness.np is None, 'needs numpy')
+class MissingnessTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='yaps-test-')
+        self.db = self.bgzip('db.vcf', db)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def bgzip(self, name, data, index='vcf'):
+        path = os.path.join(self.dir, name + '.gz')
+        with bgzf.BgzfWriter(path, index=index) as out:
+            out.write(data)
+        return path
+
+    def filter(self, data, index='vcf', **kwargs):
+        invcf = self.bgzip('in.vcf', data, index)
+        (outvcf, stats) = (os.path.join(self.dir, 'out.vcf.gz'), os.path.join(self.dir, 'stats.out'))
+        counts = missingness.run(invcf, outvcf, stats, db=self.db, threshold=threshold, log=io.StringIO(), **kwargs)
+        with gzip.open(outvcf, 'rb') as f:
+            out = f.read()
+        with gzip.open(stats + '.gz', 'rb') as f:
+            rows = f.read()
+        self.assertTrue(os.path.exists(outvcf + '.tbi'))
+        self.assertTrue(rows.startswith(missingness.stats_header))
+        return (out, rows[len(missingness.stats_header):], counts)
+
+    def test_sites_over_the_threshold_are_dropped(self):
+        data = header + b''.join(line + b'\n' for (line, expect) in records)
+        (out, rows, counts) = self.filter(data)
+        (kept, stats) = expected(records)
+        self.assertEqual(rows, stats)
+        self.assertEqual(out, missingness.annotate_header(header, threshold, self.db) + kept)
+        # two dropped (1:200, 2:70), two kept for being in the db
+        self.assertEqual(counts, [7, 2, 2])
+
+    def test_only_the_region_is_filtered(self):
+        data = header + b''.join(line + b'\n' for (line, expect) in records)
+        (out, rows, counts) = self.filter(data, region='1:150-350')
+        (kept, stats) = expected(records[1:3])
+        self.assertEqual(rows, stats)
+        self.assertEqual(out, missingness.annotate_header(header, threshold, self.db) + kept)
+        self.assertEqual(counts, [2, 1, 1])
+
+    def test_chunks_filtered_on_a_pool_match(self):
+        # the same records over and over, at increasing positions, so that
+        # records straddle the BGZF blocks the workers are handed
+        lines = []
+        for i in range(3000):
+            for (line, expect) in records[:4]:
+                fields = line.split(b'\t')
+                fields[1] = str(int(fields[1]) + 1000 * i).encode()
+                lines.append((b'\t'.join(fields), expect))
+        data = header + b''.join(line + b'\n' for (line, expect) in lines)
+        (out, rows, counts) = self.filter(data, workers=3, blocks_per_chunk=1)
+        (kept, stats) = expected(lines)
+        self.assertEqual(rows, stats)
+        self.assertEqual(out, missingness.annotate_header(header, threshold, self.db) + kept)
+        self.assertEqual(counts[0], len(lines))
+
+    def test_failed_filter_leaves_nothing_behind(self):
+        data = header + b''.join(line + b'\n' for (line, expect) in reversed(records[:3]))
+        with self.assertRaises(ValueError):
+            self.filter(data, index=None)
+        self.assertEqual(sorted(os.listdir(self.dir)), ['db.vcf.gz', 'db.vcf.gz.tbi', 'in.vcf.gz'])
+
+if __name__ == '__main__':
+    unittest.main()
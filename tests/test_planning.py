@@ -0,0 +1,66 @@
+# The order a stage's jobs are submitted in, and the priority each is
+# given: by their recent runtimes where the resource history has them,
+# scaled from the input sizes where it doesn't, and by input size alone for
+# a stage that has never run.
+
+import os, shutil, logging, tempfile, unittest
+
+from context import yaps
+from yaps.utils.planning import SubmissionPlan
+from yaps.utils.resources import ResourceHistory
+
+params = {'R' : 'rusage[mem=2000]'}
+
+class SubmissionPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='yaps-test-')
+        self.history = ResourceHistory(os.path.join(self.dir, 'resource_history.db'), logging.getLogger('yaps.tests'))
+        self.plan = SubmissionPlan(self.history, max_priority=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def ran(self, stage, item, *runtimes):
+        for (i, secs) in enumerate(runtimes):
+            job_id = '{}.{}.{}'.format(stage, item, i)
+            self.history.track(job_id, stage, item, params)
+            self.history.finished(job_id, {'state' : 'DONE', 'max_mem' : 1000, 'run_time' : secs})
+
+    def test_without_history_the_biggest_input_goes_first(self):
+        self.plan.estimate('fm', {'chr1' : 1000, 'chr2' : 500, 'chr21' : 4, 'chrY' : 0})
+        self.assertEqual(self.plan.basis['fm'], 'input size')
+        # anything not estimated goes last, in the order given
+        self.assertEqual(
+            self.plan.order('fm', ['chrY', 'chrM', 'chr21', 'chr2', 'chrX', 'chr1']),
+            ['chr1', 'chr2', 'chr21', 'chrY', 'chrM', 'chrX'],
+        )
+        self.assertEqual([self.plan.priority('fm', item) for item in ('chr1', 'chr2', 'chr21', 'chrY', 'chrM')], [100, 50, 1, 1, None])
+        # another stage's plan is its own
+        self.assertEqual(self.plan.order('dnu', ['chrY', 'chr1']), ['chrY', 'chr1'])
+
+    def test_history_outranks_input_size(self):
+        # secs per byte of 0.1, 0.5 and 1.0; the median's 0.5
+        self.ran('fm', 'chr2', 40, 60)
+        self.ran('fm', 'chr3', 20)
+        self.ran('fm', 'chr4', 300)
+        self.ran('dnu', 'chr1', 9000)
+        costs = self.plan.estimate('fm', {'chr1' : 1000, 'chr2' : 100, 'chr3' : 200, 'chr4' : 300})
+        self.assertEqual(self.plan.basis['fm'], 'runtime history')
+        self.assertEqual(costs, {'chr1' : 500, 'chr2' : 50, 'chr3' : 20, 'chr4' : 300})
+        self.assertEqual(self.plan.order('fm', ['chr3', 'chr2', 'chr4', 'chr1']), ['chr1', 'chr4', 'chr2', 'chr3'])
+        self.assertEqual(self.plan.priority('fm', 'chr4'), 60)
+
+    def test_without_sizes_a_new_item_costs_the_mean_runtime(self):
+        self.ran('fm', 'chrA', 10)
+        self.ran('fm', 'chrB', 30)
+        costs = self.plan.estimate('fm', {'chrA' : 0, 'chrB' : 0, 'chrC' : 0})
+        self.assertEqual(costs['chrC'], 20)
+        self.assertEqual(self.plan.order('fm', ['chrA', 'chrB', 'chrC']), ['chrB', 'chrC', 'chrA'])
+
+    def test_nothing_to_go_on(self):
+        self.plan.estimate('fm', {'chr1' : 0, 'chr2' : 0})
+        self.assertEqual(self.plan.order('fm', ['chr2', 'chr1']), ['chr2', 'chr1'])
+        self.assertEqual(self.plan.priority('fm', 'chr1'), 100)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+# The LSF job managers against the fake LSF in fakelsf.py: retries, held
+# jobs, speculative copies and reattaching to an earlier run's jobs.  Each
+# test gets a fake cluster of its own; the asyncio manager runs the same
+# tests as the blocking one where there is one.
+
+import os, sys, time, shutil, logging, tempfile, unittest
+
+from context import fakelsf
+from yaps.utils import scheduler
+
+params = {'q' : 'long', 'M' : 2000000, 'R' : 'select[mem>2000] rusage[mem=2000]'}
+
+class FakeLSFTest(unittest.TestCase):
+    manager_class = scheduler.BatchJobManager
+
+    def setUp(self):
+        self.environ = dict(os.environ)
+        self.home = tempfile.mkdtemp(prefix='yaps-test-')
+        os.environ['FAKELSF_HOME'] = self.home
+        os.environ['FAKELSF_RUNTIME'] = '0.2'
+        bindir = fakelsf.install(os.path.join(self.home, 'bin'))
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        self.log = logging.getLogger('yaps.tests')
+        self.log.addHandler(logging.NullHandler())
+        self.log.propagate = False
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.home)
+
+    def knobs(self, **settings):
+        for (name, value) in settings.items():
+            os.environ['FAKELSF_' + name] = str(value)
+
+    def manager(self, **kwargs):
+        return self.manager_class(self.log, **kwargs)
+
+    def poll(self, manager, job_ids):
+        # {job id : status} of every job the poller reported finished
+        seen = {}
+        def on_finish(job_id, status):
+            seen[job_id] = status
+        manager.poll(job_ids, timeout=120, log=self.log, on_finish=on_finish)
+        return seen
+
+    def job(self, job_id):
+        row = fakelsf.database().execute('SELECT * FROM jobs WHERE id = ?', (int(job_id),)).fetchone()
+        return fakelsf.Job(row)
+
+    def finish(self, job_id):
+        # when fakelsf has the job finishing
+        job = self.job(job_id)
+        return fakelsf.Cluster(fakelsf.database()).life(job, 1)[1]
+
+class RetryTest(FakeLSFTest):
+    def policy(self, attempts=3):
+        return scheduler.RetryPolicy(attempts=attempts, memory_factor=2.0, max_memory=64000, memory_queue='bigmem')
+
+    def test_memory_killed_job_retries_with_more_memory(self):
+        self.knobs(MEM='hungry=3000')
+        manager = self.manager()
+        hungry = manager.submit_job('true', 'hungry', params, retry=self.policy())
+        after = manager.submit_job('true', 'after', params, depends_on=hungry, retry=self.policy())
+        # mem needn't come first in the select/rusage sections
+        others = dict(params, R='select[tmp>10 && mem>2000] rusage[tmp=10,mem=2000]')
+        hungrier = manager.submit_job('true', 'hungry-tmp', others, retry=self.policy())
+        seen = self.poll(manager, [hungry, after, hungrier])
+
+        self.assertEqual(seen[hungry]['state'], 'EXIT')
+        self.assertEqual(seen[hungry]['exit_reason'], 'TERM_MEMLIMIT')
+        retry = seen[hungry]['retried_as']
+        self.assertEqual(seen[retry]['state'], 'DONE')
+        self.assertEqual(seen[retry]['attempt'], 2)
+        self.assertEqual(self.job(retry).queue, 'bigmem')
+        self.assertEqual(self.job(retry).memlimit, 4000000)
+        self.assertIn('rusage[mem=4000]', self.job(retry).resreq)
+        # the job waiting on it was pointed at the retry
+        self.assertEqual(self.job(after).deps, [retry])
+        self.assertEqual(seen[after]['state'], 'DONE')
+
+        retry = seen[hungrier]['retried_as']
+        self.assertEqual(seen[retry]['state'], 'DONE')
+        self.assertEqual(self.job(retry).memlimit, 4000000)
+        self.assertIn('select[tmp>10 && mem>4000]', self.job(retry).resreq)
+        self.assertIn('rusage[tmp=10,mem=4000]', self.job(retry).resreq)
+        self.assertEqual(scheduler.reserved_memory({'R' : self.job(retry).resreq}), 4000)
+
+    def test_job_out_of_attempts_fails_and_its_dependents_are_killed(self):
+        self.knobs(FAIL_MATCH='broken')
+        manager = self.manager()
+        broken = manager.submit_job('false', 'broken', params, retry=self.policy(attempts=2))
+        after = manager.submit_job('true', 'after', params, depends_on=broken, retry=self.policy())
+        with self.assertRaises(scheduler.JobFailed):
+            self.poll(manager, [broken, after])
+        self.assertIsNotNone(self.job(after).killed)
+
+    def test_job_without_a_policy_is_not_retried(self):
+        self.knobs(FAIL_MATCH='broken')
+        manager = self.manager()
+        broken = manager.submit_job('false', 'broken', params)
+        with self.assertRaises(scheduler.JobFailed):
+            self.poll(manager, [broken])
+        self.assertEqual(fakelsf.database().execute('SELECT COUNT(*) FROM jobs').fetchone()[0], 1)
+
+class AdmissionTest(FakeLSFTest):
+    def test_held_jobs_finish_under_their_tickets(self):
+        manager = self.manager(max_running=1)
+        first = manager.submit_job('true', 'first', params)
+        second = manager.submit_job('true', 'second', params)
+        third = manager.submit_job('true', 'third', params, depends_on=second)
+        # the first goes straight out, and is known by its job id
+        self.assertNotIn('held-', first)
+        self.assertTrue(second.startswith('held-'))
+        self.assertTrue(third.startswith('held-'))
+
+        seen = self.poll(manager, [first, second, third])
+        self.assertEqual(sorted(seen), sorted([first, second, third]))
+        self.assertTrue(all(status['state'] == 'DONE' for status in seen.values()))
+
+        # one at a time, with the held dependency resolved to its job id
+        released = manager.admission.released
+        (second_id, third_id) = (released[second], released[third])
+        self.assertGreaterEqual(self.job(second_id).submit, self.finish(first))
+        self.assertGreaterEqual(self.job(third_id).submit, self.finish(second_id))
+        self.assertEqual(self.job(third_id).deps, [second_id])
+
+    def test_held_job_retries_under_its_ticket(self):
+        self.knobs(MEM='hungry=3000')
+        manager = self.manager(max_running=1)
+        policy = scheduler.RetryPolicy(attempts=2, memory_factor=2.0)
+        first = manager.submit_job('true', 'first', params)
+        hungry = manager.submit_job('true', 'hungry', params, retry=policy)
+        seen = self.poll(manager, [first, hungry])
+        self.assertEqual(seen[hungry]['state'], 'EXIT')
+        retry = seen[hungry]['retried_as']
+        self.assertEqual(seen[retry]['state'], 'DONE')
+        self.assertNotIn(manager.admission.released[hungry], seen)
+
+class SpeculationTest(FakeLSFTest):
+    def test_straggler_is_beaten_by_a_copy_on_another_host(self):
+        # job 1 lands on fakenode0, which is made 20x slower than the rest
+        self.knobs(RUNTIME=1, SLOW_HOSTS='fakenode0=20')
+        policy = scheduler.SpeculationPolicy(quantile=0.5, slowdown=2.0, min_runtime=0, min_samples=3)
+        manager = self.manager(speculation=policy)
+        jobs = [ manager.submit_job('true', 'stage-chrom-{}'.format(i), params, cohort='stage') for i in range(1, 7) ]
+        after = manager.submit_job('true', 'next-chrom-1', params, depends_on=jobs[0])
+        start = time.time()
+        seen = self.poll(manager, jobs + [after])
+
+        straggler = jobs[0]
+        copy = seen[straggler]['retried_as']
+        self.assertIsNotNone(copy)
+        self.assertEqual(seen[copy]['state'], 'DONE')
+        self.assertIn('hname!=fakenode0', self.job(copy).resreq)
+        self.assertIsNotNone(self.job(straggler).killed)
+        self.assertEqual(seen[after]['state'], 'DONE')
+        self.assertEqual(self.job(after).deps, [copy])
+        self.assertLess(time.time() - start, 20)
+
+class ReattachTest(FakeLSFTest):
+    def test_earlier_runs_jobs_are_live_finished_or_lost(self):
+        self.knobs(RUNTIMES='slow=30,quick=0.1')
+        earlier = self.manager()
+        slow = earlier.submit_job('true', 'slow', params)
+        quick = earlier.submit_job('true', 'quick', params)
+        time.sleep(0.5)
+
+        (live, finished) = self.manager().reattach([slow, quick, '4242'])
+        self.assertEqual(live, [slow])
+        self.assertEqual(sorted(finished), [quick])
+        self.assertEqual(finished[quick]['state'], 'DONE')
+
+    def test_adopted_job_is_waited_on_and_retried(self):
+        self.knobs(MEM='hungry=3000')
+        hungry = self.manager().submit_job('true', 'hungry', params)
+        manager = self.manager()
+        policy = scheduler.RetryPolicy(attempts=2, memory_factor=2.0)
+        manager.adopt(hungry, 'true', 'hungry', params, None, policy)
+        seen = self.poll(manager, [hungry])
+        retry = seen[hungry]['retried_as']
+        self.assertEqual(seen[retry]['state'], 'DONE')
+        self.assertEqual(seen[retry]['attempt'], 2)
+
+@unittest.skipIf(sys.version_info < (3, 8), 'the asyncio core needs python 3.8')
+class AsyncRetryTest(RetryTest):
+    manager_class = scheduler.AsyncBatchJobManager
+
+@unittest.skipIf(sys.version_info < (3, 8), 'the asyncio core needs python 3.8')
+class AsyncAdmissionTest(AdmissionTest):
+    manager_class = scheduler.AsyncBatchJobManager
+
+@unittest.skipIf(sys.version_info < (3, 8), 'the asyncio core needs python 3.8')
+class AsyncReattachTest(ReattachTest):
+    manager_class = scheduler.AsyncBatchJobManager
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+# `yaps --help` and each pipeline's --help (as `benchmark.py --startup`
+# measures them) stay within their startup budget, without importing the
+# pipelines, numpy, drmaa or anything else in benchmark.startup_banned.
+# YAPS_STARTUP_BUDGET loosens the budget on a slow machine.
+
+import os, unittest
+
+from context import yaps
+import benchmark
+from yaps.pipelines import registry
+
+budget = float(os.environ.get('YAPS_STARTUP_BUDGET', 0.2))
+
+class StartupTest(unittest.TestCase):
+    def check(self, argv):
+        cost = benchmark.startup_cost(argv, rounds=3)
+        command = ' '.join(['yaps'] + argv)
+        if cost['banned'] != '-':
+            self.fail('{} imports {}'.format(command, ', '.join(sorted(set(m.split('.')[0] if not m.startswith('yaps.') else m for m in cost['banned'].split())))))
+        self.assertLessEqual(cost['secs'], budget, '{} took {:.3f} secs'.format(command, cost['secs']))
+
+    def test_help(self):
+        self.check(['--help'])
+
+    def test_pipeline_help(self):
+        for name in sorted(registry):
+            self.check([name, '--help'])
+
+    def test_eager_imports_are_caught(self):
+        self.assertEqual(
+            benchmark.banned_modules(['click', 'numpy.core', 'drmaa', 'yaps.pipelines', 'yaps.pipelines.postvqsr', 'yaps.version']),
+            ['numpy.core', 'drmaa', 'yaps.pipelines.postvqsr'],
+        )
+
+if __name__ == '__main__':
+    unittest.main()
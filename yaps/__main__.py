@@ -0,0 +1,5 @@
+# `python -m yaps`, for the jobs to run yaps with when it isn't on the PATH
+from yaps.cli import cli
+
+if __name__ == '__main__':
+    cli(prog_name='yaps')
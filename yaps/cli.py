@@ -4,58 +4,136 @@ import signal, importlib, sys, logging, os
 import click
 
 from .version import __version__
+from .pipelines import registry
 
-logLevels = ['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG', 'NOTSET']
+class PipelineGroup(click.Group):
+    # the pipelines' subcommands come from the registry, and each is only
+    # imported when it is the one being run (or asked for its --help)
+    def list_commands(self, ctx):
+        return sorted(set(super(PipelineGroup, self).list_commands(ctx)) | set(registry))
 
-@click.group()
+    def get_command(self, ctx, name):
+        if name in registry:
+            module = importlib.import_module(registry[name]['command'])
+            return getattr(module, name)
+        return super(PipelineGroup, self).get_command(ctx, name)
+
+    def format_commands(self, ctx, formatter):
+        # what `yaps --help` lists, without importing any pipeline
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in registry:
+                rows.append((name, registry[name]['help']))
+                continue
+            command = self.get_command(ctx, name)
+            if command is not None and not command.hidden:
+                rows.append((name, command.get_short_help_str(formatter.width - 6 - len(name))))
+        if rows:
+            with formatter.section('Commands'):
+                formatter.write_dl(rows)
+
+@click.group(cls=PipelineGroup)
 @click.version_option(version=__version__)
 def cli():
     # to make this script/module behave nicely with unix pipes
     # http://newbebweb.blogspot.com/2012/02/python-head-ioerror-errno-32-broken.html
     signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
-@cli.command()
-@click.option('--workspace', required=True, type=click.Path(),
-              help='A directory to place outputs into')
-@click.option('--job-db', default=None, type=click.Path(),
-              help="Path to LSF job sqlite DB [default='<workspace>/job_queue.db']")
-@click.option('--ruffus-history', default=None, type=click.Path(),
-              help="Path to LSF job sqlite DB [default='<workspace>/job_queue.db']")
-@click.option('--log', default=sys.stderr, type=click.File('w'),
-              help="Path to write log details to [default=stdout]")
-@click.option('--log-level', default='INFO', type=click.Choice(logLevels),
-              help='Log Level -- [default=INFO]')
-@click.option('--input-vcfs', required=True, type=click.Path(exists=True),
-              help='A file of chromosomal VCFs to process')
-@click.option('--project-name', default='yaps.default', type=click.STRING,
-              help='A prefix used to name batch jobs')
-@click.option('--email', default=None, type=click.STRING,
-              help='An email used to notify about batch jobs [default=userid@genome.wustl.edu]')
-@click.option('--timeout', default=43200, type=click.INT,
-              help='Seconds to timeout for LSF job polling [default=43200 {12 hours}]')
-@click.option('--config', default=None, type=click.Path(exists=True),
-              help='An alternative configuration file to test')
-def postvqsr(job_db, ruffus_history, log, log_level, input_vcfs, project_name, email, workspace, timeout, config):
-    conf = importlib.import_module('yaps.configs.postvqsr')
-    conf.initialize(input_vcfs, project_name, email, workspace, timeout, config)
-    conf.dump_config()
-
-    logLevel = getattr(logging, log_level.upper())
-
+@cli.command(help="Summarize a run's jobs from its job DB")
+@click.option('--workspace', required=True, type=click.Path(exists=True),
+              help='The workspace of the run to report on')
+@click.option('--job-db', default=None, type=click.Path(exists=True),
+              help="Path to LSF job sqlite DB [default='<workspace>/.job_queue.db']")
+@click.option('--run', default=None, type=click.STRING,
+              help='Which run in the job DB to report on (see --list-runs) [default=the latest]')
+@click.option('--list-runs', is_flag=True, default=False,
+              help='List the runs in the job DB and exit')
+@click.option('--slowest', default=5, type=click.IntRange(0),
+              help='How many of the slowest chromosomes to list [default=5]')
+@click.option('--json', 'json_path', default=None, type=click.Path(),
+              help='Also write the metrics to this JSON file')
+@click.option('--prometheus', default=None, type=click.Path(),
+              help='Also write the metrics to this Prometheus textfile')
+@click.option('--trace', default=None, type=click.Path(),
+              help="Also write the run's jobs as a Chrome/Perfetto trace to this file")
+def report(workspace, job_db, run, list_runs, slowest, json_path, prometheus, trace):
     if job_db is None:
-        job_db = os.path.join(
-            os.path.abspath(conf.config['workspace']),
-            '.job_queue.db'
-        )
+        job_db = os.path.join(os.path.abspath(workspace), '.job_queue.db')
+    if not os.path.exists(job_db):
+        raise click.UsageError('No job DB at {}'.format(job_db))
+
+    logger = importlib.import_module('yaps.utils.logger')
+    jobqueue = importlib.import_module('yaps.utils.jobqueue')
+    metrics = importlib.import_module('yaps.utils.metrics')
+    queue = jobqueue.DrmaaJobQueue(job_db, logger.create('report', sys.stderr, logging.WARNING))
+    runs = queue.runs()
+    if list_runs:
+        for r in runs:
+            click.echo(r)
+        return
+    if run is not None and run not in runs:
+        raise click.UsageError('No run {} in {}'.format(run, job_db))
+
+    summary = metrics.run_summary(queue, run)
+    click.echo(metrics.report(summary, slowest))
+    if json_path is not None:
+        metrics.write_json(summary, json_path)
+    if prometheus is not None:
+        metrics.write_prometheus(summary, prometheus)
+    if trace is not None:
+        tracing = importlib.import_module('yaps.utils.tracing')
+        tracing.write(trace, summary['run'], queue.records(run=summary['run']), queue.marks(summary['run']))
 
-    if ruffus_history is None:
-        ruffus_history = os.path.join(
-            os.path.abspath(conf.config['workspace']),
-            '.ruffus_history.sqlite'
+@cli.command('filter-missingness', help='Drop VCF sites with too many missing genotypes')
+@click.option('--stats', required=True, type=click.Path(),
+              help="Path to write each site's missingness to (gzipped, as '<stats>.gz')")
+@click.option('--db', default=None, type=click.Path(exists=True),
+              help='A bgzipped VCF of sites to keep whatever their missingness')
+@click.option('--missing-threshold', default=2.0, type=click.FLOAT,
+              help='Percentage of samples with a missing genotype over which a site is dropped [default=2.0]')
+@click.option('--region', default=None, type=click.STRING,
+              help="Only filter the 'chrom' or 'chrom:start-end' region [default=the whole VCF]")
+@click.option('--workers', default=1, type=click.IntRange(1),
+              help='Processes to filter with [default=1]')
+@click.option('--chunk-blocks', default=64, type=click.IntRange(1),
+              help='BGZF blocks (of up to 64kb) a worker filters at a time [default=64]')
+@click.argument('invcf', type=click.Path())
+@click.argument('outvcf', type=click.Path())
+def filter_missingness(stats, db, missing_threshold, region, workers, chunk_blocks, invcf, outvcf):
+    # the built-in engine of the postvqsr filter-missingness stage: invcf
+    # is bgzipped (or '-' for plain VCF on stdin), outvcf gets bgzipped and
+    # indexed (or is '-' for plain VCF on stdout)
+    if invcf != '-' and not os.path.exists(invcf):
+        raise click.BadParameter('No such file: {}'.format(invcf), param_hint='invcf')
+    missingness = importlib.import_module('yaps.utils.missingness')
+    try:
+        missingness.run(
+            invcf, outvcf, stats, db=db, threshold=missing_threshold, region=region,
+            workers=workers, blocks_per_chunk=chunk_blocks
         )
+    except ValueError as e:
+        # e.g. an unsorted VCF, which can't be indexed
+        raise click.ClickException(str(e))
 
-    pipeline = importlib.import_module('yaps.pipelines.postvqsr')
-    pipeline.initialize(job_db, ruffus_history, log, logLevel, input_vcfs)
-    pipeline.log.info("LSF Job DB : {}".format(job_db))
-    pipeline.log.info("Ruffus History DB : {}".format(ruffus_history))
-    pipeline.run()
+@cli.command(help='BGZF-compress (and tabix-index) a VCF in one pass')
+@click.option('-o', '--output', required=True, type=click.Path(),
+              help="Path to write the BGZF file to ('-' for stdout)")
+@click.option('--index', is_flag=True, default=False,
+              help="Also write the VCF's tabix index to '<output>.tbi', built as it is compressed")
+@click.option('--threads', default=1, type=click.IntRange(1),
+              help='Threads to compress blocks on [default=1]')
+@click.option('--level', default=6, type=click.IntRange(0, 9),
+              help='zlib compression level [default=6]')
+@click.argument('input', default='-', type=click.Path())
+def bgzip(output, index, threads, level, input):
+    # bgzip -c (and tabix -p vcf) in one pass, for the stage scripts
+    if index and output == '-':
+        raise click.UsageError('--index needs an --output file')
+    if input != '-' and not os.path.exists(input):
+        raise click.BadParameter('No such file: {}'.format(input), param_hint='input')
+    bgzf = importlib.import_module('yaps.utils.bgzf')
+    try:
+        bgzf.compress(input, output, level=level, threads=threads, index=index)
+    except ValueError as e:
+        # e.g. an unsorted VCF, which can't be indexed
+        raise click.ClickException(str(e))
@@ -0,0 +1,175 @@
+from __future__ import print_function, division
+import importlib, threading, logging, json, sys, os
+
+import click
+
+from yaps.commands.postvqsr import logLevels, run_paths, backend_options
+
+# what a cohort in a batch manifest can set (the postvqsr options that
+# belong to a single run), and what it gets when it doesn't
+cohort_options = {
+    'workspace' : None,
+    'input-vcfs' : None,
+    'project-name' : 'yaps.default',
+    'email' : None,
+    'timeout' : 43200,
+    'config' : None,
+    'job-db' : None,
+    'ruffus-history' : None,
+    'build-cache' : None,
+    'hash-inputs' : False,
+    'right-size' : False,
+    'largest-first' : False,
+    'speculate' : False,
+    'max-attempts' : None,
+    'streaming' : False,
+    'job-arrays' : False,
+    'fuse' : False,
+    'persist-intermediates' : False,
+    'builtin-missingness' : False,
+}
+
+def read_manifest(path, backend):
+    # the cohorts of a manifest, each with every one of cohort_options
+    try:
+        with open(path, 'r') as f:
+            cohorts = json.load(f)
+    except ValueError as e:
+        raise click.BadParameter('{} is not JSON: {}'.format(path, e), param_hint='--manifest')
+    if not isinstance(cohorts, list) or not cohorts:
+        raise click.BadParameter('{} should be a list of cohorts'.format(path), param_hint='--manifest')
+
+    found = []
+    for (n, cohort) in enumerate(cohorts, 1):
+        where = 'Cohort {} of {}'.format(n, path)
+        if not isinstance(cohort, dict):
+            raise click.UsageError('{} should be an object of postvqsr options'.format(where))
+        unknown = sorted(set(cohort) - set(cohort_options))
+        if unknown:
+            raise click.UsageError('{} has unknown options: {}'.format(where, ', '.join(unknown)))
+        cohort = dict(cohort_options, **cohort)
+        for option in ('workspace', 'input-vcfs'):
+            if not cohort[option]:
+                raise click.UsageError('{} needs a {}'.format(where, option))
+        for option in ('input-vcfs', 'config'):
+            if cohort[option] is not None and not os.path.exists(cohort[option]):
+                raise click.UsageError('{}: no such {}: {}'.format(where, option, cohort[option]))
+        if cohort['streaming'] and cohort['job-arrays']:
+            raise click.UsageError('{}: streaming and job-arrays cannot be combined'.format(where))
+        if cohort['persist-intermediates'] and not cohort['fuse']:
+            raise click.UsageError('{}: persist-intermediates only applies with fuse'.format(where))
+        if cohort['speculate'] and backend != 'lsf':
+            raise click.UsageError('{}: speculate needs --backend lsf'.format(where))
+        found.append(cohort)
+
+    workspaces = [ os.path.abspath(c['workspace']) for c in found ]
+    if len(set(workspaces)) != len(workspaces):
+        raise click.UsageError('Every cohort in {} needs a workspace of its own'.format(path))
+    return found
+
+@click.command()
+@click.option('--manifest', required=True, type=click.Path(exists=True),
+              help='A JSON list of cohorts, each an object of the postvqsr options it runs with (e.g. "workspace", "input-vcfs", "project-name", "streaming")')
+@click.option('--resource-history', default=None, type=click.Path(),
+              help="Path to the sqlite DB of jobs' past memory and runtime [default='~/.yaps/resource_history.db']")
+@click.option('--preflight', is_flag=True, default=False,
+              help="Check every cohort's inputs, their indexes and the tools and references the stages use before submitting anything")
+@click.option('--trace', is_flag=True, default=False,
+              help="Write a Chrome/Perfetto trace of the batch to each cohort's '<workspace>/trace.<run>.json'")
+@click.option('--log', default=sys.stderr, type=click.File('w'),
+              help="Path to write log details to [default=stderr]")
+@click.option('--log-level', default='INFO', type=click.Choice(logLevels),
+              help='Log Level -- [default=INFO]')
+@click.option('--backend', default='lsf', type=click.Choice(['lsf', 'local']),
+              help='How to submit and wait on batch jobs -- [default=lsf]')
+@click.option('--local-cores', default=None, type=click.INT,
+              help='Cores the local backend may use, between all the cohorts [default=all of them]')
+@click.option('--local-memory', default=None, type=click.INT,
+              help='Memory (MB) the local backend may reserve, between all the cohorts [default=all of it]')
+@click.option('--max-pending', default=None, type=click.INT,
+              help='Most LSF jobs to keep pending per queue, between all the cohorts [default=no limit]')
+@click.option('--max-running', default=None, type=click.INT,
+              help='Most LSF jobs to have in flight (pending or running) per queue, between all the cohorts [default=no limit]')
+@click.option('--max-memory', default=None, type=click.INT,
+              help='Most memory (MB) to have reserved by in-flight LSF jobs per queue, between all the cohorts [default=no limit]')
+def batch(manifest, resource_history, preflight, trace, log, log_level, backend, local_cores, local_memory, max_pending, max_running, max_memory):
+    # every cohort of the manifest runs the postvqsr pipeline on a thread of
+    # its own, all of them submitting through one job manager: one set of
+    # admission limits (which let the cohorts' held jobs through in turns)
+    # and, under LSF, one poller asking bjobs about all of their jobs
+    cohorts = read_manifest(manifest, backend)
+
+    conf = importlib.import_module('yaps.configs.postvqsr')
+    logger = importlib.import_module('yaps.utils.logger')
+    scheduler = importlib.import_module('yaps.utils.scheduler')
+    pipeline = importlib.import_module('yaps.pipelines.postvqsr')
+
+    logLevel = getattr(logging, log_level.upper())
+    batch_log = logger.create('batch', log, logLevel)
+
+    configs = []
+    for cohort in cohorts:
+        config = conf.load(
+            cohort['input-vcfs'], cohort['project-name'], cohort['email'], cohort['workspace'],
+            cohort['timeout'], cohort['config'], cohort['streaming'], cohort['job-arrays'],
+            cohort['fuse'], cohort['persist-intermediates'], cohort['hash-inputs'],
+            cohort['right-size'], cohort['max-attempts'], cohort['speculate'],
+            cohort['builtin-missingness'], cohort['largest-first']
+        )
+        conf.dump_config(config)
+        configs.append(config)
+    # (the project name is what the cohort's jobs, and its ruffus pipeline,
+    # are named after -- and a --config file can set it too)
+    names = [ config['project-name'] for config in configs ]
+    if len(set(names)) != len(names):
+        raise click.UsageError('Every cohort in {} needs a project name of its own: {}'.format(manifest, ', '.join(names)))
+
+    backend_opts = backend_options(backend, local_cores, local_memory, max_pending, max_running, max_memory)
+    speculating = [ config for config in configs if config['speculation'].get('enabled') ]
+    if speculating:
+        backend_opts['speculation'] = scheduler.SpeculationPolicy.from_config(speculating[0]['speculation'])
+    shared = scheduler.SharedJobManager(scheduler.job_manager(backend, batch_log, **backend_opts), batch_log)
+
+    if trace:
+        tracing = importlib.import_module('yaps.utils.tracing')
+        tracing.start()
+
+    runs = []
+    for (cohort, config) in zip(cohorts, configs):
+        (job_db, ruffus_history, build_cache) = run_paths(
+            config['workspace'], cohort['job-db'], cohort['ruffus-history'], cohort['build-cache']
+        )
+        name = config['project-name']
+        run = pipeline.PostVQSR(
+            config, job_db, ruffus_history, log, logLevel, backend, {}, build_cache,
+            resource_history, manager=shared.runner(name), name='postvqsr.{}'.format(name)
+        )
+        run.log.info("{} LSF Job DB : {}".format(name, job_db))
+        runs.append(run)
+
+    if preflight:
+        problems = sum((len(run.run_preflight(cohort['input-vcfs'])) for (cohort, run) in zip(cohorts, runs)), 0)
+        if problems:
+            raise click.ClickException('Preflight found {} problems; not submitting anything'.format(problems))
+
+    failures = {}
+    def run_cohort(run):
+        # a cohort that fails (or times out) leaves the others running
+        try:
+            run.run()
+        except BaseException as e:
+            failures[run.config['project-name']] = e
+            run.log.error('Cohort {} failed: {}'.format(run.config['project-name'], e))
+
+    threads = [ threading.Thread(target=run_cohort, args=(run,), name=run.name) for run in runs ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    batch_log.info('{} of {} cohorts finished'.format(len(runs) - len(failures), len(runs)))
+    if failures:
+        raise click.ClickException('{} of {} cohorts failed: {}'.format(
+            len(failures), len(runs), ', '.join(sorted(failures))
+        ))
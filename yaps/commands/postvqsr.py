@@ -0,0 +1,121 @@
+from __future__ import print_function, division
+import importlib, sys, logging, os
+
+import click
+
+logLevels = ['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG', 'NOTSET']
+
+@click.command()
+@click.option('--workspace', required=True, type=click.Path(),
+              help='A directory to place outputs into')
+@click.option('--job-db', default=None, type=click.Path(),
+              help="Path to LSF job sqlite DB [default='<workspace>/job_queue.db']")
+@click.option('--ruffus-history', default=None, type=click.Path(),
+              help="Path to LSF job sqlite DB [default='<workspace>/job_queue.db']")
+@click.option('--build-cache', default=None, type=click.Path(),
+              help="Path to the output fingerprint sqlite DB [default='<workspace>/.build_cache.db']")
+@click.option('--hash-inputs', is_flag=True, default=False,
+              help='Fingerprint input files on their contents instead of their size and mtime')
+@click.option('--resource-history', default=None, type=click.Path(),
+              help="Path to the sqlite DB of jobs' past memory and runtime [default='~/.yaps/resource_history.db']")
+@click.option('--right-size', is_flag=True, default=False,
+              help="Size each job's memory reservation (and queue) from its resource history")
+@click.option('--largest-first', is_flag=True, default=False,
+              help="Submit each stage's jobs longest (by runtime history or input size) first, with LSF priorities to match")
+@click.option('--speculate', is_flag=True, default=False,
+              help='Launch a copy of a straggling LSF job on another host and keep whichever finishes first')
+@click.option('--max-attempts', default=None, type=click.IntRange(1),
+              help='Times to try a failed job in all, with more memory after an LSF memory kill [default=3]')
+@click.option('--preflight', is_flag=True, default=False,
+              help='Check the inputs, their indexes and the tools and references the stages use before submitting anything')
+@click.option('--trace', is_flag=True, default=False,
+              help="Write a Chrome/Perfetto trace of the run to '<workspace>/trace.<run>.json'")
+@click.option('--log', default=sys.stderr, type=click.File('w'),
+              help="Path to write log details to [default=stdout]")
+@click.option('--log-level', default='INFO', type=click.Choice(logLevels),
+              help='Log Level -- [default=INFO]')
+@click.option('--input-vcfs', required=True, type=click.Path(exists=True),
+              help='A file of chromosomal VCFs to process')
+@click.option('--project-name', default='yaps.default', type=click.STRING,
+              help='A prefix used to name batch jobs')
+@click.option('--email', default=None, type=click.STRING,
+              help='An email used to notify about batch jobs [default=userid@genome.wustl.edu]')
+@click.option('--timeout', default=43200, type=click.INT,
+              help='Seconds to timeout for LSF job polling [default=43200 {12 hours}]')
+@click.option('--config', default=None, type=click.Path(exists=True),
+              help='An alternative configuration file to test')
+@click.option('--streaming', is_flag=True, default=False,
+              help='Chain each chromosome through all stages with LSF job dependencies instead of waiting on every stage')
+@click.option('--job-arrays', is_flag=True, default=False,
+              help='Submit each stage as a single LSF job array instead of one job per chromosome')
+@click.option('--fuse', is_flag=True, default=False,
+              help='Run decompose-normalize-uniq, filter-missingness and annotate-with-1000G as one piped job per chromosome')
+@click.option('--persist-intermediates', is_flag=True, default=False,
+              help='With --fuse, still write out (and index) the outputs of the fused stages before the last')
+@click.option('--builtin-missingness', is_flag=True, default=False,
+              help="Filter missingness with yaps' own (numpy) filter instead of identify-missingness")
+@click.option('--backend', default='lsf', type=click.Choice(['lsf', 'drmaa', 'local']),
+              help='How to submit and wait on batch jobs -- [default=lsf]')
+@click.option('--local-cores', default=None, type=click.INT,
+              help='Cores the local backend may use [default=all of them]')
+@click.option('--local-memory', default=None, type=click.INT,
+              help='Memory (MB) the local backend may reserve [default=all of it]')
+@click.option('--max-pending', default=None, type=click.INT,
+              help='Most LSF jobs to keep pending per queue [default=no limit]')
+@click.option('--max-running', default=None, type=click.INT,
+              help='Most LSF jobs to have in flight (pending or running) per queue [default=no limit]')
+@click.option('--max-memory', default=None, type=click.INT,
+              help='Most memory (MB) to have reserved by in-flight LSF jobs per queue [default=no limit]')
+def postvqsr(job_db, ruffus_history, build_cache, hash_inputs, resource_history, right_size, largest_first, speculate, max_attempts, preflight, trace, log, log_level, input_vcfs, project_name, email, workspace, timeout, config, streaming, job_arrays, fuse, persist_intermediates, builtin_missingness, backend, local_cores, local_memory, max_pending, max_running, max_memory):
+    if streaming and job_arrays:
+        raise click.UsageError('--streaming and --job-arrays cannot be combined')
+    if persist_intermediates and not fuse:
+        raise click.UsageError('--persist-intermediates only applies with --fuse')
+    if speculate and backend != 'lsf':
+        raise click.UsageError('--speculate needs --backend lsf')
+
+    conf = importlib.import_module('yaps.configs.postvqsr')
+    config = conf.load(input_vcfs, project_name, email, workspace, timeout, config, streaming, job_arrays, fuse, persist_intermediates, hash_inputs, right_size, max_attempts, speculate, builtin_missingness, largest_first)
+    conf.dump_config(config)
+
+    logLevel = getattr(logging, log_level.upper())
+    (job_db, ruffus_history, build_cache) = run_paths(config['workspace'], job_db, ruffus_history, build_cache)
+    backend_opts = backend_options(backend, local_cores, local_memory, max_pending, max_running, max_memory)
+
+    if trace:
+        tracing = importlib.import_module('yaps.utils.tracing')
+        tracing.start()
+
+    pipeline = importlib.import_module('yaps.pipelines.postvqsr')
+    run = pipeline.PostVQSR(config, job_db, ruffus_history, log, logLevel, backend, backend_opts, build_cache, resource_history)
+    run.log.info("LSF Job DB : {}".format(job_db))
+    run.log.info("Ruffus History DB : {}".format(ruffus_history))
+    run.log.info("Build Cache DB : {}".format(build_cache))
+    if preflight:
+        problems = run.run_preflight(input_vcfs)
+        if problems:
+            raise click.ClickException('Preflight found {} problems; not submitting anything'.format(len(problems)))
+    run.run()
+
+def run_paths(workspace, job_db=None, ruffus_history=None, build_cache=None):
+    # a run's job DB, ruffus history and build cache, by default in its
+    # workspace
+    workspace = os.path.abspath(workspace)
+    if job_db is None:
+        job_db = os.path.join(workspace, '.job_queue.db')
+    if ruffus_history is None:
+        ruffus_history = os.path.join(workspace, '.ruffus_history.sqlite')
+    if build_cache is None:
+        build_cache = os.path.join(workspace, '.build_cache.db')
+    return (job_db, ruffus_history, build_cache)
+
+def backend_options(backend, local_cores=None, local_memory=None, max_pending=None, max_running=None, max_memory=None):
+    if backend == 'local':
+        return { 'cores' : local_cores, 'memory' : local_memory }
+    elif backend == 'lsf':
+        return {
+            'max_pending' : max_pending,
+            'max_running' : max_running,
+            'max_memory' : max_memory,
+        }
+    return {}
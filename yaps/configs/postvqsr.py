@@ -1,15 +1,42 @@
-import os, pwd, json
-import pkg_resources
+import os, sys, pwd, json
 
-email = None
-workspace = None
-timeout = 43200 # 12 hours in seconds (12 * 60 * 60)
-input_files = []
-config = {}
-project_name = None
+from six.moves import shlex_quote
+
+try:
+    from importlib.resources import files as package_files
+except ImportError:
+    package_files = None
+
+try:
+    from shutil import which #py3
+except ImportError:
+    from distutils.spawn import find_executable as which #py2
+
+def find_yaps():
+    # the yaps on the PATH, else this python's `-m yaps`, as a shell command
+    command = which('yaps')
+    argv = [command] if command else [sys.executable, '-m', 'yaps']
+    return ' '.join(shlex_quote(arg) for arg in argv)
+
+# what the stage scripts (and built-in stages) compress and index their
+# outputs with, and the same quoted for a script's YAPS=, which it evals
+yaps_command = find_yaps()
+yaps_env = shlex_quote(yaps_command)
+
+# the stages whose scripts can stream plain VCF from one to the next
+fusable_stages = [
+    'decompose-normalize-uniq',
+    'filter-missingness',
+    'annotate-with-1000G',
+]
+
+def data_script(name):
+    # the path of one of the stage scripts shipped in yaps/data/postvqsr
+    if package_files is None:
+        return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'postvqsr', name)
+    return str(package_files('yaps').joinpath('data').joinpath('postvqsr').joinpath(name))
 
 def parse_input_vcf_file(file):
-    global input_files
     with open(file, 'r') as f:
         vcfs = [ line.rstrip().split("\t")[1] for line in f ]
     return vcfs
@@ -25,25 +52,151 @@ def setup_workspace(workspace):
         os.makedirs(workspace)
     return workspace
 
-def setup_config(alt_config):
-    config = custom_config(alt_config) if alt_config else standard_config()
+def setup_config(alt_config, options):
+    config = custom_config(alt_config, options) if alt_config else standard_config(options)
+    return stage_engines(config)
+
+def custom_config(alt_config, options):
+    # sections (and settings within a section) missing from the alternative
+    # config keep their standard values, and switches given on the command
+    # line still apply
+    config = standard_config(options)
+    with open(alt_config, 'r') as f:
+        for (k, v) in json.load(f).items():
+            if isinstance(v, dict) and isinstance(config.get(k), dict):
+                config[k].update(v)
+            else:
+                config[k] = v
+    config['streaming'] = config.get('streaming') or options['streaming']
+    config['job-arrays'] = config.get('job-arrays') or options['job_arrays']
+    config['hash-inputs'] = config.get('hash-inputs') or options['hash_inputs']
+    config['right-size'] = config.get('right-size') or options['right_size']
+    if options['fuse']:
+        config['fuse'] = dict(config['fuse'], stages=list(fusable_stages))
+    if options['persist_intermediates']:
+        config['fuse'] = dict(config['fuse'], **{'persist-intermediates' : True})
+    if options['max_attempts'] is not None:
+        config['retry'] = dict(config['retry'], attempts=options['max_attempts'])
+    if options['speculate']:
+        config['speculation'] = dict(config['speculation'], enabled=True)
+    if options['builtin_missingness']:
+        config['filter-missingness'] = dict(config['filter-missingness'], engine='builtin')
+    if options['largest_first']:
+        config['planning'] = dict(config['planning'], **{'largest-first' : True})
     return config
 
-def custom_config(alt_config):
-    config = json.load(alt_config)
+def stage_engines(config):
+    # a stage whose 'engine' is 'builtin' runs with the CMD, cmdArgs and
+    # LSF of its 'builtin' block in place of its script's
+    for (name, section) in config.items():
+        if isinstance(section, dict) and section.get('engine') == 'builtin':
+            if 'builtin' not in section:
+                raise ValueError("The {} stage's engine is builtin, but it has no builtin block".format(name))
+            config[name] = dict(section, **dict(
+                (k, v) for (k, v) in section['builtin'].items() if k in ('CMD', 'cmdArgs', 'LSF')
+            ))
     return config
 
-def standard_config():
+def standard_config(options):
+    # options are load's arguments, by name
+    email = options['email']
+    workspace = options['workspace']
+    (streaming, job_arrays) = (options['streaming'], options['job_arrays'])
+    (fuse, persist_intermediates) = (options['fuse'], options['persist_intermediates'])
+    (hash_inputs, right_size) = (options['hash_inputs'], options['right_size'])
+    (max_attempts, speculate) = (options['max_attempts'], options['speculate'])
+    (builtin_missingness, largest_first) = (options['builtin_missingness'], options['largest_first'])
     config = {
-        'inputs' : input_files,
+        'inputs' : options['input_files'],
         'workspace' : workspace,
-        'project-name': project_name,
-        'lsf-timeout' : timeout,
+        'project-name': options['project_name'],
+        'lsf-timeout' : options['timeout'],
+        # secs to wait for finished jobs' outputs (and their .tbi) to show
+        # up complete on the file system before giving up on them
+        'output-timeout' : 600,
+        'streaming' : streaming,
+        'job-arrays' : job_arrays,
+        # fingerprint inputs on their contents rather than size/mtime
+        'hash-inputs' : hash_inputs,
+        # reserve each job's memory (and pick its queue) from what it used
+        # on earlier runs, when there is a history of it
+        'right-size' : right_size,
+        'sizing' : {
+            'margin' : 0.25,
+            'min-memory' : 500,
+            # [queue, longest runtime in secs or None], in order of preference
+            'queues' : [],
+        },
+        # a failed job is tried up to 'attempts' times in all; when LSF
+        # killed it for going over its memory limit the next try reserves
+        # 'memory-factor' times as much (up to 'max-memory' MB), in
+        # 'memory-queue' if there is one.  A stage section can override
+        # these with a 'retry' of its own.
+        'retry' : {
+            'attempts' : max_attempts or 3,
+            'memory-factor' : 2.0,
+            'max-memory' : 64000,
+            'memory-queue' : None,
+        },
+        # launch a copy of a stage job (on another host) once it has run
+        # 'slowdown' times longer than the stage's 'quantile' runtime so far
+        # this run (or on earlier ones), and keep whichever finishes first.
+        # Needs 'min-samples' runtimes to go on; LSF backend only.
+        'speculation' : {
+            'enabled' : speculate,
+            'quantile' : 0.5,
+            'slowdown' : 2.0,
+            'min-runtime' : 600,
+            'min-samples' : 3,
+        },
+        # submit each stage's jobs longest first (going by how long they
+        # took on earlier runs, else by the size of their input), with LSF
+        # user priorities (-sp, up to 'max-priority') to match
+        'planning' : {
+            'largest-first' : largest_first,
+            'max-priority' : 100,
+        },
+        # how the stages with 'shards' > 1 split up a chromosome: 'data'
+        # balances the intervals on the input's .tbi index, 'length' on
+        # genomic length
+        'shard-sizing' : 'data',
+        # stages run back to back in a single job, piped into each other as
+        # plain VCF; only the last one's output is bgzipped and indexed
+        'fuse' : {
+            'stages' : list(fusable_stages) if fuse else [],
+            'persist-intermediates' : persist_intermediates,
+            'CMD' : "{yaps} bgzip --index -o {vcf}.gz {vcf} && rm -f {vcf}",
+            'cmdArgs' : {
+                'yaps' : yaps_command,
+                'vcf' : None,
+            },
+        },
+        'gather' : {
+            'CMD' : (
+                "{bcftools} concat -a -D -O z -o {outvcf} {shards} "
+                "&& {tabix} -p vcf -f {outvcf}"
+            ),
+            'LSF' : {
+                'u' : email,
+                'N' : None,
+                'q' : "long",
+                'M' : 2000000,
+                'R' : 'select[mem>2000] rusage[mem=2000]',
+                'J' : '{job_name}',
+                'oo': '{log_path}',
+            },
+            'cmdArgs' : {
+                'bcftools' : '/gsc/bin/bcftools1.2',
+                'tabix' : '/gsc/bin/tabix',
+                'outvcf' : None,
+                'shards' : None,
+            },
+        },
         'ac-0-removal' : {
             'outdir' : os.path.join(workspace, '1-select-variants-ac-0-removal'),
             'CMD' : (
                 "{java} -jar {jar} -T SelectVariants -R {reference} "
-                "--removeUnusedAlternates -V {invcf} -L {chrom} -o {outvcf}"
+                "--removeUnusedAlternates -V {invcf} -L {region} -o {outvcf}"
             ),
             'LSF' : {
                 'u' : email,
@@ -62,7 +215,9 @@ def standard_config():
                 'invcf' : None,
                 'outvcf' : None,
                 'chrom' : None,
+                'region' : None,
             },
+            'shards' : 1,
             'input-file-format'  : r'\S*/(?P<chrom>\S+)/combined.\S+\.FINMETSEQ\.recal\.het\.genotype\.annotated\.vcf\.gz$',
             'output-file-format' : os.path.join(
                 workspace,
@@ -73,7 +228,7 @@ def standard_config():
         'decompose-normalize-uniq' : {
             'outdir' : os.path.join(workspace, '2-decompose-normalize-uniq'),
             'CMD' : (
-                "bash {script} {invcf} {outvcf}"
+                "YAPS={yaps} bash {script} {invcf} {outvcf} {region}"
             ),
             'LSF' : {
                 'u' : email,
@@ -85,10 +240,13 @@ def standard_config():
                 'oo': '{log_path}',
             },
             'cmdArgs' : {
-                'script' : pkg_resources.resource_filename('yaps', 'data/postvqsr/run-decompose.sh'),
+                'script' : data_script('run-decompose.sh'),
+                'yaps' : yaps_env,
                 'invcf' : None,
                 'outvcf' : None,
+                'region' : None,
             },
+            'shards' : 1,
             'input-file-format'  : r'\S*/(?P<chrom>\S+)/combined.c\S+\.vcf\.gz$',
             'output-file-format' : os.path.join(
                 workspace,
@@ -99,7 +257,7 @@ def standard_config():
         'filter-missingness' : {
             'outdir' : os.path.join(workspace, '3-filter-missingness'),
             'CMD' : (
-                "bash {script} {invcf} {outvcf} {stats}"
+                "YAPS={yaps} bash {script} {invcf} {outvcf} {stats} {region}"
             ),
             'LSF' : {
                 'u' : email,
@@ -111,10 +269,44 @@ def standard_config():
                 'oo': '{log_path}',
             },
             'cmdArgs' : {
-                'script' : pkg_resources.resource_filename('yaps', 'data/postvqsr/filter-missingness.sh'),
+                'script' : data_script('filter-missingness.sh'),
+                'yaps' : yaps_env,
                 'invcf' : None,
                 'outvcf' : None,
                 'stats' : None,
+                'region' : None,
+            },
+            'shards' : 1,
+            # 'script' runs the stage script above (and identify-missingness);
+            # 'builtin' filters with `yaps filter-missingness` instead, on
+            # 'workers' processes (as many cores as it reserves)
+            'engine' : 'builtin' if builtin_missingness else 'script',
+            'builtin' : {
+                'CMD' : (
+                    "{yaps} filter-missingness --stats {stats} --db {db} "
+                    "--missing-threshold {threshold} --region {region} "
+                    "--workers {workers} {invcf} {outvcf}"
+                ),
+                'LSF' : {
+                    'u' : email,
+                    'N' : None,
+                    'q' : "long",
+                    'n' : 4,
+                    'M' : 8000000,
+                    'R' : 'select[mem>8000] rusage[mem=8000] span[hosts=1]',
+                    'J' : '{job_name}',
+                    'oo': '{log_path}',
+                },
+                'cmdArgs' : {
+                    'yaps' : yaps_command,
+                    'db' : '/gscuser/kmeltzst/gscmnt/reference_files/gotcloud.ref/hapmap_3.3.b37.sites.vcf.gz',
+                    'threshold' : 2.0,
+                    'workers' : 4,
+                    'invcf' : None,
+                    'outvcf' : None,
+                    'stats' : None,
+                    'region' : None,
+                },
             },
             'input-file-format'  : r'\S*/(?P<chrom>\S+)/combined.c\S+\.vcf\.gz$',
             'output-file-format' : os.path.join(
@@ -126,7 +318,7 @@ def standard_config():
         'annotate-with-1000G' : {
             'outdir' : os.path.join(workspace, '4-annotate-w-1000G'),
             'CMD' : (
-                "bash {script} {invcf} {outvcf}"
+                "YAPS={yaps} bash {script} {invcf} {outvcf} {region}"
             ),
             'LSF' : {
                 'u' : email,
@@ -138,10 +330,13 @@ def standard_config():
                 'oo': '{log_path}',
             },
             'cmdArgs' : {
-                'script' : pkg_resources.resource_filename('yaps', 'data/postvqsr/annotate-w-1000G.sh'),
+                'script' : data_script('annotate-w-1000G.sh'),
+                'yaps' : yaps_env,
                 'invcf' : None,
                 'outvcf' : None,
+                'region' : None,
             },
+            'shards' : 1,
             'input-file-format'  : r'\S*/(?P<chrom>\S+)/filtered.c\S+\.vcf\.gz$',
             'output-file-format' : os.path.join(
                 workspace,
@@ -153,17 +348,31 @@ def standard_config():
 
     return config
 
-def initialize(input_vcfs, prj_name, email_address, wkspace, time_out, alt_config):
-    global email, workspace, input_files, config, timeout, project_name
-    project_name = prj_name
-    timeout = time_out
-    email = setup_email(email_address)
-    workspace = setup_workspace(wkspace)
-    input_files = parse_input_vcf_file(input_vcfs)
-    config = setup_config(alt_config)
+def load(input_vcfs, prj_name, email_address, wkspace, time_out, alt_config, stream=False, arrays=False, fused=False, persist=False, hashes=False, sized=False, attempts=None, speculative=False, builtin=False, lpt=False):
+    # the config of one run of the pipeline; nothing is kept here, so that
+    # any number of runs (e.g. the cohorts of a `yaps batch`) can each have
+    # their own
+    options = {
+        'project_name' : prj_name,
+        'streaming' : stream,
+        'job_arrays' : arrays,
+        'fuse' : fused,
+        'persist_intermediates' : persist,
+        'hash_inputs' : hashes,
+        'right_size' : sized,
+        'max_attempts' : attempts,
+        'speculate' : speculative,
+        'builtin_missingness' : builtin,
+        'largest_first' : lpt,
+        'timeout' : time_out,
+        'email' : setup_email(email_address),
+        'workspace' : setup_workspace(wkspace),
+        'input_files' : parse_input_vcf_file(input_vcfs),
+    }
+    return setup_config(alt_config, options)
 
-def dump_config():
+def dump_config(config):
     data = json.dumps(config, sort_keys=True, indent=4)
-    outfile = os.path.join(workspace, 'config.json')
+    outfile = os.path.join(config['workspace'], 'config.json')
     with open(outfile, 'w') as f:
         f.write(data)
@@ -1,5 +1,7 @@
 #!/bin/bash
 
+set -o pipefail
+
 BCFTOOLS=/gsc/bin/bcftools1.2
 TABIX=/gsc/bin/tabix
 
@@ -11,6 +13,28 @@ KGVCF+=ALL.wgs.phase3_shapeit2_mvncall_integrated_v5.20130502.sites.decompose.no
 
 INVCF=$1
 OUTVCF=$2
+REGION=$3
+
+REGIONS=
+if [[ ${REGION} == *:* && ${INVCF} != - ]]
+then
+    REGIONS="-r ${REGION}"
+fi
+
+# bgzip stdin into $1 and tabix-index it: in one pass, on all of the job's
+# slots, when yaps is there to do it (YAPS)
+write_indexed() {
+    if [[ -n ${YAPS} ]]
+    then
+        eval "${YAPS}" bgzip --index --threads ${LSB_DJOB_NUMPROC:-1} -o $1
+    else
+        bgzip -c > $1 && ${TABIX:-tabix} -p vcf -f $1
+    fi
+}
 
-${BCFTOOLS} annotate -a ${KGVCF} -c ID -O z -o ${OUTVCF} ${INVCF} \
-    && ${TABIX} -p vcf -f ${OUTVCF}
+if [[ ${OUTVCF} == - ]]
+then
+    ${BCFTOOLS} annotate ${REGIONS} -a ${KGVCF} -c ID -O v ${INVCF}
+else
+    ${BCFTOOLS} annotate ${REGIONS} -a ${KGVCF} -c ID -O v ${INVCF} | write_indexed ${OUTVCF}
+fi
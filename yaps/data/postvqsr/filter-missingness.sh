@@ -1,5 +1,7 @@
 #!/bin/bash
 
+set -o pipefail
+
 BIO_1662=/gscmnt/gc2802/halllab/idas/jira/BIO-1662
 SCRIPT=${BIO_1662}/bin/identify-missingness
 TABIX=/gsc/bin/tabix
@@ -10,9 +12,37 @@ DBSNP=/gscuser/kmeltzst/gscmnt/reference_files/gotcloud.ref/hapmap_3.3.b37.sites
 INVCF=$1
 OUTVCF=$2
 STATS=$3
+REGION=$4
+
+# bgzip stdin into $1 and tabix-index it: in one pass, on all of the job's
+# slots, when yaps is there to do it (YAPS)
+write_indexed() {
+    if [[ -n ${YAPS} ]]
+    then
+        eval "${YAPS}" bgzip --index --threads ${LSB_DJOB_NUMPROC:-1} -o $1
+    else
+        bgzip -c > $1 && ${TABIX:-tabix} -p vcf -f $1
+    fi
+}
 
 set -o xtrace
-${SCRIPT} --stats=${STATS} --db=${DBSNP} --missing-threshold=2.0 ${INVCF} | bgzip -c > ${OUTVCF} \
-    && ${TABIX} -p vcf -f ${OUTVCF} \
-    && ${GZIP_CMD} ${STATS};
+# identify-missingness wants a file, so cut a shard's interval out first
+if [[ ${INVCF} == - ]]
+then
+    INVCF=/dev/stdin
+elif [[ ${REGION} == *:* ]]
+then
+    REGIONVCF=${OUTVCF}.region.vcf.gz
+    ${TABIX} -h ${INVCF} ${REGION} | bgzip -c > ${REGIONVCF} && INVCF=${REGIONVCF} || exit 1
+fi
+
+if [[ ${OUTVCF} == - ]]
+then
+    ${SCRIPT} --stats=${STATS} --db=${DBSNP} --missing-threshold=2.0 ${INVCF} \
+        && ${GZIP_CMD} -f ${STATS};
+else
+    ${SCRIPT} --stats=${STATS} --db=${DBSNP} --missing-threshold=2.0 ${INVCF} | write_indexed ${OUTVCF} \
+        && ${GZIP_CMD} -f ${STATS} \
+        && rm -f ${OUTVCF}.region.vcf.gz;
+fi
 set +o xtrace
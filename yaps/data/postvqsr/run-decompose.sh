@@ -3,11 +3,14 @@
 # modified from @aregier
 #  ~aregier/scratch/dlarson-gatk-scripts/run_decompose.sh
 
+set -o pipefail
+
 BIO_1662=/gscmnt/gc2802/halllab/idas/jira/BIO-1662
 VT=${BIO_1662}/vendor/local/bin/vt-0.5
 
 INVCF=$1
 OUTVCF=$2
+REGION=$3
 
 if [ -a $OUTVCF ]
 then
@@ -16,5 +19,37 @@ fi
 
 REF=/gscmnt/gc2719/halllab/genomes/human/GRCh37/1kg_phase1/human_g1k_v37.fasta
 TMPVCF=$OUTVCF.temp
-zcat $INVCF | sed 's/ID=AD,Number=./ID=AD,Number=R/' | sed 's/reads with MQ=255 or/reads with MQ equals 255 or/' | ${VT} decompose -s - | ${VT} normalize -r $REF - | ${VT} uniq - | bgzip -c > $TMPVCF
-tabix -p vcf -f $TMPVCF && mv $TMPVCF.tbi $OUTVCF.tbi && mv $TMPVCF $OUTVCF
+
+# a shard only reads its own interval of the input
+READ="zcat $INVCF"
+if [[ $INVCF == - ]]
+then
+    READ=cat
+elif [[ $REGION == *:* ]]
+then
+    READ="tabix -h $INVCF $REGION"
+fi
+
+# bgzip stdin into $1 and tabix-index it: in one pass, on all of the job's
+# slots, when yaps is there to do it (YAPS)
+write_indexed() {
+    if [[ -n ${YAPS} ]]
+    then
+        eval "${YAPS}" bgzip --index --threads ${LSB_DJOB_NUMPROC:-1} -o $1
+    else
+        bgzip -c > $1 && ${TABIX:-tabix} -p vcf -f $1
+    fi
+}
+
+decompose() {
+    sed 's/ID=AD,Number=./ID=AD,Number=R/' | sed 's/reads with MQ=255 or/reads with MQ equals 255 or/' | ${VT} decompose -s - | ${VT} normalize -r $REF - | ${VT} uniq -
+}
+
+# in a fused job, plain VCF goes straight on to the next stage
+if [[ $OUTVCF == - ]]
+then
+    $READ | decompose
+    exit
+fi
+
+$READ | decompose | write_indexed $TMPVCF && mv $TMPVCF.tbi $OUTVCF.tbi && mv $TMPVCF $OUTVCF
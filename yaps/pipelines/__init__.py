@@ -0,0 +1,16 @@
+# The pipelines yaps can run, by subcommand.  Each names the module its
+# click command lives in (which should import nothing but click at module
+# level) and a line of help for `yaps --help`; the cli imports a
+# pipeline's command -- and the command its config and ruffus pipeline --
+# only once that subcommand is run, so that `yaps --help` pays for none
+# of them.
+registry = {
+    'postvqsr' : {
+        'command' : 'yaps.commands.postvqsr',
+        'help' : 'Run the post-VQSR stages over a set of chromosomal VCFs',
+    },
+    'batch' : {
+        'command' : 'yaps.commands.batch',
+        'help' : 'Run postvqsr over many cohorts in one process, sharing a poller and admission limits',
+    },
+}
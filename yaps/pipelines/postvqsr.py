@@ -1,240 +1,824 @@
-import os, pwd
-import pprint, sys
+import os, re, pwd, time
+import pprint, sys, shlex
 
 pp = pprint.PrettyPrinter(indent=4)
 
 from ruffus import *
+from six import string_types
+from six.moves import shlex_quote
 from clint.textui import colored
 
 from yaps.utils.jobqueue import DrmaaJobQueue
-from yaps.utils.scheduler import BatchJobManager
+from yaps.utils.buildcache import BuildCache
+from yaps.utils.resources import ResourceHistory
+from yaps.utils.planning import SubmissionPlan, input_size
+import yaps.utils.scheduler as scheduler
+from yaps.utils.intervals import shard_intervals
+from yaps.utils.readiness import wait_for_outputs
+import yaps.utils.preflight as preflight
+import yaps.utils.metrics as metrics
+import yaps.utils.tracing as tracing
 
 import yaps.utils.logger as logger
 import yaps.configs.postvqsr as conf
 
-queue = None
-LSF = None
-log = None
-ruffus_history_path = None
-orig_files = conf.input_files
-config = conf.config
-
-def initialize(job_db, ruffus_history, logfh, log_level, input_vcfs):
-    global log, queue, LSF, orig_files, ruffus_history_path
-    ruffus_history_path = ruffus_history
-    log = logger.create('postvqsr', logfh, log_level)
-    queue = DrmaaJobQueue(job_db, log)
-    LSF = BatchJobManager(log)
-
-def wait(timeout=config['lsf-timeout']):
-    queue.wait(timeout, log)
-
-def check_file_exists(file):
-    flag = True if os.path.exists(file) else False
-    return flag
-
-def update_output_file_modification_time(file):
-    log.info(colored.blue('Output already exists: {}'.format(file)))
-    log.info('Updating output file modification time')
-    os.utime(file, None)
-
-@originate(orig_files)
-def start(infile):
-    pass
-
-@posttask(wait)
-@follows(start, mkdir(config['ac-0-removal']['outdir']))
-@transform(
-    start,                                                    # inputs
-    formatter(config['ac-0-removal']['input-file-format']),   # file structure
-    config['ac-0-removal']['output-file-format'],             # replacement
-    "{chrom[0]}",                                             # chrom
-)
-def ac_0_removal(invcf, outvcf, chrom):
-    print("infile: {}".format(invcf))
-    print("outfile: {}".format(outvcf))
-    print("chrom: {}".format(chrom))
-
-    if check_file_exists(outvcf):
-        update_output_file_modification_time(outvcf)
-        return
-
-    context = config['ac-0-removal']
-
-    outdir = os.path.dirname(outvcf)
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
-
-    # properly fill up the command arguments
-    cmdArgs = context['cmdArgs']
-    cmdArgs['invcf'] = invcf
-    cmdArgs['outvcf'] = outvcf
-    cmdArgs['chrom'] = chrom
-
-    # setup the command to give to LSF/DRMAA
-    cmd = context['CMD'].format(**cmdArgs)
-    print('cmd: {}'.format(cmd))
-
-    # setup the LSF/DRMAA job params
-    jobName = '-'.join([
-        config['project-name'],
-        '1-ac-0-removal',
-        'chrom-{}'.format(chrom)
-    ])
-    lsfParams = context['LSF']
-    lsfParams['oo'] = os.path.join(context['outdir'], chrom, 'gatk-log-%J.log')
-
-    jobId = LSF.submit_job(cmd, jobName, job_params=lsfParams)
-    queue.append(jobId)
-
-@posttask(wait)
-@follows(ac_0_removal, mkdir(config['decompose-normalize-uniq']['outdir']))
-@transform(
-    ac_0_removal,                                                         # inputs
-    formatter(config['decompose-normalize-uniq']['input-file-format']),   # file structure
-    config['decompose-normalize-uniq']['output-file-format'],             # replacement
-    "{chrom[0]}",                                                         # chrom
-)
-def decompose_normalize_uniq(invcf, outvcf, chrom):
-    print("infile: {}".format(invcf))
-    print("outfile: {}".format(outvcf))
-    print("chrom: {}".format(chrom))
-
-    if check_file_exists(outvcf):
-        update_output_file_modification_time(outvcf)
-        return
-
-    context = config['decompose-normalize-uniq']
-
-    outdir = os.path.dirname(outvcf)
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
-
-    # properly fill up the command arguments
-    cmdArgs = context['cmdArgs']
-    cmdArgs['invcf'] = invcf
-    cmdArgs['outvcf'] = outvcf
-
-    # setup the command to give to LSF/DRMAA
-    cmd = context['CMD'].format(**cmdArgs)
-    print('cmd: {}'.format(cmd))
-
-    # setup the LSF/DRMAA job params
-    jobName = '-'.join([
-        config['project-name'],
-        '2-decompose-normalize-uniq',
-        'chrom-{}'.format(chrom)
-    ])
-    lsfParams = context['LSF']
-    lsfParams['oo'] = os.path.join(
-        context['outdir'],
-        chrom,
-        'decompose-normalize-uniq-log-%J.log'
+# (config section, job name step) in pipeline order
+stages = [
+    ('ac-0-removal', '1-ac-0-removal'),
+    ('decompose-normalize-uniq', '2-decompose-normalize-uniq'),
+    ('filter-missingness', '3-filter-missingness'),
+    ('annotate-with-1000G', '4-annotate-w-1000G'),
+]
+
+# LSF log file flags for each stage (relative to the output directory)
+stage_logs = {
+    'ac-0-removal' : { 'oo' : 'gatk-log-%J.log' },
+    'decompose-normalize-uniq' : { 'oo' : 'decompose-normalize-uniq-log-%J.log' },
+    'filter-missingness' : {
+        'eo' : 'missingness-%J.err',
+        'oo' : 'missingness-%J.out',
+    },
+    'annotate-with-1000G' : { 'oo' : '1000G-annotate-%J.out' },
+}
+fused_logs = { 'oo' : 'fused-log-%J.log' }
+
+def shard_output(outvcf, shard):
+    (outdir, name) = os.path.split(outvcf)
+    name = name.replace('.vcf.gz', '.shard-{}.vcf.gz'.format(shard))
+    return os.path.join(outdir, 'shards', name)
+
+def array_element(cmd, lsfParams):
+    # an array only gets one set of LSF log files, so each element
+    # redirects its own output to where its standalone job would have
+    logs = dict(
+        (flag, lsfParams[flag].replace('%J', '${LSB_JOBID}'))
+        for flag in ('oo', 'eo') if flag in lsfParams
     )
+    if 'eo' in logs:
+        return '( {} ) > {} 2> {}'.format(cmd, logs['oo'], logs['eo'])
+    return '( {} ) > {} 2>&1'.format(cmd, logs['oo'])
 
-    jobId = LSF.submit_job(cmd, jobName, job_params=lsfParams)
-    queue.append(jobId)
-
-@posttask(wait)
-@follows(decompose_normalize_uniq, mkdir(config['filter-missingness']['outdir']))
-@transform(
-    decompose_normalize_uniq,                                             # inputs
-    formatter(config['filter-missingness']['input-file-format']),         # file structure
-    config['filter-missingness']['output-file-format'],                   # replacement
-    "{chrom[0]}",                                                         # chrom
-)
-def filter_missingness(invcf, outvcf, chrom):
-    print("infile: {}".format(invcf))
-    print("outfile: {}".format(outvcf))
-    print("chrom: {}".format(chrom))
-
-    if check_file_exists(outvcf):
-        update_output_file_modification_time(outvcf)
-        return
-
-    context = config['filter-missingness']
-
-    outdir = os.path.dirname(outvcf)
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
-
-    # properly fill up the command arguments
-    cmdArgs = context['cmdArgs']
-    cmdArgs['invcf'] = invcf
-    cmdArgs['outvcf'] = outvcf
-    cmdArgs['stats'] = os.path.join(
-        context['outdir'],
-        chrom,
-        "{}.stats.missingness.out".format(chrom)
-    )
+def start(infile):
+    pass
 
-    # setup the command to give to LSF/DRMAA
-    cmd = context['CMD'].format(**cmdArgs)
-    print('cmd: {}'.format(cmd))
-
-    # setup the LSF/DRMAA job params
-    jobName = '-'.join([
-        config['project-name'],
-        '3-filter-missingness',
-        'chrom-{}'.format(chrom)
-    ])
-    lsfParams = context['LSF']
-    lsfParams['eo'] = os.path.join(context['outdir'], chrom, 'missingness-%J.err')
-    lsfParams['oo'] = os.path.join(context['outdir'], chrom, 'missingness-%J.out')
-
-    jobId = LSF.submit_job(cmd, jobName, job_params=lsfParams)
-    queue.append(jobId)
-
-@posttask(wait)
-@follows(filter_missingness, mkdir(config['annotate-with-1000G']['outdir']))
-@transform(
-    filter_missingness,                                                   # inputs
-    formatter(config['annotate-with-1000G']['input-file-format']),        # file structure
-    config['annotate-with-1000G']['output-file-format'],                  # replacement
-    "{chrom[0]}",                                                         # chrom
-)
-def annotate_with_1000G(invcf, outvcf, chrom):
-    print("infile: {}".format(invcf))
-    print("outfile: {}".format(outvcf))
-    print("chrom: {}".format(chrom))
-
-    if check_file_exists(outvcf):
-        update_output_file_modification_time(outvcf)
-        return
-
-    context = config['annotate-with-1000G']
-
-    outdir = os.path.dirname(outvcf)
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
-
-    # properly fill up the command arguments
-    cmdArgs = context['cmdArgs']
-    cmdArgs['invcf'] = invcf
-    cmdArgs['outvcf'] = outvcf
-
-    # setup the command to give to LSF/DRMAA
-    cmd = context['CMD'].format(**cmdArgs)
-    print('cmd: {}'.format(cmd))
-
-    # setup the LSF/DRMAA job params
-    jobName = '-'.join([
-        config['project-name'],
-        '4-annotate-w-1000G',
-        'chrom-{}'.format(chrom)
-    ])
-    lsfParams = context['LSF']
-    lsfParams['oo'] = os.path.join(context['outdir'], chrom, '1000G-annotate-%J.out')
-
-    jobId = LSF.submit_job(cmd, jobName, job_params=lsfParams)
-    queue.append(jobId)
-
-def end():
-    return annotate_with_1000G
-
-def run():
-    pipeline_run(
-        target_tasks = [end()],
-        exceptions_terminate_immediately=True,
-        history_file = ruffus_history_path,
-    )
+def task_name(stage):
+    return stage.replace('-', '_')
+
+class PostVQSR(object):
+    # One run of the pipeline over a cohort: its config (see
+    # yaps.configs.postvqsr.load), job DB, build cache and ruffus pipeline,
+    # and the job manager it submits through.  Several of them can run side
+    # by side in one process (see `yaps batch`), sharing a manager.
+    def __init__(self, config, job_db, ruffus_history, logfh, log_level, backend='lsf', backend_opts={}, build_cache=None, resource_history=None, manager=None, name='postvqsr'):
+        self.config = config
+        self.name = name
+        self.orig_files = config['inputs']
+        self.ruffus_history_path = ruffus_history
+        self.log = logger.create(name, logfh, log_level)
+        if build_cache is None:
+            build_cache = os.path.join(os.path.dirname(os.path.abspath(job_db)), '.build_cache.db')
+        self.cache = BuildCache(build_cache, self.log, content_hashes=config.get('hash-inputs', False))
+        if resource_history is None:
+            resource_history = os.path.join(os.path.expanduser('~'), '.yaps', 'resource_history.db')
+        sizing = config.get('sizing', {})
+        self.history = ResourceHistory(
+            resource_history, self.log,
+            margin=sizing.get('margin', 0.25),
+            min_memory=sizing.get('min-memory', 500),
+            queues=sizing.get('queues', []),
+        )
+        self.planner = SubmissionPlan(self.history, max_priority=config.get('planning', {}).get('max-priority', 100))
+
+        # per-stage commands waiting to go out as a single job array, and the
+        # gathers of sharded chromosomes that have to wait for that array
+        self.pending = dict((stage, []) for (stage, step) in stages)
+        self.pending_gathers = dict((stage, []) for (stage, step) in stages)
+
+        # the intervals each chromosome is cut into, by (chrom, shard count)
+        self.intervals = {}
+
+        # outputs of the jobs submitted since the queue was last waited on,
+        # and the probes of them already under way, by path
+        self.expected = []
+        self.checks = {}
+
+        # jobs an earlier run left queued or running, and the ones this run has
+        # taken over instead of resubmitting
+        self.survivors = set()
+        self.reattached = set()
+
+        # who the build cache had making each planned array element, by output
+        self.previously = {}
+
+        # the stages whose tasks have started running
+        self.begun = set()
+
+        # the chromosomes each stage's task has been handed, held back to be
+        # submitted largest first at the stage's barrier
+        self.deferred = dict((stage, []) for (stage, step) in stages)
+
+        speculation = config.get('speculation', {})
+        if speculation.get('enabled') and backend != 'lsf':
+            self.log.warning('Speculative copies need the LSF backend; not launching any')
+        elif speculation.get('enabled'):
+            policy = getattr(manager, 'speculation', None) or scheduler.SpeculationPolicy.from_config(speculation)
+            for group in self.units():
+                policy.seed(self.step_name(group[0]), self.history.runtimes(self.step_name(group[0])))
+            backend_opts = dict(backend_opts, speculation=policy)
+        # a shared manager (and its poller) is one the caller set up already
+        self.LSF = manager or scheduler.job_manager(backend, self.log, **backend_opts)
+        self.queue = DrmaaJobQueue(job_db, self.log, poller=self.LSF.poll, on_finish=self.finished, ready=self.outputs_ready)
+        self.resume()
+
+    def resume(self):
+        # an earlier run that died (or was stopped) may have left jobs in
+        # flight: the ones that have since finished are recorded now, and the
+        # live ones get taken over by whatever would have resubmitted them
+        job_ids = self.queue.unfinished()
+        if len(self.queue) > 0:
+            self.queue.clear()
+        if not job_ids:
+            return
+        (live, done) = self.LSF.reattach(job_ids)
+        for (job_id, status) in done.items():
+            self.queue.record(job_id, status)
+        lost = [ j for j in job_ids if j not in live and j not in done ]
+        self.queue.lost(lost)
+        self.cache.lost(lost)
+        self.survivors.update(str(j) for j in live)
+        self.log.info('An earlier run left {} jobs unfinished: {} still queued or running, {} finished since, {} lost'.format(
+            len(job_ids), len(live), len(done), len(lost)
+        ))
+
+    def finished(self, job_id, status):
+        self.cache.finished(job_id, status)
+        self.history.finished(job_id, status)
+
+    def outputs_ready(self, log):
+        wait_for_outputs(self.expected, log, timeout=self.config.get('output-timeout', 600), probes=self.checks)
+        del self.expected[:]
+        self.checks.clear()
+
+    def expect(self, outvcf, fp, jobId=None):
+        # a VCF is only ready for the next stage once its index is there too
+        self.cache.expect(outvcf, fp, jobId)
+        self.expected.extend([outvcf, outvcf + '.tbi'])
+        # under the asyncio core, they are looked for as soon as the job is
+        # done, while the rest of the stage is still being waited on
+        manager = scheduler.underlying(self.LSF)
+        if jobId is not None and isinstance(manager, scheduler.AsyncBatchJobManager):
+            self.checks.update(manager.check_outputs(
+                jobId, [outvcf, outvcf + '.tbi'], self.config.get('output-timeout', 600)
+            ))
+
+    def wait(self, timeout=None, stage=None):
+        self.queue.wait(timeout or self.config['lsf-timeout'], self.log, stage)
+
+    def barrier(self, stage):
+        def submit_and_wait():
+            with tracing.span('barrier', 'ruffus', stage=self.step_name(stage)):
+                self.submit_deferred(stage)
+                self.submit_stage_array(stage)
+                self.queue.mark(self.step_name(stage), 'submitted')
+                self.wait(stage=self.step_name(stage))
+        return submit_and_wait
+
+    def streaming(self):
+        return self.config.get('streaming', False)
+
+    def arrays(self):
+        return self.config.get('job-arrays', False)
+
+    def right_size(self):
+        return self.config.get('right-size', False)
+
+    def largest_first(self):
+        return self.config.get('planning', {}).get('largest-first', False)
+
+    def stage_output(self, stage, chrom):
+        return self.config[stage]['output-file-format'].format(chrom=[chrom])
+
+    def fused_stages(self):
+        fused = self.config.get('fuse', {}).get('stages', [])
+        names = [ s for (s, step) in stages ]
+        if not fused:
+            return []
+        if fused[0] not in names or names[names.index(fused[0]):][:len(fused)] != fused:
+            raise ValueError('Fused stages must follow one another in pipeline order: {}'.format(fused))
+        if not set(fused) <= set(conf.fusable_stages):
+            raise ValueError('Only {} can be fused'.format(', '.join(conf.fusable_stages)))
+        return fused
+
+    def fused_with(self, stage):
+        # the stages that run in the same job as this one, starting with it
+        fused = self.fused_stages()
+        if fused and fused[0] == stage:
+            return fused
+        return [stage]
+
+    def units(self):
+        # the stages in the order they are submitted, fused ones as one unit
+        fused = self.fused_stages()
+        return [ self.fused_with(s) for (s, step) in stages if s not in fused[1:] ]
+
+    def unit_output(self, stage, chrom):
+        return self.stage_output(self.fused_with(stage)[-1], chrom)
+
+    def step_name(self, stage):
+        group = self.fused_with(stage)
+        steps = dict(stages)
+        if len(group) == 1:
+            return steps[stage]
+        return '{}-to-{}'.format(steps[group[0]], steps[group[-1]])
+
+    def stage_lsf(self, stage):
+        # a fused job reserves what the hungriest of its stages asks for
+        group = self.fused_with(stage)
+        return dict(max((self.config[s]['LSF'] for s in group), key=scheduler.reserved_memory))
+
+    def source_vcf(self, chrom):
+        # the chromosome's original input VCF; every stage sizes its shards on
+        # it, since (when streaming) a stage's own input may not exist yet
+        pattern = re.compile(self.config['ac-0-removal']['input-file-format'])
+        for vcf in self.config['inputs']:
+            match = pattern.search(vcf)
+            if match and match.group('chrom') == chrom:
+                return vcf
+        return None
+
+    def stage_regions(self, stage, chrom):
+        shards = self.config[stage].get('shards', 1)
+        if (chrom, shards) not in self.intervals:
+            vcf = self.source_vcf(chrom)
+            if shards <= 1 or vcf is None:
+                self.intervals[(chrom, shards)] = [chrom]
+            else:
+                sizing = self.config.get('shard-sizing', 'data')
+                self.intervals[(chrom, shards)] = shard_intervals(vcf, chrom, shards, sizing)
+                self.log.info('Sharding {} of chrom {} into {}'.format(
+                    stage, chrom, ', '.join(self.intervals[(chrom, shards)])
+                ))
+        return self.intervals[(chrom, shards)]
+
+    def stats_output(self, stage, chrom, shard=None):
+        outdir = os.path.join(self.config[stage]['outdir'], chrom)
+        if shard is None:
+            return os.path.join(outdir, "{}.stats.missingness.out".format(chrom))
+        return os.path.join(outdir, 'shards', "{}.shard-{}.stats.missingness.out".format(chrom, shard))
+
+    def stage_command(self, stage, invcf, outvcf, chrom, region=None, shard=None):
+        context = self.config[stage]
+
+        # properly fill up the command arguments
+        cmdArgs = dict(context['cmdArgs'])
+        cmdArgs['invcf'] = invcf
+        cmdArgs['outvcf'] = outvcf
+        if 'chrom' in cmdArgs:
+            cmdArgs['chrom'] = chrom
+        if 'region' in cmdArgs:
+            cmdArgs['region'] = region or chrom
+        if 'stats' in cmdArgs:
+            cmdArgs['stats'] = self.stats_output(stage, chrom, shard)
+            if not os.path.exists(os.path.dirname(cmdArgs['stats'])):
+                os.makedirs(os.path.dirname(cmdArgs['stats']))
+
+        return context['CMD'].format(**cmdArgs)
+
+    def fused_command(self, group, invcf, outvcf, chrom, region=None, shard=None):
+        # the stages pipe plain VCF into one another; an intermediate only gets
+        # written out (tee'd, then bgzipped and indexed) when persisting them
+        context = self.config['fuse']
+        pipe = []
+        persisted = []
+        for s in group:
+            stage_in = invcf if s == group[0] else '-'
+            stage_out = outvcf if s == group[-1] else '-'
+            pipe.append(self.stage_command(s, stage_in, stage_out, chrom, region, shard))
+            if stage_out == '-' and context.get('persist-intermediates'):
+                keep = self.stage_output(s, chrom)
+                if shard is not None:
+                    keep = shard_output(keep, shard)
+                if not os.path.exists(os.path.dirname(keep)):
+                    os.makedirs(os.path.dirname(keep))
+                keep = re.sub(r'\.gz$', '', keep)
+                pipe.append('tee {}'.format(shlex_quote(keep)))
+                persisted.append(keep)
+
+        cmd = 'bash -o pipefail -c {}'.format(shlex_quote(' | '.join(pipe)))
+        for vcf in persisted:
+            cmdArgs = dict(context['cmdArgs'], vcf=vcf)
+            cmd += ' && ' + context['CMD'].format(**cmdArgs)
+        return cmd
+
+    def stage_job(self, stage, invcf, outvcf, chrom, region=None, shard=None):
+        group = self.fused_with(stage)
+
+        outdir = os.path.dirname(outvcf)
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+
+        # setup the command to give to LSF/DRMAA
+        if len(group) == 1:
+            cmd = self.stage_command(stage, invcf, outvcf, chrom, region, shard)
+            logs = stage_logs[stage]
+        else:
+            cmd = self.fused_command(group, invcf, outvcf, chrom, region, shard)
+            logs = fused_logs
+        print('cmd: {}'.format(cmd))
+
+        # setup the LSF/DRMAA job params
+        jobName = '-'.join([
+            self.config['project-name'],
+            self.step_name(stage),
+            'chrom-{}'.format(chrom)
+        ])
+        if shard is not None:
+            jobName += '-shard-{}'.format(shard)
+        lsfParams = self.stage_lsf(stage)
+        for flag, logfile in logs.items():
+            lsfParams[flag] = os.path.join(outdir, logfile)
+
+        return (cmd, jobName, lsfParams)
+
+    def gather_job(self, stage, outvcf, chrom, shard_vcfs):
+        context = self.config['gather']
+        cmdArgs = dict(context['cmdArgs'])
+        cmdArgs['outvcf'] = outvcf
+        cmdArgs['shards'] = ' '.join(shard_vcfs)
+        cmd = context['CMD'].format(**cmdArgs)
+        # gzip streams concatenate, so the per-shard stats just get stacked up
+        for s in self.fused_with(stage):
+            if 'stats' in self.config[s]['cmdArgs']:
+                cmd += ' && cat {} > {}.gz'.format(
+                    ' '.join(self.stats_output(s, chrom, i) + '.gz' for i in range(1, len(shard_vcfs) + 1)),
+                    self.stats_output(s, chrom)
+                )
+        print('cmd: {}'.format(cmd))
+
+        jobName = '-'.join([
+            self.config['project-name'],
+            self.step_name(stage),
+            'chrom-{}'.format(chrom),
+            'gather',
+        ])
+        lsfParams = dict(context['LSF'])
+        lsfParams['oo'] = os.path.join(os.path.dirname(outvcf), 'gather-%J.log')
+        return (cmd, jobName, lsfParams)
+
+    def stage_scripts(self, stage):
+        scripts = [ self.config[s]['cmdArgs'].get('script') for s in self.fused_with(stage) ]
+        return [ script for script in scripts if script ]
+
+    def fingerprint(self, job, inputs, scripts=[]):
+        # everything a job's output depends on: its command, the stage scripts,
+        # its inputs and its LSF reservation (but not who gets mailed about it)
+        (cmd, jobName, lsfParams) = job
+        params = dict((k, v) for (k, v) in lsfParams.items() if k not in ('u', 'N'))
+        return self.cache.fingerprint(cmd, scripts, inputs, params)
+
+    def up_to_date(self, outvcf, fp):
+        if self.cache.fresh(outvcf, fp):
+            self.log.info(colored.blue('Output is up to date: {}'.format(outvcf)))
+            return True
+        return False
+
+    def history_key(self, jobName):
+        # (step, item) that a job's resource usage is kept under, e.g.
+        # ('2-decompose-normalize-uniq', 'chrom-1-shard-2')
+        (step, item) = jobName[len(self.config['project-name']) + 1:].rsplit('-chrom-', 1)
+        return (step, 'chrom-' + item)
+
+    def job_labels(self, jobName):
+        # what the job DB files a job under
+        (step, item) = self.history_key(jobName)
+        match = re.match(r'chrom-(.+?)(?:-shard-(\d+))?(?:-gather)?$', item)
+        return {
+            'stage' : step,
+            'item' : item,
+            'chrom' : match.group(1),
+            'shard' : int(match.group(2)) if match.group(2) else None,
+        }
+
+    def speculable(self, stage):
+        # a copy of a job may only race the original when everything it writes
+        # gets staged, which persisted intermediates don't.  A manager shared
+        # with other runs may speculate for them but not for this one.
+        if getattr(self.LSF, 'speculation', None) is None or not self.config.get('speculation', {}).get('enabled'):
+            return False
+        return len(self.fused_with(stage)) == 1 or not self.config['fuse'].get('persist-intermediates')
+
+    def cohort(self, stage):
+        # what a straggler's runtime is measured against
+        return self.step_name(stage) if self.speculable(stage) else None
+
+    def staged(self, stage, job, outvcf, chrom, shard=None):
+        # have the job write into a scratch directory of its own and move its
+        # outputs into place once it succeeds, so that two copies of it never
+        # see each other's partial files
+        if not self.speculable(stage):
+            return job
+        (cmd, jobName, lsfParams) = job
+        outputs = [outvcf] + [
+            self.stats_output(s, chrom, shard) for s in self.fused_with(stage)
+            if 'stats' in self.config[s]['cmdArgs']
+        ]
+        for path in outputs:
+            cmd = cmd.replace(path, '$STAGING/' + os.path.basename(path))
+        moves = [
+            'mv -f $STAGING/{}* {}/'.format(os.path.basename(p), os.path.dirname(p))
+            for p in outputs
+        ]
+        cmd = (
+            "STAGING=$(mktemp -d {}/.staging.XXXXXX) && export STAGING && "
+            "trap 'rm -rf $STAGING' EXIT && {} && {}"
+        ).format(os.path.dirname(outvcf), cmd, ' && '.join(moves))
+        return (cmd, jobName, lsfParams)
+
+    def retry_policy(self, section):
+        settings = dict(self.config['retry'], **self.config[section].get('retry', {}))
+        return scheduler.RetryPolicy.from_config(settings)
+
+    def reattach(self, job, outvcf, fp, depends_on=None, retry=None, cohort=None):
+        # the id of a job an earlier run left making outvcf, when it is still
+        # making the same thing after the same upstream jobs; otherwise it is
+        # killed, so as not to race its replacement
+        building = self.cache.building(outvcf)
+        if building is None or building[1] not in self.survivors:
+            return None
+        (fingerprint, jobId) = building
+        self.survivors.discard(jobId)
+        upstream = depends_on if isinstance(depends_on, list) else [depends_on]
+        if fingerprint != fp or not set(str(j) for j in upstream if j is not None) <= self.reattached:
+            self.log.warning(colored.yellow('Killing job {} left by an earlier run, as {} needs remaking'.format(jobId, outvcf)))
+            self.LSF.kill([jobId])
+            return None
+        (cmd, jobName, lsfParams) = job
+        self.LSF.adopt(jobId, cmd, jobName, lsfParams, depends_on, retry, cohort)
+        self.queue.reattach(jobId)
+        self.history.track(jobId, *self.history_key(jobName), job_params=lsfParams)
+        self.expect(outvcf, fp, jobId)
+        self.reattached.add(jobId)
+        self.log.info(colored.blue('Reattached to job {}, still making {}'.format(jobId, outvcf)))
+        return jobId
+
+    def reattach_arrays(self, stage, planned):
+        # an earlier run's job array is waited on again when everything this
+        # run planned for it is still what it is making, else killed; returns
+        # what is left to submit and the arrays taken over
+        arrays = {}
+        for element in planned:
+            building = self.previously.pop(element[1], None)
+            if building is not None and building[1] in self.survivors:
+                arrays.setdefault(building[1], []).append((element, building[0] == element[2]))
+        left = list(planned)
+        arrayIds = []
+        for (jobId, elements) in arrays.items():
+            self.survivors.discard(jobId)
+            if not all(same for (element, same) in elements):
+                self.log.warning(colored.yellow('Killing job array {} left by an earlier run, as some of its outputs need remaking'.format(jobId)))
+                self.LSF.kill([jobId])
+                continue
+            for (element, same) in elements:
+                left.remove(element)
+                (cmd, outvcf, fp, name) = element
+                self.expect(outvcf, fp, jobId)
+            self.queue.reattach(jobId)
+            self.reattached.add(jobId)
+            arrayIds.append(jobId)
+            self.log.info(colored.blue('Reattached to job array {}, still making {} outputs'.format(jobId, len(elements))))
+        return (left, arrayIds)
+
+    def submit(self, job, outvcf, fp, depends_on=None, retry=None, cohort=None):
+        jobId = self.reattach(job, outvcf, fp, depends_on, retry, cohort)
+        if jobId is not None:
+            return jobId
+        # the fingerprint is taken on the configured reservation, so sizing
+        # it to the job's history doesn't make its output look out of date
+        (cmd, jobName, lsfParams) = job
+        if self.right_size():
+            lsfParams = self.history.size(lsfParams, [self.history_key(jobName)])
+        if self.largest_first():
+            lsfParams = self.prioritized(lsfParams, jobName)
+        jobId = self.LSF.submit_job(
+            cmd, jobName, job_params=lsfParams, depends_on=depends_on, retry=retry, cohort=cohort
+        )
+        self.queue.append(jobId, jobName, cmd, lsfParams, **self.job_labels(jobName))
+        self.history.track(jobId, *self.history_key(jobName), job_params=lsfParams)
+        self.expect(outvcf, fp, jobId)
+        return jobId
+
+    def submit_stage(self, stage, invcf, outvcf, chrom, depends_on=None, upstream={}):
+        # returns the id of the job making outvcf (None when it is up to date),
+        # along with the shards it is gathered from as {region : (shard vcf, job id)}
+        if self.largest_first():
+            self.stage_costs(stage)
+        regions = self.stage_regions(stage, chrom)
+        if len(regions) == 1:
+            job = self.stage_job(stage, invcf, outvcf, chrom)
+            fp = self.fingerprint(job, [invcf], self.stage_scripts(stage))
+            if self.up_to_date(outvcf, fp):
+                return (None, {})
+            job = self.staged(stage, job, outvcf, chrom)
+            return (self.submit(job, outvcf, fp, depends_on, self.retry_policy(stage), self.cohort(stage)), {})
+
+        # a shard reads the same shard of the previous stage straight away
+        # when there is one, rather than waiting on its gather
+        shards = {}
+        for (i, region) in enumerate(regions, 1):
+            shardvcf = shard_output(outvcf, i)
+            (shardin, after) = upstream.get(region, (invcf, depends_on))
+            job = self.stage_job(stage, shardin, shardvcf, chrom, region, i)
+            fp = self.fingerprint(job, [shardin], self.stage_scripts(stage))
+            if self.up_to_date(shardvcf, fp):
+                shards[region] = (shardvcf, None)
+            else:
+                job = self.staged(stage, job, shardvcf, chrom, i)
+                shards[region] = (shardvcf, self.submit(job, shardvcf, fp, after, self.retry_policy(stage), self.cohort(stage)))
+
+        shard_vcfs = [ shards[r][0] for r in regions ]
+        job = self.gather_job(stage, outvcf, chrom, shard_vcfs)
+        fp = self.fingerprint(job, shard_vcfs)
+        if self.up_to_date(outvcf, fp):
+            return (None, shards)
+        shard_jobs = [ shards[r][1] for r in regions if shards[r][1] is not None ]
+        return (self.submit(job, outvcf, fp, shard_jobs or None, self.retry_policy('gather')), shards)
+
+    def plan(self, stage, job, outvcf, fp):
+        # the output is expected as soon as it is planned, so that whatever
+        # reads it can be fingerprinted before the array goes out
+        (cmd, jobName, lsfParams) = job
+        self.pending[stage].append((array_element(cmd, lsfParams), outvcf, fp, jobName))
+        self.previously[outvcf] = self.cache.building(outvcf)
+        self.expect(outvcf, fp)
+
+    def plan_stage(self, stage, invcf, outvcf, chrom):
+        regions = self.stage_regions(stage, chrom)
+        if len(regions) == 1:
+            job = self.stage_job(stage, invcf, outvcf, chrom)
+            fp = self.fingerprint(job, [invcf], self.stage_scripts(stage))
+            if not self.up_to_date(outvcf, fp):
+                self.plan(stage, job, outvcf, fp)
+            return
+
+        shard_vcfs = []
+        for (i, region) in enumerate(regions, 1):
+            shardvcf = shard_output(outvcf, i)
+            shard_vcfs.append(shardvcf)
+            job = self.stage_job(stage, invcf, shardvcf, chrom, region, i)
+            fp = self.fingerprint(job, [invcf], self.stage_scripts(stage))
+            if not self.up_to_date(shardvcf, fp):
+                self.plan(stage, job, shardvcf, fp)
+
+        job = self.gather_job(stage, outvcf, chrom, shard_vcfs)
+        fp = self.fingerprint(job, shard_vcfs)
+        if not self.up_to_date(outvcf, fp):
+            self.pending_gathers[stage].append((job, outvcf, fp))
+
+    def submit_stage_array(self, stage):
+        (planned, reattachedIds) = self.reattach_arrays(stage, self.pending[stage])
+        arrayIds = []
+        if planned and self.largest_first():
+            # LSF dispatches an array's elements in index order
+            self.stage_costs(stage)
+            order = self.planner.order(self.step_name(stage), [ self.history_key(name)[1] for (cmd, outvcf, fp, name) in planned ])
+            planned.sort(key=lambda element: order.index(self.history_key(element[3])[1]))
+        if planned:
+            cmds = [ cmd for (cmd, outvcf, fp, name) in planned ]
+            keys = [ self.history_key(name) for (cmd, outvcf, fp, name) in planned ]
+            context = self.config[stage]
+            jobName = '-'.join([self.config['project-name'], self.step_name(stage)])
+            lsfParams = self.stage_lsf(stage)
+            lsfParams.pop('eo', None)
+            lsfParams['oo'] = os.path.join(context['outdir'], 'array-%J-%I.log')
+            if self.right_size():
+                lsfParams = self.history.size(lsfParams, keys)
+            script = os.path.join(context['outdir'], '{}.array.sh'.format(jobName))
+            arrayIds = self.LSF.submit_array(cmds, jobName, script, job_params=lsfParams)
+            # LSF hands back one id for the whole array (so there is no usage
+            # to keep per element), DRMAA one per element
+            if len(arrayIds) != len(planned):
+                self.queue.append(arrayIds[0], jobName, script, lsfParams, stage=self.step_name(stage))
+            for (i, (cmd, outvcf, fp, name)) in enumerate(planned):
+                if len(arrayIds) == len(planned):
+                    self.queue.append(arrayIds[i], name, cmd, lsfParams, **self.job_labels(name))
+                    self.expect(outvcf, fp, arrayIds[i])
+                    self.history.track(arrayIds[i], *keys[i], job_params=lsfParams)
+                else:
+                    self.expect(outvcf, fp, arrayIds[0])
+        for (job, outvcf, fp) in self.pending_gathers[stage]:
+            self.submit(job, outvcf, fp, depends_on=(arrayIds + reattachedIds) or None, retry=self.retry_policy('gather'))
+        self.pending[stage] = []
+        self.pending_gathers[stage] = []
+
+    def submit_chain(self, stage, invcf, chrom):
+        # submit this stage and every later one for the chromosome, each job
+        # held by LSF until its predecessor is done
+        names = [ group[0] for group in self.units() ]
+        jobId = None
+        shards = {}
+        for s in names[names.index(stage):]:
+            outvcf = self.unit_output(s, chrom)
+            (jobId, shards) = self.submit_stage(s, invcf, outvcf, chrom, depends_on=jobId, upstream=shards)
+            invcf = outvcf
+
+    def process(self, stage, invcf, outvcf, chrom):
+        print("infile: {}".format(invcf))
+        print("outfile: {}".format(outvcf))
+        print("chrom: {}".format(chrom))
+
+        if self.arrays():
+            self.plan_stage(stage, invcf, outvcf, chrom)
+        elif self.largest_first():
+            self.deferred[stage].append((invcf, outvcf, chrom))
+        elif self.streaming():
+            self.submit_chain(stage, invcf, chrom)
+        else:
+            self.submit_stage(stage, invcf, outvcf, chrom)
+
+    def stage_costs(self, stage):
+        # the predicted cost of each of the stage's jobs, by item; a shard is
+        # taken to be its share of the chromosome's input, and a gather (being
+        # on the way to everything downstream of the chromosome) to cost as
+        # much as the chromosome's biggest shard
+        step = self.step_name(stage)
+        if step in self.planner.costs:
+            return self.planner.costs[step]
+        pattern = re.compile(self.config['ac-0-removal']['input-file-format'])
+        sizes = {}
+        gathers = {}
+        for vcf in self.config['inputs']:
+            match = pattern.search(vcf)
+            if not match:
+                continue
+            chrom = match.group('chrom')
+            regions = self.stage_regions(stage, chrom)
+            if len(regions) == 1:
+                sizes['chrom-{}'.format(chrom)] = input_size(vcf)
+                continue
+            shards = [ 'chrom-{}-shard-{}'.format(chrom, i) for i in range(1, len(regions) + 1) ]
+            for item in shards:
+                sizes[item] = input_size(vcf) // len(regions)
+            gathers['chrom-{}-gather'.format(chrom)] = shards
+        costs = self.planner.estimate(step, sizes)
+        for (item, shards) in gathers.items():
+            costs[item] = max(costs[s] for s in shards)
+        order = self.planner.order(step, sizes)
+        self.log.info('Submitting {} jobs largest first, by {}: {}{}'.format(
+            step, self.planner.basis[step], ', '.join(order[:5]), ', ...' if len(order) > 5 else ''
+        ))
+        return costs
+
+    def prioritized(self, lsfParams, jobName):
+        # a job's LSF user priority goes with its predicted cost; the local
+        # runner goes by submission order alone
+        if isinstance(scheduler.underlying(self.LSF), scheduler.LocalExecutor):
+            return lsfParams
+        priority = self.planner.priority(*self.history_key(jobName))
+        if priority is None:
+            return lsfParams
+        return dict(lsfParams, sp=priority)
+
+    def submit_deferred(self, stage):
+        # longest processing time first: the chromosomes predicted to take
+        # longest go out first, so that the stage (with the same slots) isn't
+        # left waiting on a big one that got going last
+        held = self.deferred[stage]
+        self.deferred[stage] = []
+        if not held:
+            return
+        costs = self.stage_costs(stage)
+        def chrom_cost(chrom):
+            item = re.compile(r'chrom-{}(-|$)'.format(re.escape(chrom)))
+            return max([ c for (i, c) in costs.items() if item.match(i) ] or [0])
+        for (invcf, outvcf, chrom) in sorted(held, key=lambda h: -chrom_cost(h[2])):
+            if self.streaming():
+                self.submit_chain(stage, invcf, chrom)
+            else:
+                self.submit_stage(stage, invcf, outvcf, chrom)
+
+    @tracing.traced('run_stage', 'ruffus', lambda self, invcf, outvcf, chrom, stage: { 'stage' : stage, 'chrom' : chrom })
+    def run_stage(self, invcf, outvcf, chrom, stage):
+        if stage not in self.begun:
+            self.begun.add(stage)
+            self.queue.mark(self.step_name(stage), 'began')
+        self.process(stage, invcf, outvcf, chrom)
+
+    def build(self):
+        # ruffus keeps every pipeline by name, so each run's gets its own
+        pipeline = Pipeline(self.name)
+        previous = pipeline.originate(task_func=start, output=self.orig_files)
+        for group in self.units():
+            (first, last) = (group[0], group[-1])
+            task = pipeline.transform(
+                task_func=self.run_stage,
+                name=task_name(first),
+                input=previous,                                                 # inputs
+                filter=formatter(self.config[first]['input-file-format']),      # file structure
+                output=self.config[last]['output-file-format'],                 # replacement
+                extras=["{chrom[0]}", first],                                   # chrom, stage
+            )
+            task.follows(previous, *[ mkdir(self.config[s]['outdir']) for s in group ])
+            task.posttask(self.barrier(first))
+            previous = task
+        return pipeline
+
+    def preflight_checks(self, input_vcfs):
+        # (problems with the input list itself, checks to run on what it and
+        # the stage configs point at)
+        problems = []
+        checks = []
+        pattern = re.compile(self.config['ac-0-removal']['input-file-format'])
+        with open(input_vcfs, 'r') as f:
+            for (n, line) in enumerate(f, 1):
+                fields = line.rstrip().split("\t")
+                if len(fields) != 2:
+                    problems.append('{} line {}: expected <chrom><tab><vcf>'.format(input_vcfs, n))
+                    continue
+                (chrom, vcf) = fields
+                match = pattern.search(vcf)
+                if not match:
+                    problems.append('{} does not match the input-file-format'.format(vcf))
+                elif match.group('chrom') != chrom:
+                    problems.append('{} is listed as chrom {}, but its path says {}'.format(
+                        vcf, chrom, match.group('chrom')
+                    ))
+                checks.append((preflight.check_vcf, (chrom, vcf)))
+
+        sections = [ s for (s, step) in stages ]
+        if any(self.config[s].get('shards', 1) > 1 for s in sections):
+            sections.append('gather')
+        if self.fused_stages() and self.config['fuse'].get('persist-intermediates'):
+            sections.append('fuse')
+
+        tools = set()
+        for section in sections:
+            for (arg, value) in self.config[section]['cmdArgs'].items():
+                if arg in ('java', 'bcftools', 'tabix', 'bgzip'):
+                    tools.add((preflight.check_executable, (value,)))
+                elif arg == 'yaps':
+                    # the shell command to run yaps with, quoted once more
+                    # when it is a stage script's YAPS=
+                    words = shlex.split(value)
+                    if 'YAPS={yaps}' in self.config[section]['CMD']:
+                        words = shlex.split(words[0])
+                    tools.add((preflight.check_executable, (words[0],)))
+                elif arg == 'reference':
+                    tools.add((preflight.check_reference, (value,)))
+                elif arg == 'script':
+                    tools.add((preflight.check_script, (value,)))
+                elif isinstance(value, string_types) and os.path.isabs(value):
+                    tools.add((preflight.check_file, (value,)))
+        if any(self.config[s].get('engine') == 'builtin' for s in sections):
+            tools.add((preflight.check_module, ('numpy',)))
+        if isinstance(scheduler.underlying(self.LSF), scheduler.BatchJobManager):
+            tools.update((preflight.check_executable, (cmd,)) for cmd in ('bsub', 'bjobs', 'bkill'))
+        return (problems, checks + sorted(tools, key=lambda check: check[1]))
+
+    def run_preflight(self, input_vcfs):
+        # everything the jobs will need, checked before any of them is
+        # submitted; returns the problems found
+        start = time.time()
+        (problems, checks) = self.preflight_checks(input_vcfs)
+        problems += preflight.run_checks(checks)
+        for problem in problems:
+            self.log.error(colored.red('Preflight: {}'.format(problem)))
+        self.log.info('Preflight ran {} checks in {:.1f} secs: {} problems'.format(
+            len(checks), time.time() - start, len(problems)
+        ))
+        return problems
+
+    def run(self):
+        # every task runs, and the build cache decides which of its jobs are
+        # out of date -- rather than ruffus going by file timestamps
+        pipeline = self.build()
+        try:
+            pipeline.run(
+                forcedtorun_tasks=[ task_name(group[0]) for group in self.units() ],
+                exceptions_terminate_immediately=True,
+                history_file = self.ruffus_history_path,
+            )
+        finally:
+            # a run that failed or stalled is the one most worth looking at
+            if tracing.enabled():
+                self.export_trace()
+        if self.right_size():
+            self.history.report()
+        self.export_metrics()
+
+    def export_metrics(self):
+        # the run's timings, for `yaps report` to break down and for a
+        # Prometheus node_exporter textfile collector to pick up
+        summary = metrics.run_summary(self.queue, self.queue.run)
+        outdir = self.config['workspace']
+        metrics.write_json(summary, os.path.join(outdir, 'metrics.json'))
+        metrics.write_prometheus(summary, os.path.join(outdir, 'metrics.prom'))
+        self.log.info('Run took {} over {} jobs; see `yaps report --workspace {}`'.format(
+            metrics.secs(summary['wall']), summary['jobs'], outdir
+        ))
+
+    def export_trace(self):
+        # a timeline of the run (yaps' own spans and every job's lifecycle),
+        # for chrome://tracing or https://ui.perfetto.dev
+        path = os.path.join(self.config['workspace'], 'trace.{}.json'.format(self.queue.run))
+        tracing.write(path, self.queue.run, self.queue.records(run=self.queue.run), self.queue.marks(self.queue.run))
+        self.log.info('Wrote a trace of the run to {}'.format(path))
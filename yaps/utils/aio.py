@@ -0,0 +1,218 @@
+import atexit, asyncio, threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from shlex import quote
+
+from clint.textui import colored
+
+import yaps.utils.tracing as tracing
+import yaps.utils.readiness as readiness
+from yaps.utils.scheduler import bsub, BSubException, BSubJobNotFound, JobFailed
+
+# The LSF side of the scheduler as asyncio coroutines, on an event loop with
+# a thread of its own.  bsub, bjobs, bkill and bmod are run with
+# create_subprocess_exec from argv lists, with a submission's command on
+# bsub's stdin, so no shell ever parses a command or a flag.  The calls
+# that don't depend on each other go out at once, up to a limit: the
+# batches of a bjobs query, a round's kills, and the probes of outputs whose
+# jobs have finished, which run while the poller carries on.  Job handles
+# are futures the poller resolves with a job's final status.  A coroutine
+# can await them, and a thread can wait on one.
+#
+# scheduler.AsyncBatchJobManager is the synchronous face of all this that
+# the pipelines use, with BatchJobManager's API.  Coroutines are run on the
+# loop from other threads through Orchestrator.run(); a round of the
+# poller, which may submit retries through it, runs on a worker thread so
+# that it never blocks the loop it waits on.
+
+class JobHandle(object):
+    # a job's final status (as the poller reports it), once it has finished
+    # for good -- a job that is retried (or beaten by a speculative copy)
+    # lives on as the job standing in for it
+    def __init__(self, job_id):
+        self.job_id = str(job_id)
+        self.future = Future()
+
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def resolve(self, status):
+        if not self.future.done():
+            self.future.set_result(status)
+
+class Orchestrator(object):
+    def __init__(self, concurrency=8, probes=16):
+        # at most `concurrency` LSF commands in flight at once, so as not to
+        # swamp mbatchd; output probes look at files on a pool of their own
+        self.concurrency = concurrency
+        self.files = ThreadPoolExecutor(probes)
+        self.loop = asyncio.new_event_loop()
+        self.limit = None
+        started = threading.Event()
+        self.thread = threading.Thread(target=self._serve, args=(started,), name='yaps-asyncio')
+        self.thread.daemon = True
+        self.thread.start()
+        started.wait()
+        atexit.register(self.close)
+
+    def _serve(self, started):
+        asyncio.set_event_loop(self.loop)
+        self.limit = asyncio.Semaphore(self.concurrency)
+        self.loop.call_soon(started.set)
+        self.loop.run_forever()
+
+    def run(self, coro):
+        # run a coroutine on the loop and wait for its result, from any
+        # thread but the loop's own
+        if threading.current_thread() is self.thread:
+            raise RuntimeError('Orchestrator.run() would block its own event loop')
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def spawn(self, coro):
+        # start a coroutine on the loop; a concurrent.futures.Future of it
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def close(self):
+        # whatever is still under way (e.g. probes of a failed run's outputs)
+        # is cancelled, rather than left for the interpreter to tear down
+        if not self.loop.is_running():
+            return
+        async def cancel():
+            tasks = [ t for t in asyncio.all_tasks() if t is not asyncio.current_task() ]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self.run(cancel())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.files.shutdown(wait=False)
+
+    async def execute(self, argv, stdin=None, expect=None):
+        # argv's stdout, once it has exited 0 (and said `expect`), with the
+        # errors bsub._run raises
+        command = command_line(argv, stdin)
+        async with self.limit:
+            with tracing.span('lsf.exec', 'lsf', command=argv[0]):
+                proc = await asyncio.create_subprocess_exec(
+                    *argv,
+                    stdin=asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+                )
+                (out, err) = await proc.communicate(stdin.encode() if stdin is not None else None)
+        res = out.strip().decode('utf-8', 'replace')
+        err = err.strip().decode('utf-8', 'replace')
+        if proc.returncode == 255:
+            raise BSubJobNotFound(command)
+        elif proc.returncode != 0:
+            raise BSubException('{}[{}]: {}'.format(command, proc.returncode, err or res))
+        if expect is not None and expect not in res:
+            raise BSubException(res)
+        return res
+
+    async def submit(self, cmd, job_name, job_params, log):
+        # the id of the job bsub makes of cmd (on its stdin, as `printf ... |
+        # bsub` had it)
+        argv = ['bsub'] + bsub.argv(dict(job_params, J=job_name))
+        log.info(colored.yellow('LSF EXEC CMD: {}'.format(command_line(argv, cmd))))
+        res = await self.execute(argv, stdin=cmd + '\n', expect='is submitted')
+        return res.split('<', 1)[1].split('>', 1)[0]
+
+    async def job_records(self, job_ids, batch=None):
+        # bsub.job_records, with all of its bjobs batches asked at once
+        batch = batch or bsub.bjobs_batch
+        job_ids = list(job_ids)
+        batches = [ job_ids[i:i + batch] for i in range(0, len(job_ids), batch) ]
+        outputs = await asyncio.gather(*[ self.execute(bsub.bjobs_argv(b)) for b in batches ])
+        records = {}
+        for (b, output) in zip(batches, outputs):
+            bsub.file_records(output, b, records)
+        return records
+
+    async def kill(self, job_ids, log, **kwargs):
+        # bsub.bkill, every id and name at once; the first failure is raised
+        # once all of them have been tried
+        ids = [ str(j) for j in job_ids if bsub.job_id_pattern.match(str(j)) ]
+        names = [ str(j) for j in job_ids if not bsub.job_id_pattern.match(str(j)) ]
+        flags = bsub.argv(kwargs)
+        commands = ([ ['bkill'] + flags + ids ] if ids else []) + [ ['bkill'] + flags + ['-J', n] for n in names ]
+        for argv in commands:
+            log.info(colored.yellow('LSF EXEC CMD: {}'.format(command_line(argv))))
+        results = await asyncio.gather(
+            *[ self.execute(argv, expect='is being terminated') for argv in commands ],
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+    async def modify(self, job_id, log, **kwargs):
+        argv = ['bmod'] + bsub.argv(kwargs) + [str(job_id)]
+        log.info(colored.yellow('LSF EXEC CMD: {}'.format(command_line(argv))))
+        return await self.execute(argv, expect='are being changed')
+
+    async def poll(self, waiting, rounds, timeout, log):
+        # bsub.poll's loop: rounds(waiting), on a worker thread, and then a
+        # sleep that grows the longer the jobs take.  Returns the jobs left
+        # waiting once the timeout is up, else None.
+        loop = asyncio.get_running_loop()
+        (waited, sleep_time) = (0, 1)
+        while True:
+            failed = await loop.run_in_executor(None, rounds, waiting)
+            if failed:
+                raise JobFailed('LSF jobs failed: {}'.format(
+                    ', '.join(job_id for (job_id, status) in failed)
+                ))
+            if not waiting:
+                return None
+
+            logMsg = "Sleeping for: {} secs (waited: {}) [timeout={}] waiting on {} jobs"
+            log.debug(logMsg.format(sleep_time, waited, timeout, len(waiting)))
+            await asyncio.sleep(sleep_time)
+            waited += sleep_time
+            if waited >= timeout:
+                return sorted(waiting)
+            if sleep_time < 180:
+                sleep_time += 0.25
+
+    async def probe(self, path, timeout, settle=30, interval=0.25, max_interval=10):
+        # readiness.probe, sleeping on the loop between looks
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        seen = (None, None)
+        while True:
+            (state, final, seen) = await loop.run_in_executor(self.files, readiness.look, path, seen, settle)
+            if final or loop.time() >= deadline:
+                return (path, state)
+            await asyncio.sleep(min(interval, max(deadline - loop.time(), 0)))
+            interval = min(interval * 2, max_interval)
+
+    async def probe_after(self, handle, path, timeout):
+        # probe a job's output as soon as it is done; (path, 'failed') when
+        # the job failed (which fails the wait on it anyway)
+        status = await handle
+        if status['state'] == 'EXIT':
+            return (path, 'failed')
+        return await self.probe(path, timeout)
+
+def command_line(argv, stdin=None):
+    # argv as it would be typed into a shell, for the log
+    line = ' '.join(quote(a) for a in argv)
+    if stdin is not None:
+        line += ' <<< {}'.format(quote(stdin.rstrip('\n')))
+    return line
+
+# the one loop every job manager in the process shares
+orchestrator = None
+lock = threading.Lock()
+
+def core():
+    global orchestrator
+    with lock:
+        if orchestrator is None:
+            orchestrator = Orchestrator()
+    return orchestrator
@@ -0,0 +1,314 @@
+import os, re, sys, struct, zlib, collections
+from multiprocessing.pool import ThreadPool
+
+# BGZF, the blocked gzip bgzip/htslib write (.vcf.gz, .tbi): a series of
+# gzip members of at most 64kb, each giving its own size in its header, so
+# that a file can be cut on member boundaries and every part inflated on
+# its own.  Places in one are virtual offsets: the compressed offset of a
+# block << 16 | the offset into its uncompressed data.
+
+header_size = 18
+footer_size = 8
+
+# the most data bgzip puts in a block, so that it compresses to under 64kb
+block_data = 0xff00
+
+# a BGZF block header, less its BSIZE (the block's size - 1)
+block_header = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00'
+
+# the empty block every BGZF file ends with
+eof_block = block_header + b'\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+def virtual_offset(coffset, uoffset):
+    return (coffset << 16) | uoffset
+
+def split_offset(voffset):
+    return (voffset >> 16, voffset & 0xffff)
+
+def block_size(header):
+    if len(header) < header_size or header[:4] != block_header[:4] or header[12:14] != b'BC':
+        raise ValueError('Not a BGZF block')
+    return struct.unpack('<H', header[16:18])[0] + 1
+
+def blocks(path, start=0, end=None):
+    # [(offset, size)] of the blocks from the one at `start` to the one at
+    # (or just past) `end`, or the end of the file
+    found = []
+    with open(path, 'rb') as f:
+        offset = start
+        while end is None or offset <= end:
+            f.seek(offset)
+            header = f.read(header_size)
+            if not header:
+                break
+            size = block_size(header)
+            found.append((offset, size))
+            offset += size
+    return found
+
+def inflate(block):
+    return zlib.decompress(block[header_size:-footer_size], -15)
+
+def read_blocks(path, spans):
+    # the uncompressed data of consecutive blocks
+    if not spans:
+        return b''
+    with open(path, 'rb') as f:
+        f.seek(spans[0][0])
+        data = f.read(sum(size for (offset, size) in spans))
+    parts = []
+    at = 0
+    for (offset, size) in spans:
+        parts.append(inflate(data[at:at + size]))
+        at += size
+    return b''.join(parts)
+
+def read_header(path):
+    # (the '#' lines a VCF starts with, the virtual offset of its first record)
+    lines = []
+    with open(path, 'rb') as f:
+        (offset, partial) = (0, b'')
+        while True:
+            f.seek(offset)
+            header = f.read(header_size)
+            if not header:
+                return (b''.join(lines) + partial, None)
+            size = block_size(header)
+            f.seek(offset)
+            data = inflate(f.read(size))
+            # where each line of the block starts, the first one possibly
+            # being the rest of one begun in an earlier block
+            at = 0
+            while at < len(data):
+                end = data.find(b'\n', at)
+                line = partial + data[at:] if end < 0 else partial + data[at:end + 1]
+                if not line.startswith(b'#'):
+                    return (b''.join(lines), virtual_offset(offset, at))
+                if end < 0:
+                    partial = line
+                    break
+                (partial, at) = (b'', end + 1)
+                lines.append(line)
+            offset += size
+
+def deflate(data, level=6):
+    # a BGZF block holding `data` (no more than block_data bytes of it)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) > 0x10000 - header_size - footer_size:
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+    size = len(compressed) + header_size + footer_size
+    return b''.join([
+        block_header, struct.pack('<H', size - 1), compressed,
+        struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)),
+    ])
+
+def reg2bin(beg, end):
+    # the smallest bin of the tabix/BAI binning scheme holding [beg, end)
+    end -= 1
+    for (shift, first) in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return first + (beg >> shift)
+    return 0
+
+info_end = re.compile(br'(?:^|;)END=(\d+)')
+
+class TabixIndexer(object):
+    # builds the .tbi of a VCF from its records as they are written: where
+    # each one starts and ends in the uncompressed stream is kept (by bin,
+    # and by 16kb window for the linear index), and turned into virtual
+    # offsets once it is known where every block ended up
+    def __init__(self):
+        self.names = []
+        self.refs = []
+        self.partial = b''
+        self.last = None
+
+    def scan(self, data, at):
+        # the whole lines of data (which starts at uncompressed offset at)
+        lines = (self.partial + data).split(b'\n')
+        start = at - len(self.partial)
+        self.partial = lines.pop()
+        for line in lines:
+            end = start + len(line) + 1
+            if line and not line.startswith(b'#'):
+                self.add(line, start, end)
+            start = end
+
+    def finish(self, at):
+        # a last line with no newline
+        if self.partial and not self.partial.startswith(b'#'):
+            self.add(self.partial, at - len(self.partial), at)
+        self.partial = b''
+
+    def add(self, line, start, end):
+        fields = line.split(b'\t', 8)
+        (chrom, beg) = (fields[0], int(fields[1]) - 1)
+        stop = beg + max(len(fields[3]), 1)
+        match = info_end.search(fields[7]) if len(fields) > 7 else None
+        if match:
+            stop = max(stop, int(match.group(1)))
+        if not self.names or self.names[-1] != chrom:
+            if chrom in self.names:
+                raise ValueError('The VCF is not sorted: {} comes back after {}'.format(
+                    chrom.decode(), self.names[-1].decode()
+                ))
+            self.names.append(chrom)
+            self.refs.append({ 'bins' : {}, 'ioff' : [], 'first' : start })
+            self.last = None
+        if self.last is not None and beg < self.last:
+            raise ValueError('The VCF is not sorted: {}:{} comes after {}:{}'.format(
+                chrom.decode(), beg + 1, chrom.decode(), self.last + 1
+            ))
+        self.last = beg
+
+        ref = self.refs[-1]
+        chunks = ref['bins'].setdefault(reg2bin(beg, stop), [])
+        if chunks and chunks[-1][1] == start:
+            chunks[-1][1] = end
+        else:
+            chunks.append([start, end])
+        ioff = ref['ioff']
+        for window in range(beg >> 14, ((stop - 1) >> 14) + 1):
+            if window >= len(ioff):
+                ioff.extend([None] * (window + 1 - len(ioff)))
+            if ioff[window] is None:
+                ioff[window] = start
+
+    def save(self, path, voffset):
+        # voffset turns an uncompressed offset into a virtual one
+        names = b''.join(name + b'\x00' for name in self.names)
+        out = [b'TBI\x01', struct.pack('<8i', len(self.names), 2, 1, 2, 0, ord('#'), 0, len(names)), names]
+        for ref in self.refs:
+            out.append(struct.pack('<i', len(ref['bins'])))
+            for (bin, chunks) in sorted(ref['bins'].items()):
+                # chunks ending in the block the next one starts in are one
+                merged = []
+                for (start, end) in chunks:
+                    (start, end) = (voffset(start), voffset(end))
+                    if merged and merged[-1][1] >> 16 == start >> 16:
+                        merged[-1][1] = max(merged[-1][1], end)
+                    else:
+                        merged.append([start, end])
+                out.append(struct.pack('<Ii', bin, len(merged)))
+                out.append(struct.pack('<{}Q'.format(2 * len(merged)), *[o for chunk in merged for o in chunk]))
+            # windows no record starts in point at the previous one's
+            # (or the sequence's first record)
+            ioff = []
+            for start in ref['ioff']:
+                ioff.append(voffset(start) if start is not None else (ioff[-1] if ioff else voffset(ref['first'])))
+            out.append(struct.pack('<i', len(ioff)))
+            out.append(struct.pack('<{}Q'.format(len(ioff)), *ioff))
+        out.append(struct.pack('<Q', 0))
+        with BgzfWriter(path) as index:
+            index.write(b''.join(out))
+
+class BgzfWriter(object):
+    # blocks are compressed on a pool of `threads` (zlib lets go of the GIL
+    # while it works) and written out in order; with index='vcf' the .tbi
+    # gets built along the way and written next to the file on close
+    def __init__(self, path, level=6, threads=1, index=None):
+        self.path = path
+        self.level = level
+        self.handle = getattr(sys.stdout, 'buffer', sys.stdout) if path == '-' else open(path, 'wb')
+        self.buffer = b''
+        self.size = 0
+        self.offset = 0
+        self.offsets = []
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.ahead = 4 * threads
+        self.pending = collections.deque()
+        if index not in (None, 'vcf'):
+            raise ValueError('Can only index VCF, not {}'.format(index))
+        if index is not None and path == '-':
+            raise ValueError('Cannot index what is written to stdout')
+        self.indexer = TabixIndexer() if index else None
+
+    def write(self, data):
+        if self.indexer is not None:
+            self.indexer.scan(data, self.size)
+        self.size += len(data)
+        data = self.buffer + data
+        at = 0
+        while len(data) - at >= block_data:
+            self._block(data[at:at + block_data])
+            at += block_data
+        self.buffer = data[at:]
+
+    def _block(self, data):
+        if self.pool is None:
+            self._emit(deflate(data, self.level))
+            return
+        self.pending.append(self.pool.apply_async(deflate, (data, self.level)))
+        while len(self.pending) > self.ahead:
+            self._emit(self.pending.popleft().get())
+
+    def _emit(self, block):
+        self.offsets.append(self.offset)
+        self.handle.write(block)
+        self.offset += len(block)
+
+    def voffset(self, at):
+        # the virtual offset of the at'th uncompressed byte written
+        (block, within) = divmod(at, block_data)
+        return virtual_offset(self.offsets[block], within)
+
+    def close(self):
+        if self.buffer:
+            self._block(self.buffer)
+            self.buffer = b''
+        while self.pending:
+            self._emit(self.pending.popleft().get())
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        # where the EOF block goes, for offsets just past the last record
+        self.offsets.append(self.offset)
+        self.handle.write(eof_block)
+        if self.path == '-':
+            self.handle.flush()
+        else:
+            self.handle.close()
+        if self.indexer is not None:
+            self.indexer.finish(self.size)
+            self.indexer.save(self.path + '.tbi', self.voffset)
+
+    def abort(self):
+        # a write that went wrong: the file is closed without its EOF block
+        # or index, and removed, so that it is never taken for a whole one
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        self.pending.clear()
+        if self.path == '-':
+            self.handle.flush()
+            return
+        self.handle.close()
+        for path in (self.path, self.path + '.tbi'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+            return
+        try:
+            self.close()
+        except BaseException:
+            self.abort()
+            raise
+
+def compress(infile, outfile, level=6, threads=1, index=False, chunk_size=4 << 20):
+    # bgzip, with the .tbi (when indexing a VCF) built in the same pass
+    source = getattr(sys.stdin, 'buffer', sys.stdin) if infile == '-' else open(infile, 'rb')
+    try:
+        with BgzfWriter(outfile, level, threads, 'vcf' if index else None) as out:
+            for data in iter(lambda: source.read(chunk_size), b''):
+                out.write(data)
+    finally:
+        if infile != '-':
+            source.close()
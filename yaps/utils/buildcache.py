@@ -0,0 +1,162 @@
+import os, json, time, sqlite3, hashlib
+
+from six.moves._thread import get_ident
+
+class BuildCache(object):
+    # Remembers the fingerprint each output was built from -- its command,
+    # stage scripts, inputs and LSF reservation -- so a stage only reruns
+    # the jobs whose fingerprint has changed since their output was made.
+    __create = (
+        'CREATE TABLE IF NOT EXISTS outputs '
+        '( path TEXT PRIMARY KEY, fingerprint TEXT, jobId TEXT, state TEXT, '
+        'size INTEGER, mtime REAL, recorded REAL )'
+    )
+
+    __create_hashes = (
+        'CREATE TABLE IF NOT EXISTS hashes '
+        '( path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha1 TEXT )'
+    )
+
+    __output   = 'SELECT fingerprint, state, size, mtime, jobId FROM outputs WHERE path = ?'
+    __expect   = "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, 'pending', NULL, NULL, ?)"
+    __pending  = "SELECT path FROM outputs WHERE jobId = ? AND state = 'pending'"
+    __rekey    = "UPDATE outputs SET jobId = ? WHERE jobId = ? AND state = 'pending'"
+    __forget   = "DELETE FROM outputs WHERE jobId = ? AND state = 'pending'"
+    __built    = "UPDATE outputs SET state = 'done', size = ?, mtime = ?, recorded = ? WHERE path = ?"
+    __hash     = 'SELECT sha1 FROM hashes WHERE path = ? AND size = ? AND mtime = ?'
+    __hashed   = 'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)'
+
+    def __init__(self, path, logger, content_hashes=False):
+        self.path = os.path.abspath(path)
+        self.log = logger
+        self.content_hashes = content_hashes
+        self._connection_cache = {}
+        self._script_hashes = {}
+        with self._get_db_connection() as c:
+            c.execute(self.__create)
+            c.execute(self.__create_hashes)
+
+    def _get_db_connection(self):
+        id = get_ident()
+        if id not in self._connection_cache:
+            self._connection_cache[id] = sqlite3.Connection(self.path, timeout=60)
+        return self._connection_cache[id]
+
+    def _output(self, path):
+        with self._get_db_connection() as c:
+            row = c.execute(self.__output, (os.path.abspath(path),)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('fingerprint', 'state', 'size', 'mtime', 'job_id'), row))
+
+    def _intact(self, path, output):
+        # a pending output is as good as made; a made one must still be the
+        # file that was recorded when its job finished
+        if output['state'] == 'pending':
+            return True
+        if not os.path.exists(path):
+            return False
+        if output['size'] is None:
+            self._built(path)
+            return True
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime) == (output['size'], output['mtime'])
+
+    def _built(self, path):
+        (size, mtime) = (None, None)
+        if os.path.exists(path):
+            st = os.stat(path)
+            (size, mtime) = (st.st_size, st.st_mtime)
+        with self._get_db_connection() as c:
+            c.execute(self.__built, (size, mtime, time.time(), os.path.abspath(path)))
+
+    def script_hash(self, path):
+        if path not in self._script_hashes:
+            self._script_hashes[path] = sha1sum(path)
+        return self._script_hashes[path]
+
+    def content_hash(self, path):
+        # hashing a VCF takes a while, so only once per size/mtime
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_size, st.st_mtime)
+        with self._get_db_connection() as c:
+            row = c.execute(self.__hash, key).fetchone()
+        if row is not None:
+            return row[0]
+        digest = sha1sum(path)
+        with self._get_db_connection() as c:
+            c.execute(self.__hashed, key + (digest,))
+        return digest
+
+    def identity(self, path):
+        # an output we built is known by its own fingerprint (even before
+        # it exists), anything else by its size/mtime or contents
+        output = self._output(path)
+        if output is not None and self._intact(path, output):
+            return 'built:{}'.format(output['fingerprint'])
+        if not os.path.exists(path):
+            return 'missing:{}'.format(path)
+        if self.content_hashes:
+            return 'sha1:{}'.format(self.content_hash(path))
+        st = os.stat(path)
+        return 'stat:{}:{}'.format(st.st_size, st.st_mtime)
+
+    def fingerprint(self, cmd, scripts, inputs, params):
+        parts = [cmd]
+        parts += [ 'script:{}'.format(self.script_hash(s)) for s in scripts ]
+        parts += [ self.identity(i) for i in inputs ]
+        parts.append(json.dumps(params, sort_keys=True))
+        return hashlib.sha1('\0'.join(parts).encode()).hexdigest()
+
+    def fresh(self, path, fingerprint):
+        output = self._output(path)
+        return (
+            output is not None
+            and output['state'] == 'done'
+            and output['fingerprint'] == fingerprint
+            and self._intact(path, output)
+        )
+
+    def building(self, path):
+        # (fingerprint, job id) of the job still expected to make path, or
+        # None if it has been made (or was never asked for)
+        output = self._output(path)
+        if output is None or output['state'] != 'pending' or output['job_id'] is None:
+            return None
+        return (output['fingerprint'], output['job_id'])
+
+    def expect(self, path, fingerprint, job_id=None):
+        with self._get_db_connection() as c:
+            c.execute(self.__expect, (
+                os.path.abspath(path), fingerprint,
+                None if job_id is None else str(job_id), time.time()
+            ))
+
+    def finished(self, job_id, status):
+        if status.get('retried_as'):
+            # whatever the failed attempt was to build, its retry builds now
+            with self._get_db_connection() as c:
+                c.execute(self.__rekey, (str(status['retried_as']), str(job_id)))
+            return
+        if status['state'] != 'DONE':
+            self.lost([job_id])
+            return
+        with self._get_db_connection() as c:
+            paths = [ row[0] for row in c.execute(self.__pending, (str(job_id),)).fetchall() ]
+        for path in paths:
+            self._built(path)
+
+    def lost(self, job_ids):
+        # what jobs that failed or went missing were making is as good as
+        # never built.  Their ids can be handed out again (a local run
+        # numbers its jobs from 1) to jobs making something else, whose
+        # finishing mustn't pass off a half-written output as made.
+        with self._get_db_connection() as c:
+            c.executemany(self.__forget, [ (str(j),) for j in job_ids ])
+
+def sha1sum(path, blocksize=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,118 @@
+import os, gzip, struct
+
+# tabix linear index windows are 16kb wide
+linear_window = 1 << 14
+
+class TabixIndex(object):
+    def __init__(self, names, refs, fmt):
+        self.names = names
+        self.refs = refs
+        self.format = fmt
+
+    def linear_index(self, name):
+        return self.refs[self.names.index(name)]['ioff']
+
+    def data_end(self, name):
+        # compressed offset just past the last block holding this sequence
+        bins = self.refs[self.names.index(name)]['bins']
+        ends = [end for chunks in bins.values() for (beg, end) in chunks]
+        return max(ends) >> 16 if ends else 0
+
+def read_tabix_index(path):
+    with gzip.open(path, 'rb') as f:
+        data = f.read()
+
+    def unpack(fmt, offset):
+        return (struct.unpack_from(fmt, data, offset), offset + struct.calcsize(fmt))
+
+    if data[:4] != b'TBI\x01':
+        raise ValueError('{} is not a tabix index'.format(path))
+    ((n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm), offset) = unpack('<8i', 4)
+    names = [n.decode() for n in data[offset:offset + l_nm].split(b'\x00') if n]
+    offset += l_nm
+
+    refs = []
+    for i in range(n_ref):
+        ((n_bin,), offset) = unpack('<i', offset)
+        bins = {}
+        for j in range(n_bin):
+            ((bin, n_chunk), offset) = unpack('<Ii', offset)
+            (chunks, offset) = unpack('<{}Q'.format(2 * n_chunk), offset)
+            bins[bin] = list(zip(chunks[0::2], chunks[1::2]))
+        ((n_intv,), offset) = unpack('<i', offset)
+        (ioff, offset) = unpack('<{}Q'.format(n_intv), offset)
+        refs.append({ 'bins' : bins, 'ioff' : list(ioff) })
+
+    return TabixIndex(names, refs, fmt)
+
+def header_contigs(vcf):
+    # {ID : length or None} from the '##contig=<ID=...,length=...>' lines
+    contigs = {}
+    with gzip.open(vcf, 'rb') as f:
+        for line in f:
+            line = line.decode()
+            if not line.startswith('##'):
+                break
+            if not line.startswith('##contig=<'):
+                continue
+            fields = dict(
+                kv.split('=', 1) for kv in line.strip()[10:-1].split(',') if '=' in kv
+            )
+            if 'ID' in fields:
+                contigs[fields['ID']] = int(fields['length']) if 'length' in fields else None
+    return contigs
+
+def contig_length(vcf, chrom):
+    # from the header, if it has one for the contig
+    return header_contigs(vcf).get(chrom)
+
+def split_by_data(index, chrom, shards):
+    # balance the shards on compressed bytes, using the first block offset
+    # of each 16kb window from the linear index
+    ioff = [voffset >> 16 for voffset in index.linear_index(chrom)]
+    begin, end = ioff[0], index.data_end(chrom)
+    boundaries = []
+    window = 0
+    for k in range(1, shards):
+        target = begin + (end - begin) * k // shards
+        while window < len(ioff) and ioff[window] < target:
+            window += 1
+        if window < len(ioff) and window * linear_window not in boundaries:
+            boundaries.append(window * linear_window)
+    return [b for b in boundaries if b > 0]
+
+def split_by_length(length, shards):
+    step = length // shards
+    return [step * k for k in range(1, shards) if step * k > 0]
+
+def shard_intervals(vcf, chrom, shards, sizing='data'):
+    # split a chromosome of a bgzipped, tabix-indexed VCF into (up to)
+    # `shards` 'chrom:start-end' regions, balanced on how much of the file
+    # they cover (sizing='data') or on genomic length (sizing='length')
+    if shards <= 1:
+        return [chrom]
+
+    # without an index there is nothing but the header to size shards on
+    if not os.path.exists(vcf + '.tbi'):
+        length = contig_length(vcf, chrom)
+        if length is None:
+            return [chrom]
+        return regions(chrom, split_by_length(length, shards), length)
+
+    index = read_tabix_index(vcf + '.tbi')
+    if chrom not in index.names:
+        return [chrom]
+
+    # records can start no later than the last linear index window
+    end = len(index.linear_index(chrom)) * linear_window
+    if sizing == 'length':
+        end = contig_length(vcf, chrom) or end
+        boundaries = split_by_length(end, shards)
+    else:
+        boundaries = split_by_data(index, chrom, shards)
+    return regions(chrom, boundaries, end)
+
+def regions(chrom, boundaries, end):
+    starts = [1] + [b + 1 for b in boundaries]
+    ends = boundaries + [end]
+    return ['{}:{}-{}'.format(chrom, s, e) for (s, e) in zip(starts, ends) if s <= e]
@@ -1,74 +1,269 @@
-import os, sqlite3, time
+import os, sqlite3, time, hashlib, threading
 
-# for future threading considerations...punting for now...
-from dummy_thread import get_ident
+from six.moves._thread import get_ident
 
-from yaps.utils.scheduler import bsub
+from yaps.utils.scheduler import bsub, reserved_memory
+import yaps.utils.tracing as tracing
 
 class DrmaaJobQueue(object):
+    # Every job a run submits, with what it is for and how it went.  Rows
+    # outlive the stage that made them, so a run's history (and that of
+    # earlier runs sharing the DB) can be queried while it goes on; the
+    # `waiting` ones are what the next wait() is for.
     __create = (
-        'CREATE TABLE IF NOT EXISTS queue '
-        '( id INTEGER PRIMARY KEY AUTOINCREMENT, jobId INTEGER )'
+        'CREATE TABLE IF NOT EXISTS jobs '
+        '( id INTEGER PRIMARY KEY AUTOINCREMENT, run TEXT, jobId TEXT, jobName TEXT, '
+        'stage TEXT, item TEXT, chrom TEXT, shard INTEGER, cmdHash TEXT, '
+        'queue TEXT, reservedMem REAL, attempt INTEGER, submitted REAL, submitSecs REAL, '
+        'pendTime REAL, started REAL, ended REAL, noticed REAL, state TEXT, '
+        'exitCode INTEGER, exitReason TEXT, maxMem REAL, runTime REAL, execHost TEXT, '
+        'retriedAs TEXT, waiting INTEGER )'
     )
 
-    __count      = 'SELECT COUNT(*) from queue'
-    __iterate    = 'SELECT id, jobId FROM queue ORDER BY jobId'
-    __append     = 'INSERT INTO QUEUE (jobId) VALUES (?)'
-    __write_lock = 'BEGIN IMMEDIATE'
-    __jobs        = 'SELECT jobId FROM queue ORDER BY jobId'
-    __clear      = 'DELETE FROM queue'
-    __vacuum     = 'VACUUM'
+    # when each stage of a run began, had its jobs out, was done waiting on
+    # them and saw their outputs
+    __create_marks = (
+        'CREATE TABLE IF NOT EXISTS marks '
+        '( run TEXT, stage TEXT, event TEXT, at REAL )'
+    )
+
+    __indexes = (
+        'CREATE INDEX IF NOT EXISTS jobs_by_id ON jobs (jobId)',
+        'CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state)',
+        'CREATE INDEX IF NOT EXISTS jobs_by_stage ON jobs (stage, state)',
+        'CREATE INDEX IF NOT EXISTS jobs_waiting ON jobs (waiting)',
+        'CREATE INDEX IF NOT EXISTS jobs_by_run ON jobs (run, stage)',
+    )
 
-    def __init__(self, path, logger):
+    # a job id can come round again (the local runner's start at 1 every
+    # run), so a job is always its latest row
+    __latest     = '(SELECT MAX(id) FROM jobs WHERE jobId = ?)'
+
+    __count      = 'SELECT COUNT(*) FROM jobs WHERE waiting = 1'
+    __jobs       = 'SELECT jobId FROM jobs WHERE waiting = 1 ORDER BY id'
+    __append     = (
+        'INSERT INTO jobs (run, jobId, jobName, stage, item, chrom, shard, cmdHash, '
+        'queue, reservedMem, attempt, submitted, waiting) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, 1)'
+    )
+    __retried    = (
+        'INSERT INTO jobs (run, jobId, jobName, stage, item, chrom, shard, cmdHash, '
+        'queue, reservedMem, attempt, submitted, waiting) '
+        'SELECT ?, ?, jobName, stage, item, chrom, shard, cmdHash, queue, reservedMem, '
+        'COALESCE(attempt, 1) + 1, ?, 0 FROM jobs WHERE id = ' + __latest
+    )
+    __known      = 'SELECT 1 FROM jobs WHERE jobId = ?'
+    __unknown    = 'INSERT INTO jobs (run, jobId, waiting) VALUES (?, ?, 0)'
+    __record     = (
+        'UPDATE jobs SET state = ?, exitCode = ?, exitReason = ?, maxMem = ?, '
+        'runTime = ?, pendTime = ?, execHost = ?, retriedAs = ?, '
+        'attempt = COALESCE(?, attempt), queue = COALESCE(?, queue), '
+        'reservedMem = COALESCE(?, reservedMem), submitSecs = COALESCE(?, submitSecs), '
+        'noticed = ? WHERE id = ' + __latest
+    )
+    # when the job started and ended, from when it was submitted and how
+    # long it pended and ran, else (for want of those) from when the
+    # poller noticed it had finished
+    __times      = (
+        'UPDATE jobs SET '
+        'started = COALESCE(submitted + pendTime, noticed - runTime), '
+        'ended = COALESCE(submitted + pendTime + runTime, noticed) WHERE id = ' + __latest
+    )
+    __clear      = 'UPDATE jobs SET waiting = 0 WHERE waiting = 1'
+    __unfinished = (
+        'SELECT jobId FROM jobs WHERE state IS NULL '
+        'AND id IN (SELECT MAX(id) FROM jobs GROUP BY jobId) ORDER BY id'
+    )
+    __reattach   = 'UPDATE jobs SET waiting = 1, run = ? WHERE id = ' + __latest
+    __lost       = "UPDATE jobs SET state = 'LOST', waiting = 0 WHERE id = " + __latest
+    __status     = 'SELECT state, exitCode, maxMem, runTime FROM jobs WHERE id = ' + __latest
+    __attempts   = (
+        'SELECT jobId, attempt, state, exitCode, exitReason, maxMem, runTime, retriedAs '
+        'FROM jobs WHERE state IS NOT NULL ORDER BY ended'
+    )
+    __records    = 'SELECT * FROM jobs'
+    __mark       = 'INSERT INTO marks VALUES (?, ?, ?, ?)'
+    __marks      = 'SELECT stage, event, at FROM marks WHERE run = ? ORDER BY at'
+    __runs       = 'SELECT DISTINCT run FROM jobs WHERE run IS NOT NULL ORDER BY run'
+
+    def __init__(self, path, logger, poller=bsub.poll, on_finish=None, ready=None, batch=500):
         self.path = os.path.abspath(path)
         self.log = logger
+        self.poller = poller
+        self.on_finish = on_finish
+        self.ready = ready
+        self.batch = batch
+        # the rows this run makes are told apart by when it started
+        self.run = '{:.6f}'.format(time.time())
         self._connection_cache = {}
+        self._appended = []
+        self._append_lock = threading.Lock()
         with self._get_db_connection() as c:
+            # readers (pollers, reports) don't block the writer, or it them
+            c.execute('PRAGMA journal_mode=WAL')
             c.execute(self.__create)
+            c.execute(self.__create_marks)
+            for index in self.__indexes:
+                c.execute(index)
 
     def __len__(self):
-        count = 0
+        self.flush()
         with self._get_db_connection() as c:
-            count = c.execute(self.__count).next()[0]
+            count = c.execute(self.__count).fetchone()[0]
         return count
 
     def __iter__(self):
-        with self._get_db_connection() as c:
-            for id, job_id in c.execute(self.__iterate):
-                yield job_id
+        return iter(self.jobs())
 
     def _get_db_connection(self):
         id = get_ident()
         if id not in self._connection_cache:
-            self._connection_cache[id] = sqlite3.Connection(self.path, timeout=60)
+            connection = sqlite3.Connection(self.path, timeout=60)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection_cache[id] = connection
         return self._connection_cache[id]
 
-    def append(self, job_id):
-        with self._get_db_connection() as c:
-            c.execute(self.__write_lock)
-            c.execute(self.__append, (job_id,))
-            c.commit() # unlock the database
+    def append(self, job_id, job_name=None, cmd=None, job_params=None, stage=None, item=None, chrom=None, shard=None):
+        # buffered, and written out a batch at a time (or before anything
+        # reads the DB)
+        job_params = job_params or {}
+        row = (
+            self.run, str(job_id), job_name, stage, item, chrom, shard,
+            hashlib.sha1(cmd.encode()).hexdigest() if cmd else None,
+            job_params.get('q'), reserved_memory(job_params) or None, time.time(),
+        )
+        with self._append_lock:
+            self._appended.append(row)
+            full = len(self._appended) >= self.batch
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._append_lock:
+            (rows, self._appended) = (self._appended, [])
+        if rows:
+            with self._get_db_connection() as c:
+                c.executemany(self.__append, rows)
 
     def jobs(self):
+        self.flush()
         with self._get_db_connection() as c:
             cursor = c.execute(self.__jobs)
             job_ids = [ row[0] for row in cursor.fetchall() ]
         return job_ids
 
+    def record(self, job_id, status):
+        self.flush()
+        now = time.time()
+        params = status.get('job_params') or {}
+        with self._get_db_connection() as c:
+            if c.execute(self.__known, (str(job_id),)).fetchone() is None:
+                c.execute(self.__unknown, (self.run, str(job_id)))
+            c.execute(self.__record, (
+                status['state'], status['exit_code'], status.get('exit_reason'),
+                status['max_mem'], status.get('run_time'), status.get('pend_time'),
+                status.get('exec_host'), status.get('retried_as'), status.get('attempt'),
+                params.get('q'), reserved_memory(params) or None,
+                status.get('submit_secs'), now, str(job_id),
+            ))
+            c.execute(self.__times, (str(job_id),))
+            # a retried job lives on under its new id, as the same stage/item
+            if status.get('retried_as'):
+                c.execute(self.__retried, (self.run, str(status['retried_as']), now, str(job_id)))
+        if self.on_finish is not None:
+            self.on_finish(job_id, status)
+
+    def status(self, job_id):
+        self.flush()
+        with self._get_db_connection() as c:
+            row = c.execute(self.__status, (str(job_id),)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return dict(zip(('state', 'exit_code', 'max_mem', 'run_time'), row))
+
+    def attempts(self):
+        fields = ('job_id', 'attempt', 'state', 'exit_code', 'exit_reason', 'max_mem', 'run_time', 'retried_as')
+        self.flush()
+        with self._get_db_connection() as c:
+            rows = c.execute(self.__attempts).fetchall()
+        return [ dict(zip(fields, row)) for row in rows ]
+
+    def records(self, stage=None, state=None, run=None):
+        # every row (as a dict keyed by column), optionally just the
+        # stage's, those in the state and/or the run's
+        (clauses, args) = ([], [])
+        if run is not None:
+            clauses.append('run = ?')
+            args.append(run)
+        if stage is not None:
+            clauses.append('stage = ?')
+            args.append(stage)
+        if state is not None:
+            clauses.append('state = ?')
+            args.append(state)
+        sql = self.__records
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        self.flush()
+        with self._get_db_connection() as c:
+            cursor = c.execute(sql + ' ORDER BY id', args)
+            fields = [ d[0] for d in cursor.description ]
+            rows = cursor.fetchall()
+        return [ dict(zip(fields, row)) for row in rows ]
+
+    def unfinished(self):
+        # jobs with nothing recorded about how they went, e.g. those left
+        # in flight when an earlier run died
+        self.flush()
+        with self._get_db_connection() as c:
+            rows = c.execute(self.__unfinished).fetchall()
+        return [ row[0] for row in rows ]
+
+    def reattach(self, job_id):
+        # wait on an earlier run's job as though it had just been appended
+        self.flush()
+        with self._get_db_connection() as c:
+            c.execute(self.__reattach, (self.run, str(job_id)))
+
+    def lost(self, job_ids):
+        with self._get_db_connection() as c:
+            c.executemany(self.__lost, [ (str(j),) for j in job_ids ])
+
+    def mark(self, stage, event):
+        with self._get_db_connection() as c:
+            c.execute(self.__mark, (self.run, stage, event, time.time()))
+
+    def marks(self, run=None):
+        # [(stage, event, time)] in the order they happened
+        with self._get_db_connection() as c:
+            rows = c.execute(self.__marks, (run or self.run,)).fetchall()
+        return rows
+
+    def runs(self):
+        with self._get_db_connection() as c:
+            rows = c.execute(self.__runs).fetchall()
+        return [ row[0] for row in rows ]
+
     def clear(self):
-        self.log.info("Clearing out the LSF job DB")
+        # the jobs stay on record, just no longer waited for
+        self.log.info("Done waiting on the jobs in the LSF job DB")
+        self.flush()
         with self._get_db_connection() as c:
-            c.execute(self.__write_lock)
             c.execute(self.__clear)
-            c.execute(self.__vacuum)
-            c.commit() # unlock the database
 
-    def wait(self, timeout, log):
+    @tracing.traced('DrmaaJobQueue.wait', 'wait', lambda self, timeout, log, stage=None: { 'stage' : stage })
+    def wait(self, timeout, log, stage=None):
         if len(self) > 0:
             ids = [str(j) for j in self.jobs()]
             log.info("See {} lsf jobs to wait for:\n\t{}".format(len(ids), "\n\t".join(ids)))
-            bsub.poll(ids, timeout=timeout, log=log)
+            self.poller(ids, timeout=timeout, log=log, on_finish=self.record)
             self.clear()
-            time.sleep(30) # wait a few seconds for the file system to catch up
+            if stage is not None:
+                self.mark(stage, 'waited')
+            # hold off until the file system shows the jobs' outputs
+            if self.ready is not None:
+                self.ready(log)
+                if stage is not None:
+                    self.mark(stage, 'ready')
         else:
             print("There are no LSF jobs to wait for!")
@@ -0,0 +1,203 @@
+import os, json, time
+
+# Where a run's wall-clock time went, worked out from the job DB: per job
+# the secs bsub took to submit it, it pended in the queue, it ran, and
+# passed before the poller noticed it had finished; per stage those summed
+# up, along with its critical (last noticed) job and the time it spent
+# submitting, waiting and checking its outputs; and per chromosome.
+
+def spread(values):
+    values = [ v for v in values if v is not None ]
+    if not values:
+        return { 'sum' : None, 'mean' : None, 'max' : None }
+    return { 'sum' : sum(values), 'mean' : float(sum(values)) / len(values), 'max' : max(values) }
+
+def job_timings(job):
+    lag = None
+    if job['noticed'] is not None and job['ended'] is not None:
+        lag = max(job['noticed'] - job['ended'], 0)
+    return {
+        'job_id' : job['jobId'],
+        'item' : job['item'],
+        'state' : job['state'],
+        'attempt' : job['attempt'],
+        'submit' : job['submitSecs'],
+        'queue_wait' : job['pendTime'],
+        'compute' : job['runTime'],
+        'detection_lag' : lag,
+        'total' : job['noticed'] - job['submitted'] if job['noticed'] and job['submitted'] else None,
+    }
+
+def stage_marks(marks):
+    # {stage : {event : time}} with the first time each event happened
+    stages = {}
+    for (stage, event, at) in marks:
+        stages.setdefault(stage, {}).setdefault(event, at)
+    return stages
+
+def between(events, start, end):
+    if start in events and end in events:
+        return events[end] - events[start]
+    return None
+
+def summarize(run, jobs, marks):
+    jobs = [ j for j in jobs if j['state'] is not None and j['state'] != 'LOST' ]
+    events = stage_marks(marks)
+    stages = {}
+    for stage in sorted(set(j['stage'] for j in jobs if j['stage']) | set(events)):
+        rows = [ j for j in jobs if j['stage'] == stage ]
+        timings = [ job_timings(j) for j in rows ]
+        submitted = [ j['submitted'] for j in rows if j['submitted'] ]
+        noticed = [ j['noticed'] for j in rows if j['noticed'] ]
+        critical = max(rows, key=lambda j: j['noticed'] or 0) if rows else None
+        stage_events = events.get(stage, {})
+        stages[stage] = {
+            'jobs' : len(rows),
+            'failed' : len([ j for j in rows if j['state'] == 'EXIT' ]),
+            'retries' : len([ j for j in rows if (j['attempt'] or 1) > 1 ]),
+            'wall' : max(noticed) - min(submitted) if submitted and noticed else None,
+            'submit' : spread(t['submit'] for t in timings),
+            'queue_wait' : spread(t['queue_wait'] for t in timings),
+            'compute' : spread(t['compute'] for t in timings),
+            'detection_lag' : spread(t['detection_lag'] for t in timings),
+            'critical_path' : job_timings(critical) if critical else None,
+            'submitting' : between(stage_events, 'began', 'submitted'),
+            'waiting' : between(stage_events, 'submitted', 'waited'),
+            'readiness' : between(stage_events, 'waited', 'ready'),
+        }
+
+    chroms = {}
+    for chrom in sorted(set(j['chrom'] for j in jobs if j['chrom'])):
+        rows = [ j for j in jobs if j['chrom'] == chrom ]
+        submitted = [ j['submitted'] for j in rows if j['submitted'] ]
+        noticed = [ j['noticed'] for j in rows if j['noticed'] ]
+        chroms[chrom] = {
+            'jobs' : len(rows),
+            'wall' : max(noticed) - min(submitted) if submitted and noticed else None,
+            'queue_wait' : spread(j['pendTime'] for j in rows)['sum'],
+            'compute' : spread(j['runTime'] for j in rows)['sum'],
+        }
+
+    submitted = [ j['submitted'] for j in jobs if j['submitted'] ]
+    noticed = [ j['noticed'] for j in jobs if j['noticed'] ]
+    return {
+        'run' : run,
+        'started' : min(submitted) if submitted else None,
+        'wall' : max(noticed) - min(submitted) if submitted and noticed else None,
+        'jobs' : len(jobs),
+        'stages' : stages,
+        'chroms' : chroms,
+    }
+
+def run_summary(queue, run=None):
+    # the latest run's, unless told which
+    if run is None:
+        runs = queue.runs()
+        run = runs[-1] if runs else queue.run
+    return summarize(run, queue.records(run=run), queue.marks(run))
+
+def replace(path, text):
+    # written to the side and moved into place, so that whatever scrapes
+    # it (e.g. node_exporter's textfile collector) never sees half of it
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.rename(tmp, path)
+
+def write_json(summary, path):
+    replace(path, json.dumps(summary, indent=2, sort_keys=True) + '\n')
+
+prometheus_metrics = [
+    # (name, help, summary key, stats)
+    ('yaps_stage_jobs', 'Jobs the stage ran', 'jobs', None),
+    ('yaps_stage_failed_jobs', 'Jobs of the stage that failed', 'failed', None),
+    ('yaps_stage_retried_jobs', 'Retries of the stage\'s jobs', 'retries', None),
+    ('yaps_stage_wall_seconds', 'From the stage\'s first submission to its last job being noticed done', 'wall', None),
+    ('yaps_stage_submit_seconds', 'Time bsub took to submit the stage\'s jobs', 'submit', ('sum', 'mean', 'max')),
+    ('yaps_stage_queue_wait_seconds', 'Time the stage\'s jobs pended', 'queue_wait', ('sum', 'mean', 'max')),
+    ('yaps_stage_compute_seconds', 'Time the stage\'s jobs ran', 'compute', ('sum', 'mean', 'max')),
+    ('yaps_stage_detection_lag_seconds', 'Time from a job finishing to the poller noticing', 'detection_lag', ('sum', 'mean', 'max')),
+    ('yaps_stage_waiting_seconds', 'Time spent waiting on the stage\'s jobs', 'waiting', None),
+    ('yaps_stage_readiness_seconds', 'Time spent checking the stage\'s outputs were visible', 'readiness', None),
+]
+
+def prometheus(summary):
+    lines = []
+    for (name, text, key, stats) in prometheus_metrics:
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} gauge'.format(name))
+        for (stage, values) in sorted(summary['stages'].items()):
+            if stats is None:
+                if values[key] is not None:
+                    lines.append('{}{{stage="{}"}} {}'.format(name, stage, values[key]))
+                continue
+            for stat in stats:
+                if values[key][stat] is not None:
+                    lines.append('{}{{stage="{}",stat="{}"}} {}'.format(name, stage, stat, values[key][stat]))
+    lines.append('# HELP yaps_run_wall_seconds From the run\'s first submission to its last job being noticed done')
+    lines.append('# TYPE yaps_run_wall_seconds gauge')
+    if summary['wall'] is not None:
+        lines.append('yaps_run_wall_seconds {}'.format(summary['wall']))
+    lines.append('# HELP yaps_run_jobs Jobs the run ran')
+    lines.append('# TYPE yaps_run_jobs gauge')
+    lines.append('yaps_run_jobs {}'.format(summary['jobs']))
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus(summary, path):
+    replace(path, prometheus(summary))
+
+def secs(value):
+    if value is None:
+        return '-'
+    if value >= 3600:
+        return '{:.1f}h'.format(value / 3600.0)
+    if value >= 60:
+        return '{:.1f}m'.format(value / 60.0)
+    return '{:.1f}s'.format(value)
+
+def share(part, whole):
+    if not part or not whole:
+        return '-'
+    return '{:.0f}%'.format(100.0 * part / whole)
+
+def report(summary, slowest=5):
+    # the summary as text, one section per question: where did each stage's
+    # time go, what held up its end, and which chromosomes took longest
+    started = summary['started']
+    lines = [
+        'Run {} (started {}): {} jobs in {}'.format(
+            summary['run'],
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)) if started else '-',
+            summary['jobs'], secs(summary['wall'])
+        ),
+        '',
+        '{:<34} {:>5} {:>9} {:>11} {:>9} {:>7} {:>9} {:>9} {:>9}'.format(
+            'stage', 'jobs', 'wall', 'queue-wait', 'compute', 'wait%', 'submit', 'poll-lag', 'readiness'
+        ),
+    ]
+    for (stage, s) in sorted(summary['stages'].items()):
+        waited = s['queue_wait']['sum']
+        computed = s['compute']['sum']
+        lines.append('{:<34} {:>5} {:>9} {:>11} {:>9} {:>7} {:>9} {:>9} {:>9}'.format(
+            stage, s['jobs'], secs(s['wall']), secs(waited), secs(computed),
+            share(waited, (waited or 0) + (computed or 0)),
+            secs(s['submit']['sum']), secs(s['detection_lag']['max']), secs(s['readiness'])
+        ))
+
+    lines += ['', 'Critical path (the job each stage waited on last):']
+    for (stage, s) in sorted(summary['stages'].items()):
+        c = s['critical_path']
+        if c is None:
+            continue
+        lines.append('  {:<32} job {} ({}): submit {}, queued {}, ran {}, noticed {} later; {} in all'.format(
+            stage, c['job_id'], c['item'], secs(c['submit']), secs(c['queue_wait']),
+            secs(c['compute']), secs(c['detection_lag']), secs(c['total'])
+        ))
+
+    chroms = sorted(summary['chroms'].items(), key=lambda kv: kv[1]['wall'] or 0, reverse=True)
+    lines += ['', 'Slowest chromosomes:']
+    for (chrom, c) in chroms[:slowest]:
+        lines.append('  {:<10} {:>9} over {} jobs ({} queued, {} ran)'.format(
+            chrom, secs(c['wall']), c['jobs'], secs(c['queue_wait']), secs(c['compute'])
+        ))
+    return '\n'.join(lines)
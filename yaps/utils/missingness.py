@@ -0,0 +1,282 @@
+import os, sys, gzip, time, collections
+from multiprocessing import Pool
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import yaps.utils.bgzf as bgzf
+from yaps.utils.intervals import read_tabix_index
+
+# The filter-missingness stage, done in-process: the percentage of each
+# site's samples whose genotype (GT) has a missing allele is worked out a
+# block of records at a time with numpy, and a site over the threshold is
+# dropped unless it is in the whitelist (--db).  Every site gets a line in
+# the stats file, whether kept or not.
+#
+# The input is cut into runs of BGZF blocks (from its tabix index, when it
+# has one, just those of the region), which a pool of worker processes
+# inflate and filter side by side; the records straddling two runs are
+# stitched back together and filtered here.
+
+stats_header = b'#CHROM\tPOS\tREF\tALT\tMISSING\tSAMPLES\tPCT_MISSING\tIN_DB\tFILTERED\n'
+
+# what the workers filter against, set up once per worker process
+settings = {}
+
+def parse_region(region):
+    # (chrom, start, end) from 'chrom' or 'chrom:start-end', 1-based
+    if region is None:
+        return (None, None, None)
+    if ':' not in region:
+        return (region, None, None)
+    (chrom, span) = region.rsplit(':', 1)
+    (start, end) = span.replace(',', '').split('-')
+    return (chrom, int(start), int(end))
+
+def site_lines(path, chrom=None):
+    # the records of a bgzipped VCF (just the chrom's, when it has one and
+    # the VCF is tabix-indexed)
+    if chrom is not None and os.path.exists(path + '.tbi'):
+        index = read_tabix_index(path + '.tbi')
+        if chrom not in index.names:
+            return []
+        ioff = [ v for v in index.linear_index(chrom) if v ]
+        (coffset, uoffset) = bgzf.split_offset(min(ioff) if ioff else 0)
+        data = bgzf.read_blocks(path, bgzf.blocks(path, coffset, index.data_end(chrom)))
+        lines = data[uoffset:].split(b'\n')
+    else:
+        with gzip.open(path, 'rb') as f:
+            lines = f.read().split(b'\n')
+    return [ l for l in lines if l and not l.startswith(b'#') ]
+
+def load_whitelist(db, chrom=None):
+    # {(chrom, pos, ref, alt)} of the sites to keep whatever their missingness
+    sites = set()
+    if db is None:
+        return sites
+    for line in site_lines(db, chrom):
+        fields = line.split(b'\t', 5)
+        if chrom is not None and fields[0] != chrom.encode():
+            continue
+        for alt in fields[4].split(b','):
+            sites.add((fields[0], int(fields[1]), fields[3], alt))
+    return sites
+
+def missing_genotypes(text):
+    # (missing, samples) per line of `text` (whole lines, each ending in a
+    # newline): how many samples' GT have a '.' allele, out of how many
+    # samples.  Lines whose FORMAT doesn't lead with GT count no samples.
+    a = np.frombuffer(text, dtype=np.uint8)
+    newline = a == ord('\n')
+    tab = a == ord('\t')
+    sep = newline | tab
+    colon = a == ord(':')
+
+    # the line and field (counted across all of text) each byte is in
+    line = np.cumsum(newline, dtype=np.int32) - newline
+    field = np.cumsum(sep, dtype=np.int32) - sep
+    starts = np.concatenate(([0], np.flatnonzero(sep)[:-1] + 1))
+    line_starts = np.concatenate(([0], np.flatnonzero(newline)[:-1] + 1))
+    lines = len(line_starts)
+
+    # which column of its line each field is, and whether a byte comes
+    # before the first ':' of its field (i.e. is in the GT subfield)
+    column = field[starts] - field[line_starts][line[starts]]
+    colons = np.cumsum(colon, dtype=np.int32) - colon
+    in_gt = colons == colons[starts][field]
+
+    formats = starts[column == 8]
+    (second, third) = (np.minimum(formats + 1, len(a) - 1), np.minimum(formats + 2, len(a) - 1))
+    has_gt = (a[formats] == ord('G')) & (a[second] == ord('T')) & (colon[third] | sep[third])
+    gt_lines = np.zeros(lines, dtype=bool)
+    gt_lines[line[formats[has_gt]]] = True
+
+    missing_bytes = (a == ord('.')) & in_gt & (column[field] >= 9)
+    missing_fields = np.unique(field[missing_bytes])
+    missing = np.bincount(line[starts[missing_fields]], minlength=lines)
+    samples = np.bincount(line[np.flatnonzero(tab)], minlength=lines) - 8
+    samples = np.where(gt_lines, np.maximum(samples, 0), 0)
+    return (np.where(gt_lines, missing, 0), samples)
+
+def filter_text(text, region=None):
+    # (kept lines, stats lines, [sites, dropped, rescued]) for whole lines
+    if not text:
+        return (b'', b'', [0, 0, 0])
+    (chrom, start, end) = region or (None, None, None)
+    (missing, samples) = missing_genotypes(text)
+    (threshold, whitelist) = (settings['threshold'], settings['whitelist'])
+    kept = []
+    stats = []
+    counts = [0, 0, 0]
+    for (i, line) in enumerate(text[:-1].split(b'\n')):
+        fields = line.split(b'\t', 5)
+        if chrom is not None and fields[0] != chrom:
+            continue
+        pos = int(fields[1])
+        if (start is not None and pos < start) or (end is not None and pos > end):
+            continue
+        pct = 100.0 * missing[i] / samples[i] if samples[i] else 0.0
+        in_db = any((fields[0], pos, fields[3], alt) in whitelist for alt in fields[4].split(b','))
+        dropped = pct > threshold and not in_db
+        counts[0] += 1
+        counts[1] += dropped
+        counts[2] += pct > threshold and in_db
+        if not dropped:
+            kept.append(line)
+        stats.append(b'\t'.join([
+            fields[0], fields[1], fields[3], fields[4], str(missing[i]).encode(),
+            str(samples[i]).encode(), '{:.4f}'.format(pct).encode(),
+            b'1' if in_db else b'0', b'1' if dropped else b'0',
+        ]))
+    return (
+        b''.join(l + b'\n' for l in kept), b''.join(l + b'\n' for l in stats), counts
+    )
+
+def filter_chunk(task):
+    # filters the whole lines of a chunk (runs of blocks, or text read from
+    # a pipe), handing back the partial ones at either end as they are
+    (path, spans, skip, text, region) = task
+    if path is not None:
+        text = bgzf.read_blocks(path, spans)[skip:]
+    first = text.find(b'\n')
+    if first < 0:
+        return (None, (b'', b'', [0, 0, 0]), text)
+    last = text.rfind(b'\n')
+    return (text[:first + 1], filter_text(text[first + 1:last + 1], region), text[last + 1:])
+
+def ordered(pool, func, tasks, ahead):
+    # pool.imap, but with no more than `ahead` tasks out at a time, so that
+    # neither what is read nor what is filtered piles up in memory
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def setup(threshold, whitelist):
+    settings['threshold'] = threshold
+    settings['whitelist'] = whitelist
+
+def bgzf_chunks(path, region, blocks_per_chunk):
+    # (header, tasks): the VCF's header, and its records (or just those
+    # that can be in region, going by its tabix index) as runs of blocks
+    (header, first) = bgzf.read_header(path)
+    if first is None:
+        return (header, [])
+    (coffset, skip) = bgzf.split_offset(first)
+    (chrom, start, end) = region
+    last = None
+    if chrom is not None and os.path.exists(path + '.tbi'):
+        (index, name) = (read_tabix_index(path + '.tbi'), chrom.decode())
+        if name not in index.names:
+            return (header, [])
+        ioff = index.linear_index(name)
+        window = ((start or 1) - 1) >> 14
+        voffsets = [ v for v in ioff[min(window, len(ioff) - 1):] if v ] or [ v for v in ioff if v ]
+        if voffsets and voffsets[0] > first:
+            (coffset, skip) = bgzf.split_offset(voffsets[0])
+        last = index.data_end(name)
+    spans = bgzf.blocks(path, coffset, last)
+    tasks = []
+    for i in range(0, len(spans), blocks_per_chunk):
+        tasks.append((path, spans[i:i + blocks_per_chunk], skip if i == 0 else 0, None, region))
+    return (header, tasks)
+
+def pipe_chunks(stream, region, chunk_size):
+    # (header, tasks) for plain VCF read from a pipe, in chunks of text
+    header = []
+    for line in iter(stream.readline, b''):
+        if not line.startswith(b'#'):
+            first = line
+            break
+        header.append(line)
+    else:
+        return (b''.join(header), [])
+
+    def tasks():
+        text = first
+        while text:
+            yield (None, None, 0, text, region)
+            text = stream.read(chunk_size)
+    return (b''.join(header), tasks())
+
+def annotate_header(header, threshold, db):
+    # a record of the filtering, just ahead of the #CHROM line
+    note = '##yaps_filter_missingness=<threshold={},db={}>\n'.format(threshold, db or '.').encode()
+    at = header.rfind(b'#CHROM')
+    if at < 0:
+        return header + note
+    return header[:at] + note + header[at:]
+
+def run(invcf, outvcf, stats, db=None, threshold=2.0, region=None, workers=1, blocks_per_chunk=64, log=sys.stderr):
+    # filters invcf (a bgzipped VCF, or '-' for plain VCF on stdin) into
+    # outvcf (bgzipped and indexed, or '-' for plain VCF on stdout), with
+    # the per-site stats gzipped to stats + '.gz'
+    if np is None:
+        raise ImportError('The built-in missingness filter needs numpy')
+    begin = time.time()
+    region = parse_region(region)
+    whitelist = load_whitelist(db, region[0])
+    region = (region[0].encode() if region[0] else None, region[1], region[2])
+
+    if invcf == '-':
+        (header, tasks) = pipe_chunks(getattr(sys.stdin, 'buffer', sys.stdin), region, blocks_per_chunk * bgzf.block_data)
+    else:
+        (header, tasks) = bgzf_chunks(invcf, region, blocks_per_chunk)
+
+    # the output is compressed (and indexed) as it goes, on as many threads
+    # as there are workers
+    out = getattr(sys.stdout, 'buffer', sys.stdout) if outvcf == '-' else bgzf.BgzfWriter(outvcf, threads=workers, index='vcf')
+    summary = gzip.open(stats + '.gz', 'wb')
+    out.write(annotate_header(header, threshold, db))
+    summary.write(stats_header)
+
+    setup(threshold, whitelist)
+    pool = Pool(workers, setup, (threshold, whitelist)) if workers > 1 else None
+    results = ordered(pool, filter_chunk, tasks, 2 * workers) if pool else map(filter_chunk, tasks)
+    counts = [0, 0, 0]
+    carry = b''
+    try:
+        for (head, (kept, rows, tally), tail) in results:
+            # a chunk's first partial line finishes the last one's
+            if head is None:
+                carry += tail
+                continue
+            (k, r, t) = filter_text(carry + head, region)
+            for (text, lines, n) in ((k, r, t), (kept, rows, tally)):
+                out.write(text)
+                summary.write(lines)
+                counts = [ c + m for (c, m) in zip(counts, n) ]
+            carry = tail
+        if carry:
+            (k, r, t) = filter_text(carry.rstrip(b'\n') + b'\n', region)
+            out.write(k)
+            summary.write(r)
+            counts = [ c + m for (c, m) in zip(counts, t) ]
+    except BaseException:
+        # nothing half-written is left to be taken for the filter's output
+        summary.close()
+        os.remove(stats + '.gz')
+        if outvcf != '-':
+            out.abort()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    # only finished off (with its EOF block and index) once all of it is
+    # there, so that a failed filter never looks like a finished one
+    summary.close()
+    if outvcf != '-':
+        out.close()
+    else:
+        out.flush()
+
+    log.write('filter-missingness: {} sites, {} dropped over {}% missing, {} kept as in {} ({:.1f} secs, {} workers)\n'.format(
+        counts[0], counts[1], threshold, counts[2], db, time.time() - begin, workers
+    ))
+    return counts
@@ -0,0 +1,70 @@
+import os
+
+class SubmissionPlan(object):
+    # Longest-processing-time-first ordering of a stage's jobs.  A job is
+    # predicted to take as long as it did on its recent runs when the
+    # resource history has any, else its input's size times the stage's
+    # secs per byte (the median over the jobs with both); with no history
+    # at all for the stage, the input sizes alone rank the jobs.  The
+    # biggest get submitted -- and, through LSF's user priority (-sp),
+    # dispatched -- first, so that a stage isn't kept waiting on a chr1
+    # that happened to start last.
+    def __init__(self, history, max_priority=100):
+        self.history = history
+        self.max_priority = max_priority
+        self.costs = {}
+        self.basis = {}
+
+    def recent_runtime(self, step, item):
+        runtimes = [ secs for (mem, secs) in self.history.usage(step, item) if secs is not None ]
+        if not runtimes:
+            return None
+        return sum(runtimes) / float(len(runtimes))
+
+    def estimate(self, step, sizes):
+        # sizes is {item : bytes of input}; returns {item : cost}
+        runtimes = {}
+        for item in sizes:
+            secs = self.recent_runtime(step, item)
+            if secs is not None:
+                runtimes[item] = secs
+        rates = sorted(runtimes[item] / sizes[item] for item in runtimes if sizes[item])
+        rate = rates[len(rates) // 2] if rates else None
+
+        costs = {}
+        for (item, size) in sizes.items():
+            if item in runtimes:
+                costs[item] = runtimes[item]
+            elif rate is not None:
+                costs[item] = size * rate
+            elif runtimes:
+                costs[item] = sum(runtimes.values()) / len(runtimes)
+            else:
+                costs[item] = float(size)
+        self.costs[step] = costs
+        self.basis[step] = 'runtime history' if runtimes else 'input size'
+        return costs
+
+    def cost(self, step, item):
+        return self.costs.get(step, {}).get(item)
+
+    def order(self, step, items):
+        # largest first; anything without a cost goes last, in the order given
+        costs = self.costs.get(step, {})
+        return sorted(items, key=lambda item: -costs.get(item, -1))
+
+    def priority(self, step, item):
+        # 1 to max_priority, in proportion to the stage's largest job
+        costs = self.costs.get(step, {})
+        if item not in costs or not costs:
+            return None
+        top = max(costs.values())
+        if top <= 0:
+            return self.max_priority
+        return max(1, int(round(self.max_priority * costs[item] / top)))
+
+def input_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
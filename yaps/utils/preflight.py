@@ -0,0 +1,110 @@
+import os, re, importlib
+from multiprocessing.pool import ThreadPool
+
+try:
+    from shutil import which #py3
+except ImportError:
+    from distutils.spawn import find_executable as which #py2
+
+from yaps.utils.intervals import read_tabix_index, header_contigs
+from yaps.utils.readiness import is_bgzf, bgzf_complete
+
+# Each check returns a list of the problems it found (empty when all is well)
+
+def check_vcf(chrom, vcf):
+    if not os.path.exists(vcf):
+        return ['{}: no such file'.format(vcf)]
+    if not is_bgzf(vcf):
+        return ['{}: not bgzip-compressed'.format(vcf)]
+    if not bgzf_complete(vcf):
+        return ['{}: truncated (no BGZF EOF block)'.format(vcf)]
+
+    index = vcf + '.tbi'
+    if not os.path.exists(index):
+        problems = ['{}: no tabix index'.format(vcf)]
+        contigs = header_contigs(vcf)
+        if contigs and chrom not in contigs:
+            problems.append('{}: chrom {} is not among its header contigs'.format(vcf, chrom))
+        return problems
+    if os.path.getmtime(index) < os.path.getmtime(vcf):
+        return ['{}: tabix index is older than the VCF'.format(vcf)]
+    try:
+        names = read_tabix_index(index).names
+    except (ValueError, IOError, EOFError) as e:
+        return ['{}: unreadable tabix index ({})'.format(index, e)]
+    if chrom not in names:
+        return ['{}: chrom {} is not in its tabix index ({})'.format(vcf, chrom, ', '.join(names[:5]))]
+    return []
+
+def check_file(path, what='file'):
+    if not os.path.exists(path):
+        return ['{} not found: {}'.format(what, path)]
+    return []
+
+def check_executable(cmd):
+    if os.path.isabs(cmd):
+        if not os.path.isfile(cmd) or not os.access(cmd, os.X_OK):
+            return ['executable not found: {}'.format(cmd)]
+        return []
+    if which(cmd) is None:
+        return ['executable not on the PATH: {}'.format(cmd)]
+    return []
+
+def check_module(name):
+    # for the stages yaps runs itself, with the python it runs under
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        return ['python module not installed: {}'.format(name)]
+    return []
+
+def check_reference(fasta):
+    # GATK also wants the .fai and the sequence dictionary alongside it
+    problems = check_file(fasta, 'reference')
+    if problems:
+        return problems
+    problems += check_file(fasta + '.fai', 'reference index')
+    problems += check_file(re.sub(r'\.(fa|fasta)$', '', fasta) + '.dict', 'reference dictionary')
+    return problems
+
+def script_paths(script):
+    # the absolute paths a stage script assigns to its variables, e.g.
+    # TABIX=/gsc/bin/tabix or VT=${BIO_1662}/vendor/local/bin/vt-0.5
+    values = {}
+    paths = []
+    assignment = re.compile(r'^([A-Za-z_][A-Za-z0-9_]*)=(\S+)\s*$')
+    reference = re.compile(r'\$\{?([A-Za-z_][A-Za-z0-9_]*)\}?')
+    with open(script) as f:
+        for line in f:
+            match = assignment.match(line)
+            if not match:
+                continue
+            (name, value) = match.groups()
+            value = reference.sub(lambda m: values.get(m.group(1), m.group(0)), value)
+            if '$' in value or '"' in value or "'" in value:
+                continue
+            values[name] = value
+            if os.path.isabs(value):
+                paths.append(value)
+    return paths
+
+def check_script(script):
+    problems = check_file(script, 'stage script')
+    if problems:
+        return problems
+    for path in script_paths(script):
+        problems += check_file(path, 'path in {}'.format(os.path.basename(script)))
+    return problems
+
+def run_checks(checks, workers=32):
+    # checks are (function, args) pairs, run side by side as they are
+    # mostly waiting on the file system
+    if not checks:
+        return []
+    pool = ThreadPool(min(workers, len(checks)))
+    try:
+        results = pool.map(lambda check: check[0](*check[1]), checks)
+    finally:
+        pool.close()
+        pool.join()
+    return [ problem for problems in results for problem in problems ]
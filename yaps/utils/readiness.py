@@ -0,0 +1,84 @@
+import os, time
+from multiprocessing.pool import ThreadPool
+
+# the empty block bgzip/htslib end every BGZF file (.vcf.gz, .tbi) with
+bgzf_eof = (
+    b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00'
+    b'\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+)
+
+class OutputNotReady(Exception):
+    pass
+
+def is_bgzf(path):
+    # a gzip member with the 'BC' extra subfield
+    with open(path, 'rb') as f:
+        header = f.read(14)
+    return (
+        len(header) == 14 and header[:2] == b'\x1f\x8b'
+        and bytearray(header)[3] & 4 and header[12:14] == b'BC'
+    )
+
+def bgzf_complete(path):
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < len(bgzf_eof):
+            return False
+        f.seek(-len(bgzf_eof), os.SEEK_END)
+        return f.read() == bgzf_eof
+
+def look(path, seen, settle):
+    # one look at the path: (state, final, seen), where final says another
+    # look won't change the state.  seen is the (size, since) of a BGZF file
+    # missing its EOF block, which only counts as truncated for good once
+    # its size has held for `settle` secs.
+    if os.path.exists(path):
+        if not is_bgzf(path) or bgzf_complete(path):
+            return ('ready', True, seen)
+        size = os.path.getsize(path)
+        if size != seen[0]:
+            return ('truncated', False, (size, time.time()))
+        return ('truncated', time.time() - seen[1] >= settle, seen)
+    # listing the directory makes an NFS client revalidate it
+    if os.path.isdir(os.path.dirname(path)):
+        os.listdir(os.path.dirname(path))
+    return ('missing', False, seen)
+
+def probe(path, timeout, settle=30, interval=0.25, max_interval=10):
+    # (path, 'ready' | 'missing' | 'truncated'), once the file is there and
+    # (for BGZF) ends in its EOF block, or the timeout is up.  A file written
+    # on another host can take a while to show up (or grow to its full size)
+    # here under NFS attribute caching.
+    deadline = time.time() + timeout
+    seen = (None, None)
+    while True:
+        (state, final, seen) = look(path, seen, settle)
+        if final or time.time() >= deadline:
+            return (path, state)
+        time.sleep(min(interval, max(deadline - time.time(), 0)))
+        interval = min(interval * 2, max_interval)
+
+def wait_for_outputs(paths, log, timeout=600, workers=16, probes={}):
+    # probe all the paths at once; raises OutputNotReady naming whatever is
+    # still missing or truncated after `timeout` secs.  probes holds the
+    # probes already under way (anything with a result() of (path, state)),
+    # by path, whose outcome is taken rather than probing again.
+    paths = sorted(set(paths))
+    if not paths:
+        return
+    start = time.time()
+    pool = ThreadPool(min(workers, len(paths)))
+    try:
+        results = pool.map(lambda path: probes[path].result() if path in probes else probe(path, timeout), paths)
+    finally:
+        pool.close()
+        pool.join()
+
+    bad = [ (path, state) for (path, state) in results if state != 'ready' ]
+    if bad:
+        for (path, state) in bad:
+            log.error('Output {}: {}'.format(state, path))
+        raise OutputNotReady('{} of {} outputs not ready after {} secs: {}'.format(
+            len(bad), len(paths), timeout, ', '.join(path for (path, state) in bad)
+        ))
+    log.info('All {} outputs ready after {:.1f} secs'.format(len(paths), time.time() - start))
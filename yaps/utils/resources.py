@@ -0,0 +1,127 @@
+import os, math, time, sqlite3
+
+from six.moves._thread import get_ident
+
+from yaps.utils.scheduler import reserved_memory, reserve_memory
+
+class ResourceHistory(object):
+    # What each stage's jobs actually used, kept across runs, so that later
+    # runs can reserve about that much (plus a safety margin) rather than
+    # the stage config's one-size-fits-all figure.
+    __create = (
+        'CREATE TABLE IF NOT EXISTS usage '
+        '( stage TEXT, item TEXT, maxMem REAL, runTime REAL, '
+        'reservedMem REAL, recorded REAL )'
+    )
+
+    __index  = 'CREATE INDEX IF NOT EXISTS usage_by_item ON usage (stage, item)'
+    __record = 'INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?)'
+    __usage  = (
+        'SELECT maxMem, runTime FROM usage WHERE stage = ? AND item = ? '
+        'ORDER BY recorded DESC LIMIT ?'
+    )
+    __runtimes = (
+        'SELECT runTime FROM usage WHERE stage = ? AND runTime IS NOT NULL '
+        'ORDER BY recorded DESC LIMIT ?'
+    )
+
+    def __init__(self, path, logger, margin=0.25, min_memory=500, queues=[], recent=5):
+        self.path = os.path.abspath(path)
+        self.log = logger
+        self.margin = margin
+        self.min_memory = min_memory
+        self.queues = queues
+        self.recent = recent
+        self.jobs = {}
+        self.sized = []
+        self._connection_cache = {}
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with self._get_db_connection() as c:
+            c.execute(self.__create)
+            c.execute(self.__index)
+
+    def _get_db_connection(self):
+        id = get_ident()
+        if id not in self._connection_cache:
+            self._connection_cache[id] = sqlite3.Connection(self.path, timeout=60)
+        return self._connection_cache[id]
+
+    def usage(self, stage, item):
+        with self._get_db_connection() as c:
+            rows = c.execute(self.__usage, (stage, item, self.recent)).fetchall()
+        return rows
+
+    def runtimes(self, stage, limit=100):
+        # how long the stage's jobs have recently taken, whatever their item
+        with self._get_db_connection() as c:
+            rows = c.execute(self.__runtimes, (stage, limit)).fetchall()
+        return [ row[0] for row in rows ]
+
+    def predict(self, stage, item):
+        # (MB, secs) from the most any of the recent runs used, or None
+        # when there is no (complete) history for the job yet
+        rows = [ (mem, secs) for (mem, secs) in self.usage(stage, item) if mem is not None ]
+        if not rows:
+            return None
+        memory = max(mem for (mem, secs) in rows) * (1 + self.margin)
+        memory = max(int(math.ceil(memory / 100.0)) * 100, self.min_memory)
+        runtimes = [ secs for (mem, secs) in rows if secs is not None ]
+        runtime = max(runtimes) * (1 + self.margin) if runtimes else None
+        return (memory, runtime)
+
+    def size(self, job_params, keys):
+        # a job array gets what its hungriest element needs; anything
+        # without a history keeps the reservation it was configured with
+        predictions = [ self.predict(stage, item) for (stage, item) in keys ]
+        if not predictions or None in predictions:
+            return job_params
+
+        memory = max(mem for (mem, secs) in predictions)
+        params = reserve_memory(job_params, memory)
+
+        runtimes = [ secs for (mem, secs) in predictions ]
+        if self.queues and None not in runtimes:
+            for (queue, limit) in self.queues:
+                if limit is None or max(runtimes) <= limit:
+                    params['q'] = queue
+                    break
+
+        self.sized.append((keys[0][0], len(keys), reserved_memory(job_params), memory))
+        return params
+
+    def track(self, job_id, stage, item, job_params):
+        self.jobs[str(job_id)] = (stage, item, reserved_memory(job_params))
+
+    def finished(self, job_id, status):
+        if str(job_id) in self.jobs and status.get('retried_as'):
+            # the retry gets recorded under the same stage/item
+            self.jobs[str(status['retried_as'])] = self.jobs.pop(str(job_id))
+            return
+        if str(job_id) not in self.jobs or status['state'] != 'DONE':
+            return
+        (stage, item, reserved) = self.jobs.pop(str(job_id))
+        with self._get_db_connection() as c:
+            c.execute(self.__record, (
+                stage, item, status['max_mem'], status['run_time'], reserved, time.time()
+            ))
+
+    def report(self):
+        # per stage: jobs sized, MB they were configured to reserve, MB
+        # they reserved instead
+        stages = {}
+        for (stage, jobs, configured, sized) in self.sized:
+            totals = stages.setdefault(stage, [0, 0, 0])
+            totals[0] += jobs
+            totals[1] += configured * jobs
+            totals[2] += sized * jobs
+        for stage in sorted(stages):
+            (jobs, configured, sized) = stages[stage]
+            msg = 'Right-sized {} {} jobs: reserved {} MB instead of {} MB ({} MB reclaimed)'
+            self.log.info(msg.format(jobs, stage, sized, configured, configured - sized))
+        configured = sum(totals[1] for totals in stages.values())
+        sized = sum(totals[2] for totals in stages.values())
+        if configured:
+            msg = 'Right-sizing reclaimed {} MB of {} MB reserved in total ({:.0f}%)'
+            self.log.info(msg.format(configured - sized, configured, 100.0 * (configured - sized) / configured))
+        return stages
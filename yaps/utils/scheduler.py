@@ -1,4 +1,5 @@
-import os, sys, pwd, six, time, logging
+import os, re, sys, pwd, six, json, math, time, shlex, atexit, logging, threading, itertools
+import multiprocessing
 import subprocess as sp
 
 try:
@@ -9,9 +10,24 @@ except ImportError:
 from clint.textui import colored
 
 import yaps.utils.logger as logger
+import yaps.utils.tracing as tracing
 
 user_id = pwd.getpwuid( os.getuid() ).pw_name
 
+# a job LSF no longer knows about is reported as NOTFOUND
+finished_states = ('DONE', 'EXIT', 'NOTFOUND')
+
+# what a traced call's span gets labelled with
+def naming(self, cmd, job_name, *args, **kwargs):
+    return { 'job_name' : job_name }
+
+def counting(self, job_ids, *args, **kwargs):
+    return { 'jobs' : 1 if isinstance(job_ids, six.string_types) else len(job_ids) }
+
+def commanding(cls, command, *args, **kwargs):
+    # which LSF command it was; a submission is piped into bsub
+    return { 'command' : 'bsub' if '| bsub' in command else command.split()[0] }
+
 default_lsf_params = {
     'q' : "short",
     'u' : "{}@genome.wustl.edu".format(user_id),
@@ -19,17 +35,1281 @@ default_lsf_params = {
     'M' : "8000000",
 }
 
-class BatchJobManager(object):
-    def __init__(self, logwriter):
+class RetryPolicy(object):
+    # How many times a failed job is tried in all, and how its reservation
+    # grows when it was killed for going over its memory limit
+    def __init__(self, attempts=1, memory_factor=2.0, max_memory=None, memory_queue=None):
+        self.attempts = attempts
+        self.memory_factor = memory_factor
+        self.max_memory = max_memory
+        self.memory_queue = memory_queue
+
+    @classmethod
+    def from_config(cls, settings):
+        return cls(
+            attempts=settings.get('attempts', 1),
+            memory_factor=settings.get('memory-factor', 2.0),
+            max_memory=settings.get('max-memory'),
+            memory_queue=settings.get('memory-queue'),
+        )
+
+    def retries(self):
+        return self.attempts > 1
+
+    def memory_killed(self, status, job_params):
+        if status.get('exit_reason'):
+            return status['exit_reason'] == 'TERM_MEMLIMIT'
+        # backends that don't say why a job died: it ran up to its reservation
+        reserved = reserved_memory(job_params)
+        return bool(reserved and status.get('max_mem') and status['max_mem'] >= reserved)
+
+    def next_params(self, job_params, status, attempt):
+        # what to resubmit the job with after its attempt-th try failed, or
+        # None when it is out of attempts (or memory to escalate to)
+        if attempt >= self.attempts:
+            return None
+        reserved = reserved_memory(job_params)
+        if not reserved or not self.memory_killed(status, job_params):
+            return dict(job_params)
+        if self.max_memory is not None and reserved >= self.max_memory:
+            return None
+        memory = int(math.ceil(reserved * self.memory_factor))
+        if self.max_memory is not None:
+            memory = min(memory, self.max_memory)
+        params = reserve_memory(job_params, memory)
+        if self.memory_queue:
+            params['q'] = self.memory_queue
+        return params
+
+# LSF took these jobs down on purpose; trying them again won't help
+not_retried = ('TERM_OWNER', 'TERM_ORPHAN_SYSTEM')
+
+class JobRetries(object):
+    # Resubmits failed jobs per the RetryPolicy they were submitted with and
+    # points whatever was waiting on them at the new attempt.  Managers keep
+    # `submitted` and `retried` dicts and provide _resubmit(cmd, job_name,
+    # job_params), _rewire(job_id, depends_on) and _kill(job_ids).
+    def track(self, job_id, cmd, job_name, job_params, depends_on, retry, attempt=1, cohort=None, submit_secs=None):
+        if isinstance(depends_on, (six.string_types, six.integer_types)):
+            depends_on = [depends_on]
+        if submit_secs is None:
+            # a retry is tracked again once resubmitted; keep its timing
+            submit_secs = self.submitted.get(str(job_id), {}).get('submit_secs')
+        self.submitted[str(job_id)] = {
+            'cmd' : cmd,
+            'name' : job_name,
+            'params' : job_params,
+            'depends_on' : [str(j) for j in (depends_on or [])],
+            'retry' : retry,
+            'attempt' : attempt,
+            'cohort' : cohort,
+            'submit_secs' : submit_secs,
+        }
+
+    def current(self, job_id):
+        # the latest attempt at a job
+        job_id = str(job_id)
+        while job_id in self.retried:
+            job_id = self.retried[job_id]
+        return job_id
+
+    def retryable(self, depends_on):
+        if isinstance(depends_on, (six.string_types, six.integer_types)):
+            depends_on = [depends_on]
+        jobs = [self.submitted.get(str(j)) for j in depends_on or []]
+        return any(job and job['retry'] and job['retry'].retries() for job in jobs)
+
+    def dependents(self, job_id):
+        # every job waiting on this one, directly or further down the line
+        found = []
+        frontier = [str(job_id)]
+        while frontier:
+            parent = frontier.pop()
+            for (child, job) in self.submitted.items():
+                if parent in job['depends_on'] and child not in found and child not in self.retried:
+                    found.append(child)
+                    frontier.append(child)
+        return found
+
+    def attempt(self, job_id):
+        job = self.submitted.get(str(job_id))
+        return job['attempt'] if job else 1
+
+    def handed_out_as(self, job_id):
+        # the id the job's submitter was given for it
+        return str(job_id)
+
+    def retry(self, job_id, status):
+        # the id of the job's next attempt, or None if it isn't getting one
+        job = self.submitted.get(str(job_id))
+        if job is None or job['retry'] is None or status.get('exit_reason') in not_retried:
+            return None
+        params = job['retry'].next_params(job['params'], status, job['attempt'])
+        if params is None:
+            if job['retry'].retries():
+                self.abandon(job_id)
+            return None
+
+        new_id = str(self._resubmit(job['cmd'], job['name'], params))
+        self.track(
+            new_id, job['cmd'], job['name'], params, job['depends_on'],
+            job['retry'], job['attempt'] + 1, job['cohort']
+        )
+        if reserved_memory(params) != reserved_memory(job['params']):
+            msg = 'Retrying job {} as {} (attempt {} of {}) with {} MB in queue {}'
+            self.log.warning(colored.yellow(msg.format(
+                job_id, new_id, job['attempt'] + 1, job['retry'].attempts,
+                reserved_memory(params), params.get('q')
+            )))
+        else:
+            msg = 'Retrying job {} as {} (attempt {} of {})'
+            self.log.warning(colored.yellow(msg.format(
+                job_id, new_id, job['attempt'] + 1, job['retry'].attempts
+            )))
+        self.supersede(str(job_id), new_id)
+        return new_id
+
+    def supersede(self, job_id, new_id):
+        # whatever waits on job_id waits on new_id instead
+        self.retried[job_id] = new_id
+        for (child, dependent) in list(self.submitted.items()):
+            if job_id in dependent['depends_on'] and child not in self.retried:
+                dependent['depends_on'] = [
+                    new_id if j == job_id else j for j in dependent['depends_on']
+                ]
+                self._rewire(child, dependent['depends_on'])
+
+    def abandon(self, job_id):
+        # its dependents were submitted to wait out retries rather than die
+        # with it, so they'd otherwise sit pending forever
+        doomed = self.dependents(job_id)
+        if doomed:
+            msg = 'Job {} is out of attempts; killing the {} jobs waiting on it'
+            self.log.error(colored.red(msg.format(job_id, len(doomed))))
+            for child in doomed:
+                self.submitted[child]['retry'] = None
+            self._kill(doomed)
+
+    def adopt(self, job_id, cmd, job_name, job_params, depends_on, retry, cohort=None):
+        # take over a job an earlier run submitted, as if this one had
+        self.track(job_id, cmd, job_name, job_params, depends_on, retry, cohort=cohort)
+
+    def kill(self, job_ids):
+        self._kill([str(j) for j in job_ids])
+
+    def noting_attempts(self, on_finish):
+        if on_finish is None:
+            return None
+        def finish(job_id, status):
+            # along with what the attempt reserved, as a retry may differ --
+            # and under the ticket a held job was handed out as, which is
+            # what the caller recorded it by
+            job = self.submitted.get(str(job_id)) or {}
+            on_finish(self.handed_out_as(job_id), dict(
+                status, attempt=self.attempt(job_id), job_params=job.get('params'),
+                submit_secs=job.get('submit_secs'),
+            ))
+        return finish
+
+class SpeculationPolicy(object):
+    # When a running job counts as a straggler: it has run `slowdown` times
+    # longer than the `quantile` runtime of the jobs in its cohort (a stage),
+    # and at least `min_runtime` secs.  Runtimes come from the jobs of the
+    # cohort that finished this run, on top of any seeded from history.
+    def __init__(self, quantile=0.5, slowdown=2.0, min_runtime=600, min_samples=3):
+        self.quantile = quantile
+        self.slowdown = slowdown
+        self.min_runtime = min_runtime
+        self.min_samples = min_samples
+        self.runtimes = {}
+
+    @classmethod
+    def from_config(cls, settings):
+        return cls(
+            quantile=settings.get('quantile', 0.5),
+            slowdown=settings.get('slowdown', 2.0),
+            min_runtime=settings.get('min-runtime', 600),
+            min_samples=settings.get('min-samples', 3),
+        )
+
+    def seed(self, cohort, runtimes):
+        self.runtimes.setdefault(cohort, []).extend(runtimes)
+
+    def observe(self, cohort, runtime):
+        if runtime is not None:
+            self.runtimes.setdefault(cohort, []).append(runtime)
+
+    def threshold(self, cohort):
+        runtimes = sorted(self.runtimes.get(cohort, []))
+        if len(runtimes) < self.min_samples:
+            return None
+        typical = runtimes[min(int(self.quantile * len(runtimes)), len(runtimes) - 1)]
+        return max(typical * self.slowdown, self.min_runtime)
+
+class JobSpeculation(object):
+    # Launches a copy of a straggling job on some other host, keeps whichever
+    # of the two finishes first and kills the other.  The job's commands
+    # must tolerate two copies racing each other.  Builds on JobRetries: a
+    # copy that wins stands in for the original the way a retry would.
+    def speculate(self, records):
+        # ids of the copies launched for jobs running past their threshold
+        launched = []
+        for (job_id, rs) in records.items():
+            job = self.submitted.get(job_id)
+            if job is None or job['cohort'] is None or job_id in self.copies or job_id in self.copy_of:
+                continue
+            if len(rs) != 1 or rs[0]['STAT'] != 'RUN':
+                continue
+            threshold = self.speculation.threshold(job['cohort'])
+            runtime = lsf_int(rs[0].get('RUN_TIME'))
+            if threshold is None or runtime is None or runtime <= threshold:
+                continue
+            hosts = exec_hosts(rs[0].get('EXEC_HOST'))
+            params = avoid_hosts(job['params'], hosts) if hosts else dict(job['params'])
+            copy_id = str(self._resubmit(job['cmd'], job['name'], params))
+            self.track(
+                copy_id, job['cmd'], job['name'], params, job['depends_on'],
+                job['retry'], job['attempt'] + 1, job['cohort']
+            )
+            self.copies[job_id] = copy_id
+            self.copy_of[copy_id] = job_id
+            self._keep_dependents(job_id)
+            msg = 'Job {} has run {} secs (threshold {:.0f}) on {}; launched copy {} elsewhere'
+            self.log.warning(colored.yellow(msg.format(
+                job_id, runtime, threshold, ', '.join(hosts) or 'an unknown host', copy_id
+            )))
+            launched.append(copy_id)
+        return launched
+
+    def _keep_dependents(self, job_id):
+        # the original failing no longer dooms what waits on it (see -ti)
+        for (child, job) in self.submitted.items():
+            if job_id in job['depends_on'] and child not in self.retried:
+                try:
+                    self._modify(child, tin=None)
+                except BSubException as e:
+                    self.log.warning('Could not keep job {} from being orphaned: {}'.format(child, e))
+
+    def settle(self, finished, waiting):
+        # sort out the jobs (job id, status) that just finished: a copy the
+        # original beat is forgotten, an original its copy beat (or that
+        # failed while its copy runs on) is reported as retried as the copy
+        reports = []
+        for (job_id, status) in finished:
+            if job_id in self.copy_of:
+                original = self.copy_of.pop(job_id)
+                if self.copies.pop(original, None) is None or status['state'] != 'DONE':
+                    self.log.info('Dropping speculative copy {} of job {} [{}]'.format(job_id, original, status['state']))
+                    continue
+                self.log.info(colored.green('Speculative copy {} beat job {}'.format(job_id, original)))
+                self.supersede(original, job_id)
+                waiting.discard(original)
+                self._kill([original])
+                reports.append((original, {
+                    'state' : 'EXIT', 'exit_code' : None, 'exit_reason' : 'TERM_OWNER',
+                    'max_mem' : None, 'run_time' : None, 'retried_as' : job_id,
+                }))
+            elif job_id in self.copies:
+                copy_id = self.copies.pop(job_id)
+                if status['state'] == 'DONE':
+                    self.copy_of.pop(copy_id, None)
+                    waiting.discard(copy_id)
+                    self._kill([copy_id])
+                else:
+                    # the copy carries on as the job's next attempt
+                    self.copy_of.pop(copy_id, None)
+                    self.supersede(job_id, copy_id)
+                    status = dict(status, retried_as=copy_id)
+            if status['state'] == 'DONE' and self.submitted.get(job_id, {}).get('cohort'):
+                self.speculation.observe(self.submitted[job_id]['cohort'], status['run_time'])
+            reports.append((job_id, status))
+        return reports
+
+class BatchJobManager(JobRetries, JobSpeculation):
+    def __init__(self, logwriter, max_pending=None, max_running=None, max_memory=None, speculation=None):
         self.log = logwriter
+        self.admission = None
+        self.speculation = speculation
+        self.submitted = {}
+        self.retried = {}
+        self.copies = {}
+        self.copy_of = {}
+        if any(cap is not None for cap in (max_pending, max_running, max_memory)):
+            self.admission = AdmissionController(
+                self.log, max_pending, max_running, max_memory
+            )
+
+    def poll(self, job_ids, timeout=43200, log=None, on_finish=None):
+        return bsub.poll(
+            job_ids, timeout=timeout, log=log or self.log,
+            admission=self.admission, on_finish=self.noting_attempts(on_finish),
+            retry=self.retry, speculation=self if self.speculation else None,
+            records=self.job_records
+        )
+
+    def poll_round(self, waiting, log, on_finish=None, retry=None):
+        # one look at the jobs in `waiting` (see bsub.poll_round)
+        return bsub.poll_round(
+            waiting, log, self.admission, on_finish, retry,
+            self if self.speculation else None, records=self.job_records
+        )
+
+    def job_records(self, job_ids):
+        return bsub.job_records(job_ids)
+
+    def handed_out_as(self, job_id):
+        # a held job's ticket, once it has gone out as job_id
+        if self.admission is None:
+            return str(job_id)
+        return self.admission.ticket(job_id) or str(job_id)
+
+    @tracing.traced('submit_job', 'submit', naming)
+    def submit_job(self, cmd, job_name, job_params=default_lsf_params, depends_on=None, retry=None, cohort=None, share=None):
+        if self.admission is None:
+            return self._submit_job(cmd, job_name, job_params, depends_on, retry, cohort)
+        submit = lambda deps: self._submit_job(cmd, job_name, job_params, deps, retry, cohort)
+        return self.admission.submit(submit, job_params, depends_on=depends_on, share=share)
 
-    def submit_job(self, cmd, job_name, job_params=default_lsf_params):
-        submit = bsub(job_name, log=self.log, **job_params)
-        jobid = submit(cmd).job_id
+    @tracing.traced('submit_array', 'submit', naming)
+    def submit_array(self, cmds, job_name, script, job_params=default_lsf_params, share=None):
+        if self.admission is None:
+            return [self._submit_array(cmds, job_name, script, job_params)]
+        submit = lambda deps: self._submit_array(cmds, job_name, script, job_params)
+        return [self.admission.submit(submit, job_params, elements=len(cmds), share=share)]
+
+    def _submit_job(self, cmd, job_name, job_params, depends_on, retry=None, cohort=None):
+        params = job_params
+        if depends_on is not None:
+            if isinstance(depends_on, (six.string_types, six.integer_types)):
+                depends_on = [depends_on]
+            depends_on = [self.current(j) for j in depends_on]
+            params = dependency_params(job_params, depends_on, orphans=not self.retryable(depends_on))
+        start = time.time()
+        jobid = self._bsub(cmd, job_name, params)
         msg = colored.green('Generated LSF job ID: {}'.format(jobid))
         self.log.info(msg)
+        self.track(jobid, cmd, job_name, job_params, depends_on, retry, cohort=cohort, submit_secs=time.time() - start)
+        return jobid
+
+    def _submit_array(self, cmds, job_name, script, job_params):
+        write_array_script(script, cmds)
+        array_name = '{}[1-{}]'.format(job_name, len(cmds))
+        jobid = self._bsub('bash {}'.format(script), array_name, job_params)
+        msg = 'Generated LSF job array ID: {} ({} elements)'
+        self.log.info(colored.green(msg.format(jobid, len(cmds))))
+        return jobid
+
+    def _bsub(self, cmd, job_name, job_params):
+        # the new job's id
+        return bsub(job_name, log=self.log, **job_params)(cmd).job_id
+
+    def _resubmit(self, cmd, job_name, job_params):
+        jobid = self._submit_job(cmd, job_name, job_params, None)
+        if self.admission is not None:
+            self.admission.admit(jobid, job_params)
+        return jobid
+
+    def _modify(self, job_id, **kwargs):
+        return bsub.bmod(job_id, log=self.log, **kwargs)
+
+    def _rewire(self, job_id, depends_on):
+        try:
+            self._modify(job_id, w='"{}"'.format(dependency_condition(depends_on)))
+        except BSubException as e:
+            self.log.warning('Could not point job {} at its retried dependencies: {}'.format(job_id, e))
+
+    def adopt(self, job_id, cmd, job_name, job_params, depends_on, retry, cohort=None):
+        JobRetries.adopt(self, job_id, cmd, job_name, job_params, depends_on, retry, cohort)
+        if self.admission is not None:
+            self.admission.admit(job_id, job_params)
+
+    def reattach(self, job_ids):
+        # ([still queued or running], {finished : status}) among the jobs
+        # an earlier run submitted; bjobs has forgotten about the rest
+        live = []
+        finished = {}
+        for (job_id, records) in self.job_records(job_ids).items():
+            states = [r['STAT'] for r in records]
+            if 'NOTFOUND' in states:
+                continue
+            if all(state in finished_states for state in states):
+                finished[job_id] = bsub.job_status(records)
+            else:
+                live.append(job_id)
+        return (live, finished)
+
+    def _bkill(self, job_ids):
+        bsub.bkill(*job_ids, log=self.log)
+
+    def _kill(self, job_ids):
+        try:
+            self._bkill(job_ids)
+        except BSubException as e:
+            self.log.warning('Could not kill all of jobs {}: {}'.format(', '.join(job_ids), e))
+
+class AsyncBatchJobManager(BatchJobManager):
+    # BatchJobManager on the asyncio core of yaps.utils.aio, with the same
+    # synchronous API: LSF's commands run without a shell (the independent
+    # ones side by side), the poller sleeps on the core's event loop, and
+    # handle(job_id) is an awaitable of a job's final status.  Outputs can
+    # be probed as soon as their job is done (check_outputs), while the
+    # poller goes on waiting for the rest.
+    def __init__(self, logwriter, max_pending=None, max_running=None, max_memory=None, speculation=None):
+        BatchJobManager.__init__(self, logwriter, max_pending, max_running, max_memory, speculation)
+        from yaps.utils import aio
+        self.aio = aio
+        self.core = aio.core()
+        # the handles waiting on each job (or held ticket), and the final
+        # status of those that have finished
+        self.handles = {}
+        self.outcomes = {}
+        self.handles_lock = threading.Lock()
+
+    @tracing.traced('bsub.poll', 'poll', counting)
+    def poll(self, job_ids, timeout=43200, log=None, on_finish=None):
+        log = log or self.log
+        log.info('Entering LSF wait poller')
+
+        if isinstance(job_ids, six.string_types):
+            job_ids = [job_ids]
+
+        if len(job_ids) == 0:
+            return
+
+        waiting = set(str(j) for j in job_ids)
+        log.info("Waiting on {} LSF jobs".format(len(waiting)))
+        finish = self.noting_attempts(on_finish)
+        rounds = lambda waiting: self.poll_round(waiting, log, finish, self.retry)
+        leftover = self.core.run(self.core.poll(waiting, rounds, timeout, log))
+        if leftover:
+            bsub.killpoll(timeout, timeout, leftover)
+
+        log.info('Exiting LSF wait poller')
+        return True
+
+    def job_records(self, job_ids):
+        return self.core.run(self.core.job_records(job_ids))
+
+    def _bsub(self, cmd, job_name, job_params):
+        return self.core.run(self.core.submit(cmd, job_name, job_params, self.log))
+
+    def _modify(self, job_id, **kwargs):
+        return self.core.run(self.core.modify(job_id, self.log, **kwargs))
+
+    def _bkill(self, job_ids):
+        self.core.run(self.core.kill(job_ids, self.log))
+
+    def handle(self, job_id):
+        job_id = str(job_id)
+        with self.handles_lock:
+            handle = self.aio.JobHandle(job_id)
+            if job_id in self.outcomes:
+                handle.resolve(self.outcomes[job_id])
+            else:
+                self.handles.setdefault(job_id, []).append(handle)
+        return handle
+
+    def check_outputs(self, job_id, paths, timeout):
+        # {path : a concurrent.futures.Future of its (path, state)}, each
+        # probed once the job is done
+        handle = self.handle(job_id)
+        return dict(
+            (path, self.core.spawn(self.core.probe_after(handle, path, timeout)))
+            for path in paths
+        )
+
+    def noting_attempts(self, on_finish):
+        noted = BatchJobManager.noting_attempts(self, on_finish)
+        def finish(job_id, status):
+            self._resolve(job_id, status)
+            if noted is not None:
+                noted(job_id, status)
+        return finish
+
+    def _resolve(self, job_id, status):
+        # a finished job's handles (and those of the ticket it was held as)
+        # get its status, or move on to the job standing in for it
+        keys = set([str(job_id), self.handed_out_as(job_id)])
+        with self.handles_lock:
+            for key in keys:
+                handles = self.handles.pop(key, [])
+                if status.get('retried_as'):
+                    self.handles.setdefault(str(status['retried_as']), []).extend(handles)
+                    continue
+                self.outcomes[key] = status
+                for handle in handles:
+                    handle.resolve(status)
+
+class AdmissionController(object):
+    # Caps how much of each LSF queue a run may occupy at once.  Submissions
+    # over a cap are held in-process (in submission order) and go out as the
+    # poller sees earlier jobs finish -- it never calls bjobs on its own.
+    # When several runs share the caps (the cohorts of a `yaps batch`, each
+    # submitting as its own `share`), their held jobs go out in turns, one
+    # from each share at a time.
+    running = ('RUN', 'USUSP', 'SSUSP')
+
+    def __init__(self, logwriter, max_pending=None, max_running=None, max_memory=None):
+        self.log = logwriter
+        self.max_pending = max_pending
+        self.max_running = max_running
+        self.max_memory = max_memory
+        self.held = []
+        self.inflight = {}
+        self.released = {}
+        self.held_as = {}
+        self.tickets = itertools.count(1)
+
+    def submit(self, submit, job_params, elements=1, depends_on=None, share=None):
+        if isinstance(depends_on, (six.string_types, six.integer_types)):
+            depends_on = [depends_on]
+        ticket = 'held-{}'.format(next(self.tickets))
+        self.held.append({
+            'ticket' : ticket,
+            'share' : share,
+            'queue' : job_params.get('q'),
+            'elements' : elements,
+            'memory' : reserved_memory(job_params),
+            'depends_on' : [str(j) for j in (depends_on or [])],
+            'submit' : submit,
+        })
+        self._release()
+        if ticket in self.released:
+            # it went straight out, and is known by its job id after all
+            del self.held_as[self.released[ticket]]
+        else:
+            msg = 'Holding back {} ({} queue is at its admission limit)'
+            self.log.info(colored.yellow(msg.format(ticket, job_params.get('q'))))
+        return self.released.get(ticket, ticket)
+
+    def holds(self, job_id):
+        return job_id in set(job['ticket'] for job in self.held)
+
+    def ticket(self, job_id):
+        # the ticket a released job was held as, if it was
+        return self.held_as.get(str(job_id))
+
+    def withdraw(self, job_id):
+        # a held job that is no longer wanted never goes out
+        self.held = [job for job in self.held if job['ticket'] != job_id]
+
+    def observe(self, job_ids, states, release=True):
+        # states maps a job id to the STAT of each of its bjobs rows
+        for (job_id, job) in list(self.inflight.items()):
+            if job_id not in states:
+                continue
+            active = [s for s in states[job_id] if s not in finished_states]
+            if not active:
+                del self.inflight[job_id]
+                continue
+            job['remaining'] = len(active)
+            job['running'] = len([s for s in active if s in self.running])
+        if release:
+            self._release()
+        return frozenset(self.released.get(j, j) for j in job_ids)
+
+    def _fits(self, queue, elements, memory):
+        jobs = [j for j in self.inflight.values() if j['queue'] == queue]
+        if not jobs:
+            # always let something through, so one oversized request
+            # can't wedge the whole run
+            return True
+        pending = sum(j['remaining'] - j['running'] for j in jobs)
+        inflight = sum(j['remaining'] for j in jobs)
+        reserved = sum(j['remaining'] * j['memory'] for j in jobs)
+        return (
+            (self.max_pending is None or pending + elements <= self.max_pending) and
+            (self.max_running is None or inflight + elements <= self.max_running) and
+            (self.max_memory is None or reserved + elements * memory <= self.max_memory)
+        )
+
+    def _turns(self):
+        # the held jobs in the order they get to go: each share's first,
+        # then each share's second, and so on
+        ranks = {}
+        order = []
+        for (i, job) in enumerate(self.held):
+            rank = ranks.get(job['share'], 0)
+            ranks[job['share']] = rank + 1
+            order.append((rank, i, job))
+        return [ job for (rank, i, job) in sorted(order, key=lambda o: o[:2]) ]
+
+    def _release(self):
+        blocked = set()
+        tickets = set(job['ticket'] for job in self.held)
+        for job in self._turns():
+            queue = job['queue']
+            deps = [self.released.get(j, j) for j in job['depends_on']]
+            if queue in blocked or (queue, job['share']) in blocked:
+                continue
+            if tickets.intersection(deps):
+                # keep the share's later submissions to this queue behind
+                # this one, which waits on a job that is itself held
+                blocked.add((queue, job['share']))
+                continue
+            if not self._fits(queue, job['elements'], job['memory']):
+                # and everyone's, when the queue is full
+                blocked.add(queue)
+                continue
+            job_id = str(job['submit'](deps or None))
+            self.held.remove(job)
+            tickets.discard(job['ticket'])
+            self.released[job['ticket']] = job_id
+            self.held_as[job_id] = job['ticket']
+            self._admit(job_id, queue, job['memory'], job['elements'])
+
+    def admit(self, job_id, job_params, elements=1):
+        # count a job submitted around the caps (e.g. a retry) against them
+        self._admit(str(job_id), job_params.get('q'), reserved_memory(job_params), elements)
+
+    def _admit(self, job_id, queue, memory, elements):
+        self.inflight[job_id] = {
+            'queue' : queue,
+            'memory' : memory,
+            'remaining' : elements,
+            'running' : 0,
+        }
+
+def reserved_memory(job_params):
+    # MB reserved per job: the rusage request, else -M (in KB)
+    match = re.search(r'rusage\[[^\]]*\bmem=(\d+)', str(job_params.get('R') or ''))
+    if match:
+        return int(match.group(1))
+    return int(job_params.get('M') or 0) // 1000
+
+def reserve_memory(job_params, memory):
+    # the same job reserving `memory` MB instead: -M (in KB) along with any
+    # rusage/select memory in its resource requirement
+    params = dict(job_params)
+    params['M'] = memory * 1000
+    if params.get('R'):
+        params['R'] = re.sub(r'(rusage\[[^\]]*\bmem=)\d+', r'\g<1>{}'.format(memory), params['R'])
+        params['R'] = re.sub(r'(select\[[^\]]*\bmem>)\d+', r'\g<1>{}'.format(memory), params['R'])
+    return params
+
+class DrmaaJobManager(JobRetries):
+    # LSF flags with a native DRMAA job template attribute
+    template_params = ('J',)
+
+    def __init__(self, logwriter, drmaa_module=None):
+        self.log = logwriter
+        if drmaa_module is None:
+            import drmaa as drmaa_module
+        self.drmaa = drmaa_module
+        self.session = drmaa_module.Session()
+        self.session.initialize()
+        self.job_info = {}
+        self.reaped = {}
+        self.submitted = {}
+        self.retried = {}
+        atexit.register(self.session.exit)
+
+    def _template(self, job_name, job_params, depends_on):
+        if depends_on is not None:
+            job_params = dependency_params(job_params, depends_on, orphans=not self.retryable(depends_on))
+        native = dict(
+            (k, v) for (k, v) in job_params.items()
+            if k not in self.template_params
+        )
+        jt = self.session.createJobTemplate()
+        jt.jobName = job_name
+        jt.remoteCommand = '/bin/bash'
+        jt.nativeSpecification = bsub._kwargs_to_flag_string(native).strip()
+        return jt
+
+    @tracing.traced('submit_job', 'submit', naming)
+    def submit_job(self, cmd, job_name, job_params=default_lsf_params, depends_on=None, retry=None, cohort=None, share=None):
+        if isinstance(depends_on, (six.string_types, six.integer_types)):
+            depends_on = [depends_on]
+        if depends_on is not None:
+            depends_on = [self.current(j) for j in depends_on]
+        jt = self._template(job_name, job_params, depends_on)
+        jt.args = ['-c', cmd]
+        start = time.time()
+        jobid = self.session.runJob(jt)
+        submit_secs = time.time() - start
+        self.session.deleteJobTemplate(jt)
+        msg = colored.green('Generated DRMAA job ID: {}'.format(jobid))
+        self.log.info(msg)
+        self.track(jobid, cmd, job_name, job_params, depends_on, retry, submit_secs=submit_secs)
+        return jobid
+
+    def _resubmit(self, cmd, job_name, job_params):
+        return self.submit_job(cmd, job_name, job_params)
+
+    def _rewire(self, job_id, depends_on):
+        # DRMAA can't change a queued job's dependencies, but under LSF its
+        # job ids are LSF job ids
+        try:
+            bsub.bmod(job_id, log=self.log, w='"{}"'.format(dependency_condition(depends_on)))
+        except BSubException as e:
+            self.log.warning('Could not point job {} at its retried dependencies: {}'.format(job_id, e))
+
+    def _kill(self, job_ids):
+        for job_id in job_ids:
+            try:
+                self.session.control(job_id, self.drmaa.JobControlAction.TERMINATE)
+            except Exception as e:
+                self.log.warning('Could not kill job {}: {}'.format(job_id, e))
+
+    def reattach(self, job_ids):
+        # a DRMAA session can only wait on its own jobs, so an earlier run's
+        # are killed rather than left to race their resubmissions (under
+        # LSF, as with _rewire, its job ids are LSF job ids)
+        try:
+            bsub.bkill(*job_ids, log=self.log)
+        except (BSubException, OSError) as e:
+            self.log.warning('Could not kill the jobs an earlier run left: {}'.format(e))
+        return ([], {})
+
+    @tracing.traced('submit_array', 'submit', naming)
+    def submit_array(self, cmds, job_name, script, job_params=default_lsf_params, share=None):
+        write_array_script(script, cmds)
+        jt = self._template(job_name, job_params, None)
+        jt.args = [script, self.drmaa.JobTemplate.PARAMETRIC_INDEX]
+        jobids = self.session.runBulkJobs(jt, 1, len(cmds), 1)
+        self.session.deleteJobTemplate(jt)
+        msg = 'Generated DRMAA bulk job IDs: {} ({} elements)'
+        self.log.info(colored.green(msg.format(', '.join(jobids), len(cmds))))
+        return list(jobids)
+
+    @tracing.traced('poll', 'poll', counting)
+    def poll(self, job_ids, timeout=43200, log=None, on_finish=None):
+        if log is None: log = self.log
+        on_finish = self.noting_attempts(on_finish)
+
+        if isinstance(job_ids, six.string_types):
+            job_ids = [job_ids]
+        job_ids = [str(j) for j in job_ids]
+
+        log.info('Entering DRMAA wait on {} jobs'.format(len(job_ids)))
+        # collect jobs as they finish rather than synchronizing on all of
+        # them, as whatever waits on a failed job does so until its retry.
+        # The session hands back whichever of its jobs finishes next, which
+        # may be one a later wait is for; it is kept until then.
+        waiting = list(job_ids)
+        failed = []
+        deadline = time.time() + timeout
+        while waiting:
+            found = [j for j in waiting if j in self.reaped]
+            if found:
+                job_id = found[0]
+                info = self.reaped.pop(job_id)
+            else:
+                try:
+                    info = self.session.wait(
+                        self.drmaa.Session.JOB_IDS_SESSION_ANY,
+                        int(max(deadline - time.time(), 0))
+                    )
+                except self.drmaa.errors.ExitTimeoutException:
+                    msg = ('There are DRMAA jobs running past the timeout: {}. '
+                           'Please investigate!')
+                    sys.exit(msg.format(timeout))
+                job_id = str(info.jobId)
+                if job_id not in waiting:
+                    self.reaped[job_id] = info
+                    continue
+            waiting.remove(job_id)
+            self.job_info[job_id] = info
+            usage = info.resourceUsage
+            status = {
+                'state' : 'DONE' if info.hasExited and info.exitStatus == 0 else 'EXIT',
+                'exit_code' : info.exitStatus if info.hasExited else None,
+                'exit_reason' : None,
+                'max_mem' : drmaa_usage(usage, ('maxvmem', 'max_mem', 'mem')),
+                'run_time' : drmaa_usage(usage, ('ru_wallclock', 'wallclock', 'run_time')),
+                'pend_time' : drmaa_pend_time(usage),
+            }
+            if status['state'] == 'EXIT':
+                status['retried_as'] = self.retry(job_id, status)
+            if on_finish is not None:
+                on_finish(job_id, status)
+            summary = ', '.join('{}={}'.format(k, v) for (k, v) in sorted(usage.items()))
+            if status['state'] == 'DONE':
+                log.info("DRMAA job {} finished [{}]".format(job_id, summary))
+                continue
+            if status['retried_as']:
+                msg = "DRMAA job {} ended (exit status: {}, aborted: {}, signal: {}); {} stands in for it"
+                log.warning(colored.yellow(msg.format(
+                    job_id, info.exitStatus, info.wasAborted, info.terminatedSignal, status['retried_as']
+                )))
+                waiting.append(status['retried_as'])
+                continue
+            msg = "DRMAA job {} failed (exit status: {}, aborted: {}, signal: {})"
+            log.error(colored.red(msg.format(
+                job_id, info.exitStatus, info.wasAborted, info.terminatedSignal
+            )))
+            failed.append(job_id)
+
+        log.info('Exiting DRMAA wait')
+        if failed:
+            raise JobFailed('DRMAA jobs failed: {}'.format(', '.join(failed)))
+        return True
+
+def drmaa_usage(usage, keys):
+    # resource usage names differ from one DRM to the next
+    for key in keys:
+        if key in usage:
+            try:
+                return float(usage[key])
+            except ValueError:
+                pass
+    return None
+
+def drmaa_pend_time(usage):
+    # secs between the job's submission and its start, when the DRM says
+    submitted = drmaa_usage(usage, ('submission_time', 'submit_time'))
+    started = drmaa_usage(usage, ('start_time',))
+    if submitted is None or started is None:
+        return None
+    return max(started - submitted, 0)
+
+class LocalJob(object):
+    def __init__(self, job_id, cmd, job_name, cores, memory, depends_on, logs, env):
+        self.job_id = job_id
+        self.cmd = cmd
+        self.job_name = job_name
+        self.cores = cores
+        self.memory = memory
+        self.depends_on = depends_on
+        self.logs = logs
+        self.env = env
+        self.state = 'PEND'
+        self.returncode = None
+        self.submit_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        self.max_mem = None
+
+class LocalExecutor(JobRetries):
+    def __init__(self, logwriter, cores=None, memory=None):
+        self.log = logwriter
+        self.cores = cores or multiprocessing.cpu_count()
+        self.memory = memory or host_memory()
+        self.free_cores = self.cores
+        self.free_memory = self.memory
+        self.jobs = {}
+        self.submitted = {}
+        self.retried = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Condition()
+        msg = 'Local executor running jobs on {} cores / {} MB of memory'
+        self.log.info(msg.format(self.cores, self.memory))
+
+    def _slots(self, job_params):
+        # honor the LSF reservation, but never ask for more than the host has
+        cores = int(job_params.get('n') or 1)
+        memory = reserved_memory(job_params)
+        return (min(cores, self.cores), min(memory, self.memory))
+
+    def _logs(self, job_params, job_id, index=None):
+        logs = {}
+        for flag in ('oo', 'eo'):
+            if job_params.get(flag):
+                path = job_params[flag].replace('%J', str(job_id))
+                logs[flag] = path.replace('%I', str(index or 0))
+        return logs
+
+    def _submit(self, cmd, job_name, job_params, depends_on, index=None):
+        if isinstance(depends_on, (six.string_types, six.integer_types)):
+            depends_on = [depends_on]
+        (cores, memory) = self._slots(job_params)
+        job_id = str(next(self.ids))
+        env = dict(os.environ, LSB_JOBID=job_id)
+        if index is not None:
+            env['LSB_JOBINDEX'] = str(index)
+        job = LocalJob(
+            job_id, cmd, job_name, cores, memory,
+            [str(j) for j in (depends_on or [])],
+            self._logs(job_params, job_id, index),
+            env
+        )
+        with self.lock:
+            self.jobs[job_id] = job
+        worker = threading.Thread(target=self._run, args=(job,))
+        worker.daemon = True
+        worker.start()
+        return job_id
+
+    def _run(self, job):
+        with self.lock:
+            # mimic 'bsub -w "done(...)" -ti': wait on the predecessors, and
+            # give up straight away if any of them did not succeed.  A retry
+            # rewires job.depends_on, so look them up afresh each time.
+            deps = lambda: [self.jobs[j] for j in job.depends_on if j in self.jobs]
+            while any(d.state in ('PEND', 'RUN') for d in deps()):
+                self.lock.wait()
+            if any(d.state != 'DONE' for d in deps()):
+                self._finish(job, 'EXIT', None)
+                return
+            while job.cores > self.free_cores or job.memory > self.free_memory:
+                self.lock.wait()
+            self.free_cores -= job.cores
+            self.free_memory -= job.memory
+            job.state = 'RUN'
+            job.start_time = time.time()
+
+        stdout = open(job.logs['oo'], 'a') if 'oo' in job.logs else open(os.devnull, 'w')
+        stderr = open(job.logs['eo'], 'a') if 'eo' in job.logs else sp.STDOUT
+        try:
+            p = sp.Popen(['/bin/bash', '-c', job.cmd], stdout=stdout, stderr=stderr, env=job.env)
+            (pid, status, usage) = os.wait4(p.pid, 0)
+            if os.WIFEXITED(status):
+                returncode = os.WEXITSTATUS(status)
+            else:
+                returncode = 128 + os.WTERMSIG(status)
+            job.max_mem = usage.ru_maxrss / 1024.0
+        finally:
+            stdout.close()
+            if stderr is not sp.STDOUT:
+                stderr.close()
+
+        with self.lock:
+            self.free_cores += job.cores
+            self.free_memory += job.memory
+            if returncode != 0:
+                # resubmit before anything waiting on the job sees it fail
+                job.returncode = returncode
+                job.end_time = time.time()
+                self.retry(job.job_id, dict(self._status(job), state='EXIT'))
+            self._finish(job, 'DONE' if returncode == 0 else 'EXIT', returncode)
+
+    def _finish(self, job, state, returncode):
+        job.state = state
+        job.returncode = returncode
+        job.end_time = time.time()
+        self.lock.notify_all()
+
+    def _status(self, job):
+        return {
+            'state' : job.state,
+            'exit_code' : job.returncode,
+            'exit_reason' : None,
+            'max_mem' : job.max_mem,
+            'run_time' : job.end_time - job.start_time if job.start_time else None,
+            'pend_time' : job.start_time - job.submit_time if job.start_time else None,
+        }
+
+    @tracing.traced('submit_job', 'submit', naming)
+    def submit_job(self, cmd, job_name, job_params=default_lsf_params, depends_on=None, retry=None, cohort=None, share=None):
+        if isinstance(depends_on, (six.string_types, six.integer_types)):
+            depends_on = [depends_on]
+        if depends_on is not None:
+            depends_on = [self.current(j) for j in depends_on]
+        start = time.time()
+        jobid = self._submit(cmd, job_name, job_params, depends_on)
+        submit_secs = time.time() - start
+        msg = colored.green('Generated local job ID: {}'.format(jobid))
+        self.log.info(msg)
+        self.track(jobid, cmd, job_name, job_params, depends_on, retry, submit_secs=submit_secs)
         return jobid
 
+    def _resubmit(self, cmd, job_name, job_params):
+        return self.submit_job(cmd, job_name, job_params)
+
+    def _rewire(self, job_id, depends_on):
+        if job_id in self.jobs:
+            self.jobs[job_id].depends_on = list(depends_on)
+
+    def _kill(self, job_ids):
+        # nothing waiting on a failed local job ever starts; see _run
+        pass
+
+    def reattach(self, job_ids):
+        # an earlier run's jobs were its own children, and went with it
+        return ([], {})
+
+    @tracing.traced('submit_array', 'submit', naming)
+    def submit_array(self, cmds, job_name, script, job_params=default_lsf_params, share=None):
+        write_array_script(script, cmds)
+        jobids = [
+            self._submit('bash {} {}'.format(script, index), job_name, job_params, None, index)
+            for index in range(1, len(cmds) + 1)
+        ]
+        msg = 'Generated local job IDs: {} ({} elements)'
+        self.log.info(colored.green(msg.format(', '.join(jobids), len(cmds))))
+        return jobids
+
+    @tracing.traced('poll', 'poll', counting)
+    def poll(self, job_ids, timeout=43200, log=None, on_finish=None):
+        if log is None: log = self.log
+
+        if isinstance(job_ids, six.string_types):
+            job_ids = [job_ids]
+        jobs = [self.jobs[str(j)] for j in job_ids if str(j) in self.jobs]
+
+        log.info('Entering local wait on {} jobs'.format(len(jobs)))
+        deadline = time.time() + timeout
+        with self.lock:
+            while any(self.jobs[self.current(j.job_id)].state in ('PEND', 'RUN') for j in jobs):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    msg = ('There are local jobs running past the timeout: {}. '
+                           'Please investigate!')
+                    sys.exit(msg.format(timeout))
+                self.lock.wait(remaining)
+
+        # report every attempt at each job
+        attempts = []
+        for job in jobs:
+            attempts.append(job)
+            while attempts[-1].job_id in self.retried:
+                attempts.append(self.jobs[self.retried[attempts[-1].job_id]])
+
+        on_finish = self.noting_attempts(on_finish)
+        failed = []
+        for job in attempts:
+            if on_finish is not None:
+                on_finish(job.job_id, dict(self._status(job), retried_as=self.retried.get(job.job_id)))
+            if job.state == 'DONE':
+                log.info("Local job {} ({}) finished".format(job.job_id, job.job_name))
+            elif job.job_id in self.retried:
+                msg = "Local job {} ({}) ended (exit status: {}); {} stands in for it"
+                log.warning(colored.yellow(msg.format(
+                    job.job_id, job.job_name, job.returncode, self.retried[job.job_id]
+                )))
+            else:
+                msg = "Local job {} ({}) failed (exit status: {})"
+                log.error(colored.red(msg.format(job.job_id, job.job_name, job.returncode)))
+                failed.append(job.job_id)
+
+        log.info('Exiting local wait')
+        if failed:
+            raise JobFailed('Local jobs failed: {}'.format(', '.join(failed)))
+        return True
+
+def host_memory():
+    # total physical memory in MB
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+
+job_managers = {
+    # asyncio runs subprocesses from a loop off the main thread from 3.8 on
+    'lsf' : AsyncBatchJobManager if sys.version_info >= (3, 8) else BatchJobManager,
+    'drmaa' : DrmaaJobManager,
+    'local' : LocalExecutor,
+}
+
+def job_manager(backend, logwriter, **kwargs):
+    return job_managers[backend](logwriter, **kwargs)
+
+def underlying(manager):
+    # the LSF/DRMAA/local manager behind a SharedJobManager's runner
+    return getattr(manager, 'manager', manager)
+
+class SharedJobManager(object):
+    # One job manager serving several pipeline runs on threads of their own
+    # (the cohorts of a `yaps batch`).  Each run submits through a runner()
+    # of its own, so that held jobs are let through the admission limits a
+    # run at a time; the manager's state is only touched under the lock.
+    # Under LSF one poller thread asks bjobs about every run's jobs at once,
+    # and hands each waiting run its own finished jobs, rather than each
+    # run polling bjobs itself.  The local runner's poll can already be
+    # waited on from any number of threads.
+    def __init__(self, manager, logwriter):
+        self.manager = manager
+        self.log = logwriter
+        self.lock = threading.RLock()
+        self.wakeup = threading.Condition(self.lock)
+        self.waiters = []
+        self.arrivals = 0
+        self.poller = None
+        # the jobs of runs that gave up waiting, still looked at until they
+        # finish, so that the admission limits see them go
+        self.orphans = set()
+
+    def runner(self, share):
+        return SharedRunner(self, share)
+
+    def call(self, method, *args, **kwargs):
+        with self.lock:
+            return getattr(self.manager, method)(*args, **kwargs)
+
+    def poll(self, job_ids, timeout=43200, log=None, on_finish=None):
+        if not isinstance(self.manager, BatchJobManager):
+            return self.manager.poll(job_ids, timeout=timeout, log=log, on_finish=on_finish)
+        if isinstance(job_ids, six.string_types):
+            job_ids = [job_ids]
+        if len(job_ids) == 0:
+            return
+        waiter = {
+            'ids' : set(str(j) for j in job_ids),
+            'log' : log or self.log,
+            'on_finish' : self.manager.noting_attempts(on_finish),
+            'deadline' : time.time() + timeout,
+            'done' : threading.Event(),
+            'error' : None,
+        }
+        waiter['log'].info('Waiting on {} LSF jobs with the shared poller'.format(len(waiter['ids'])))
+        with self.lock:
+            self.waiters.append(waiter)
+            self.arrivals += 1
+            if self.poller is None:
+                self.poller = threading.Thread(target=self._poll, name='shared-poller')
+                self.poller.daemon = True
+                self.poller.start()
+            self.wakeup.notify()
+        waiter['done'].wait()
+        if waiter['error'] is not None:
+            raise waiter['error']
+        waiter['log'].info('Exiting LSF wait poller')
+        return True
+
+    def _poll(self):
+        # rounds over everyone's jobs, backing off as bsub.poll does; a run
+        # that starts waiting gets a round straight away
+        sleep_time = 1
+        with self.lock:
+            while True:
+                arrivals = self.arrivals
+                if self.waiters or self.orphans:
+                    self._round()
+                self.wakeup.wait(sleep_time if self.waiters or self.orphans else None)
+                if self.arrivals != arrivals:
+                    sleep_time = 1
+                elif sleep_time < 180:
+                    sleep_time += 0.25
+
+    @tracing.traced('shared.poll_round', 'poll')
+    def _round(self):
+        manager = self.manager
+        owners = {}
+        for waiter in self.waiters:
+            owners.update((job_id, waiter) for job_id in waiter['ids'])
+
+        def on_finish(job_id, status):
+            waiter = owners.get(job_id)
+            if waiter is None:
+                return
+            if status.get('retried_as'):
+                owners[str(status['retried_as'])] = waiter
+            if waiter['on_finish'] is not None:
+                waiter['on_finish'](job_id, status)
+
+        def retry(job_id, status):
+            # no run is waiting on an orphan's retry
+            return manager.retry(job_id, status) if job_id in owners else None
+
+        waiting = set(owners) | self.orphans
+        try:
+            failed = manager.poll_round(waiting, self.log, on_finish=on_finish, retry=retry)
+        except Exception as e:
+            # bjobs itself failing fails every run waiting on it
+            for waiter in list(self.waiters):
+                self._done(waiter, e)
+            return
+
+        # what now stands in for a run's jobs is the run's to wait on too
+        for job_id in waiting:
+            if job_id not in owners:
+                original = manager.copy_of.get(job_id) or manager.handed_out_as(job_id)
+                if original in owners:
+                    owners[job_id] = owners[original]
+        self.orphans = set(j for j in waiting if j not in owners)
+
+        # a failure only fails the run whose job it was
+        now = time.time()
+        for waiter in list(self.waiters):
+            lost = [ job_id for (job_id, status) in failed if owners.get(job_id) is waiter ]
+            waiter['ids'] = set(j for j in waiting if owners.get(j) is waiter)
+            if lost:
+                self._done(waiter, JobFailed('LSF jobs failed: {}'.format(', '.join(lost))))
+            elif not waiter['ids']:
+                self._done(waiter)
+            elif now >= waiter['deadline']:
+                msg = ('There are {} LSF jobs running past the timeout: {}.'
+                       'Please investigate!')
+                self._done(waiter, SystemExit(msg.format(len(waiter['ids']), sorted(waiter['ids']))))
+
+    def _done(self, waiter, error=None):
+        waiter['error'] = error
+        self.waiters.remove(waiter)
+        admission = getattr(self.manager, 'admission', None)
+        for job_id in waiter['ids']:
+            if admission is not None and admission.holds(job_id):
+                admission.withdraw(job_id)
+            else:
+                self.orphans.add(job_id)
+        waiter['done'].set()
+
+class SharedRunner(object):
+    # what one run of a SharedJobManager submits, kills and polls through;
+    # anything else is the manager's own
+    def __init__(self, shared, share):
+        self.shared = shared
+        self.manager = shared.manager
+        self.share = share
+
+    def __getattr__(self, name):
+        return getattr(self.manager, name)
+
+    def submit_job(self, cmd, job_name, job_params=default_lsf_params, depends_on=None, retry=None, cohort=None):
+        return self.shared.call('submit_job', cmd, job_name, job_params, depends_on, retry, cohort, share=self.share)
+
+    def submit_array(self, cmds, job_name, script, job_params=default_lsf_params):
+        return self.shared.call('submit_array', cmds, job_name, script, job_params, share=self.share)
+
+    def adopt(self, job_id, cmd, job_name, job_params, depends_on, retry, cohort=None):
+        return self.shared.call('adopt', job_id, cmd, job_name, job_params, depends_on, retry, cohort)
+
+    def reattach(self, job_ids):
+        return self.shared.call('reattach', job_ids)
+
+    def kill(self, job_ids):
+        return self.shared.call('kill', job_ids)
+
+    def poll(self, job_ids, timeout=43200, log=None, on_finish=None):
+        return self.shared.poll(job_ids, timeout=timeout, log=log, on_finish=on_finish)
+
+def write_array_script(path, cmds):
+    # every element of an LSF job array runs the same command, so dispatch
+    # on the element's index to its own command.  DRMAA bulk jobs pass the
+    # index in as $1.
+    lines = ['#!/bin/bash', '', 'case ${1:-$LSB_JOBINDEX} in']
+    for index, cmd in enumerate(cmds, 1):
+        lines.append('{}) {} ;;'.format(index, cmd))
+    lines.append('*) echo "Unknown job array index: ${1:-$LSB_JOBINDEX}" >&2; exit 1 ;;')
+    lines.append('esac')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+def exec_hosts(value):
+    # bjobs' exec_host, e.g. 'node1' or '4*node1:2*node2'
+    if value in (None, '', '-'):
+        return []
+    return [h.split('*')[-1] for h in str(value).split(':') if h]
+
+def avoid_hosts(job_params, hosts):
+    # keep the job off the given hosts, on top of any select[] it has
+    clause = ' && '.join('hname!={}'.format(h) for h in hosts)
+    params = dict(job_params)
+    resreq = str(params.get('R') or '')
+    if 'select[' in resreq:
+        params['R'] = re.sub(
+            r'select\[([^\]]*)\]',
+            lambda m: 'select[{} && {}]'.format(m.group(1), clause),
+            resreq, count=1
+        )
+    else:
+        params['R'] = 'select[{}] {}'.format(clause, resreq).strip()
+    return params
+
+def dependency_condition(depends_on):
+    if isinstance(depends_on, (six.string_types, six.integer_types)):
+        depends_on = [depends_on]
+    return ' && '.join('done({})'.format(j) for j in depends_on)
+
+def dependency_params(job_params, depends_on, orphans=True):
+    # hold the job until all of its predecessors finish successfully, and
+    # have LSF terminate it outright if one of them exits instead -- unless
+    # a predecessor may yet be retried, in which case it waits to be
+    # pointed at the retry (or killed once there are none left)
+    params = dict(job_params)
+    params['w'] = '"{}"'.format(dependency_condition(depends_on))
+    if orphans:
+        params['ti'] = None
+    return params
+
 # modeled on https://github.com/brentp/bsub/blob/master/bsub/bsub.py
 class BSubException(Exception):
     pass
@@ -37,8 +1317,14 @@ class BSubException(Exception):
 class BSubJobNotFound(BSubException):
     pass
 
+class JobFailed(Exception):
+    pass
+
 class bsub(object):
     TEST_ONLY = -1000
+    job_id_pattern = re.compile(r'^\d+(\[\d+\])?$')
+    bjobs_fields = ('jobid', 'jobindex', 'stat', 'exit_code', 'exit_reason', 'max_mem', 'run_time', 'pend_time', 'exec_host')
+    bjobs_batch = 200
     stdlogger = logger.create('BSUB', sys.stderr, logging.INFO)
 
     def __init__(self, job_name, *args, **kwargs):
@@ -69,14 +1355,14 @@ class bsub(object):
         return s + " " + self._kwargs_to_flag_string(self.kwargs) \
                  + ((" < %s" % self.args[0]) if len(self.args) else "")
 
-    def __call__(self, input_string=None, job_cap=None):
-        if job_cap is not None:
-            self._cap(job_cap)
+    def __call__(self, input_string=None):
         if input_string is None:
             assert len(self.args) == 1
             command = str(self)
         else:
-            command = "echo \"%s\" | %s" % (input_string, str(self))
+            # printf rather than echo "...", so that nothing in the command
+            # gets expanded (or mangled) by the shell submitting it
+            command = "printf '%%s\\n' %s | %s" % (quote(input_string), str(self))
 
         if self.verbose == self.__class__.TEST_ONLY:
             self.job_id = self.__class__.TEST_ONLY
@@ -99,19 +1385,40 @@ class bsub(object):
             s += " -" + k + ("" if v is None else (" " + str(v)))
         return s
 
+    @classmethod
+    def argv(cls, kwargs):
+        # the flags as arguments of their own, for running without a shell:
+        # _kwargs_to_flag_string's, less any shell quoting
+        args = []
+        for k, v in kwargs.items():
+            args.append("-" + k)
+            if v is not None:
+                args.append(unquoted(str(v)))
+        return args
+
     def kill(self):
         if self.job_id is None: return
-        return bsub.kill(int(self.job_id))
+        return bsub.bkill(self.job_id, log=self.log)
 
+    @classmethod
     def bkill(cls, *args, **kwargs):
+        # job ids (or 'id[index]' array elements) are killed by id, anything
+        # else by job name
+        log = kwargs.pop('log', None)
         kargs = cls._kwargs_to_flag_string(kwargs)
-        if all(isinstance(a, six.integer_types) for a in args):
-            command = "bkill " + kargs + " " + " ".join(args)
-            cls._run(command, "is being terminated")
-        else:
-            for a in args:
-                command = "bkill " + kargs.strip() + " -J " + a
-                cls._run(command, "is being terminated")
+        ids = [str(a) for a in args if cls.job_id_pattern.match(str(a))]
+        names = [str(a) for a in args if not cls.job_id_pattern.match(str(a))]
+        if ids:
+            command = "bkill" + kargs + " " + " ".join(ids)
+            cls._run(command, "is being terminated", log=log)
+        for name in names:
+            command = "bkill" + kargs + " -J " + name
+            cls._run(command, "is being terminated", log=log)
+
+    @classmethod
+    def bmod(cls, job_id, log=None, **kwargs):
+        command = "bmod" + cls._kwargs_to_flag_string(kwargs) + " " + str(job_id)
+        return cls._run(command, "are being changed", log=log)
 
     def _get_job_name(self):
         return self._job_name
@@ -125,6 +1432,7 @@ class bsub(object):
     job_name = property(_get_job_name, _set_job_name)
 
     @classmethod
+    @tracing.traced('bsub._run', 'lsf', commanding)
     def _run(cls, command, check_str="is submitted", log=None):
         if log is None: log = cls.stdlogger
         log.info(colored.yellow("LSF EXEC CMD: {}".format(command)))
@@ -144,17 +1452,57 @@ class bsub(object):
         return res
 
     @classmethod
-    def running_jobs(cls, names=False):
-        # grab the integer id (names=False) or # the name (names=True)
-        # depending on whether they requested
-        return [x.split(None, 7)[-2 if names else 0]
-                for x in sp.check_output(["bjobs", "-w"])\
-                           .decode().rstrip().split("\n")[1:]
-                           if x.strip()
-               ]
+    @tracing.traced('bsub.job_records', 'poll', counting)
+    def job_records(cls, job_ids):
+        # job id => one bjobs record per job (or per job array element)
+        records = {}
+        job_ids = list(job_ids)
+        for i in range(0, len(job_ids), cls.bjobs_batch):
+            batch = job_ids[i:i + cls.bjobs_batch]
+            output = sp.check_output(cls.bjobs_argv(batch)).decode()
+            cls.file_records(output, batch, records)
+        return records
+
+    @classmethod
+    def bjobs_argv(cls, job_ids):
+        return ["bjobs", "-o", " ".join(cls.bjobs_fields), "-json"] + list(job_ids)
 
     @classmethod
-    def poll(cls, job_ids, timeout=43200, log=None): # 43200 secs <=> 12 hours
+    def file_records(cls, output, batch, records):
+        # file the records of bjobs' -json output under the ids of the
+        # batch they were asked for by
+        for record in json.loads(output).get("RECORDS", []):
+            if 'ERROR' in record:
+                # long gone from mbatchd
+                record['STAT'] = 'NOTFOUND'
+            job_id = record['JOBID']
+            element = '{}[{}]'.format(job_id, record.get('JOBINDEX'))
+            if element in batch:
+                job_id = element
+            records.setdefault(job_id, []).append(record)
+        return records
+
+    @classmethod
+    def job_status(cls, records):
+        # sum up a job's (or a whole job array's) final bjobs records
+        states = [r['STAT'] for r in records]
+        codes = [lsf_int(r.get('EXIT_CODE')) for r in records]
+        memory = [lsf_memory(r.get('MAX_MEM')) for r in records]
+        runtime = [lsf_int(r.get('RUN_TIME')) for r in records]
+        pending = [lsf_int(r.get('PEND_TIME')) for r in records]
+        state = 'EXIT' if 'EXIT' in states else states[0]
+        return {
+            'state' : state,
+            'exit_code' : max([c for c in codes if c is not None] or [0 if state == 'DONE' else None]),
+            'exit_reason' : next((r.get('EXIT_REASON') for r in records if r.get('EXIT_REASON')), None),
+            'max_mem' : max([m for m in memory if m is not None] or [None]),
+            'run_time' : max([t for t in runtime if t is not None] or [None]),
+            'pend_time' : max([t for t in pending if t is not None] or [None]),
+        }
+
+    @classmethod
+    @tracing.traced('bsub.poll', 'poll', counting)
+    def poll(cls, job_ids, timeout=43200, log=None, admission=None, on_finish=None, retry=None, speculation=None, records=None): # 43200 secs <=> 12 hours
         if log is None: log = cls.stdlogger
 
         log.info('Entering LSF wait poller')
@@ -162,26 +1510,32 @@ class bsub(object):
         if isinstance(job_ids, six.string_types):
             job_ids = [job_ids]
 
-        if len(job_ids) == []:
+        if len(job_ids) == 0:
             return
 
-        job_ids = frozenset(job_ids)
-
-        active_jobs = cls.running_jobs()
-        log.info("There are {} active jobs running".format(len(active_jobs)))
+        # only ever ask bjobs about the jobs we are still waiting on
+        waiting = set(str(j) for j in job_ids)
+        log.info("Waiting on {} LSF jobs".format(len(waiting)))
 
-	kill_timer = 0
+        kill_timer = 0
         sleep_time = 1
 
-        while job_ids.intersection(active_jobs):
-            logMsg = "Sleeping for: {} secs (kill_timer: {}) [timeout={}]"
-            log.debug(logMsg.format(sleep_time, kill_timer, timeout))
+        while True:
+            failed = cls.poll_round(waiting, log, admission, on_finish, retry, speculation, records)
+            if failed:
+                raise JobFailed('LSF jobs failed: {}'.format(
+                    ', '.join(job_id for (job_id, status) in failed)
+                ))
+
+            if not waiting:
+                break
+
+            logMsg = "Sleeping for: {} secs (kill_timer: {}) [timeout={}] waiting on {} jobs"
+            log.debug(logMsg.format(sleep_time, kill_timer, timeout, len(waiting)))
 
             time.sleep(sleep_time)
-            active_jobs = cls.running_jobs()
-            log.debug("There are {} active jobs running".format(len(active_jobs)))
             kill_timer += sleep_time
-            cls.killpoll(kill_timer, timeout, active_jobs)
+            cls.killpoll(kill_timer, timeout, sorted(waiting))
 
             if sleep_time < 180:
                 sleep_time += 0.25
@@ -189,19 +1543,95 @@ class bsub(object):
         log.info('Exiting LSF wait poller')
         return True
 
+    @classmethod
+    def poll_round(cls, waiting, log, admission=None, on_finish=None, retry=None, speculation=None, records=None):
+        # one look at the jobs in `waiting`, which is updated in place: the
+        # ones that finished are dropped, and whatever stands in for them
+        # (a retry, a speculative copy, a held job let through) is added.
+        # Returns the (job id, status) of those that failed for good.
+        # records(job_ids) is what asks bjobs, by default job_records.
+        held = set(j for j in waiting if admission is not None and admission.holds(j))
+        records = (records or cls.job_records)(waiting - held) if waiting - held else {}
+        states = dict((j, [r['STAT'] for r in rs]) for (j, rs) in records.items())
+
+        finished = []
+        for (job_id, rs) in records.items():
+            if any(r['STAT'] not in finished_states for r in rs):
+                continue
+            waiting.discard(job_id)
+            finished.append((job_id, cls.job_status(rs)))
+        if speculation is not None:
+            finished = speculation.settle(finished, waiting)
+
+        failed = []
+        reported = set(job_id for (job_id, status) in finished)
+        for (job_id, status) in finished:
+            if status['state'] == 'EXIT' and retry is not None and not status.get('retried_as'):
+                status['retried_as'] = retry(job_id, status)
+            if on_finish is not None:
+                on_finish(job_id, status)
+            if status.get('retried_as'):
+                msg = "LSF job {} ended (exit code: {}, {}); {} stands in for it"
+                log.warning(colored.yellow(msg.format(
+                    job_id, status['exit_code'], status['exit_reason'], status['retried_as']
+                )))
+                if status['retried_as'] not in reported:
+                    waiting.add(status['retried_as'])
+            elif status['state'] == 'EXIT':
+                failed.append((job_id, status))
+            else:
+                log.info("LSF job {} finished [{}]".format(job_id, status['state']))
+
+        if failed:
+            for (job_id, status) in failed:
+                msg = "LSF job {} failed (exit code: {})"
+                log.error(colored.red(msg.format(job_id, status['exit_code'])))
+            # nothing more goes out, but what finished no longer counts
+            # against the admission limits (which may be shared)
+            if admission is not None:
+                admission.observe(waiting, states, release=False)
+            return failed
+
+        if speculation is not None:
+            running = dict((j, rs) for (j, rs) in records.items() if j in waiting)
+            waiting.update(speculation.speculate(running))
+
+        if admission is not None:
+            observed = admission.observe(waiting, states)
+            waiting.clear()
+            waiting.update(observed)
+        return failed
+
     @classmethod
     def killpoll(cls, killtimer, timeout, leftover_jobs):
         if killtimer >= timeout:
             msg = ('There are {} LSF jobs running past the timeout: {}.'
                    'Please investigate!')
-            msg = msg.format(len(leftover_jobs), lefover_jobs)
+            msg = msg.format(len(leftover_jobs), leftover_jobs)
             sys.exit(msg)
 
-    @classmethod
-    def _cap(self, max_jobs):
-        sleep_time = 1
-        while len(self.running_jobs()) >= max_jobs:
-            time.sleep(sleep_time)
-            if sleep_time < 180:
-                sleep_time += 0.25
-        return True
+def unquoted(value):
+    # a flag value quoted for the shell (e.g. '"done(1)"'), as it was
+    if len(value) > 1 and value[0] == value[-1] and value[0] in "'\"":
+        words = shlex.split(value)
+        if len(words) == 1:
+            return words[0]
+    return value
+
+def lsf_int(value):
+    # '' for unset, '10 second(s)' for run times
+    if value in (None, '', '-'):
+        return None
+    try:
+        return int(str(value).split()[0])
+    except ValueError:
+        return None
+
+def lsf_memory(value):
+    # max_mem as MB, from e.g. '512 Kbytes', '2 Mbytes' or '1.5 Gbytes'
+    if value in (None, '', '-'):
+        return None
+    units = { 'K' : 1.0 / 1024, 'M' : 1.0, 'G' : 1024.0, 'T' : 1024.0 * 1024 }
+    fields = str(value).split()
+    scale = units.get(fields[1][0].upper(), 1.0) if len(fields) > 1 else 1.0
+    return float(fields[0]) * scale
@@ -0,0 +1,163 @@
+import os, json, time, threading, functools
+from contextlib import contextmanager
+
+from six.moves._thread import get_ident
+
+from yaps.utils.metrics import replace
+
+# An opt-in timeline of a run, as Chrome trace events (what chrome://tracing
+# and https://ui.perfetto.dev load).  While tracing is on, the traced spans
+# of yaps itself -- submitting, bsub/bjobs calls, polling, waiting on the
+# queue, the ruffus task bodies -- are collected as they happen; the jobs'
+# own lifecycles (queued, running, noticed done) are laid out afterwards
+# from the job DB, on one track per chromosome.
+
+# None while tracing is off
+events = None
+lock = threading.Lock()
+
+# the process tracks: yaps itself, then one per chromosome
+yaps_pid = 1
+
+def start():
+    global events
+    events = []
+
+def enabled():
+    return events is not None
+
+def micros(secs):
+    return int(secs * 1000000)
+
+def emit(event):
+    with lock:
+        events.append(event)
+
+@contextmanager
+def span(name, cat='yaps', **args):
+    if events is None:
+        yield
+        return
+    begin = time.time()
+    try:
+        yield
+    finally:
+        emit({
+            'name' : name, 'cat' : cat, 'ph' : 'X',
+            'ts' : micros(begin), 'dur' : micros(time.time() - begin),
+            'pid' : yaps_pid, 'tid' : get_ident(), 'args' : args,
+        })
+
+def traced(name, cat='yaps', describe=None):
+    # wraps a function in a span, with describe(*args, **kwargs) giving
+    # the span's args; a no-op (bar the check) while tracing is off
+    def wrap(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            if events is None:
+                return func(*args, **kwargs)
+            with span(name, cat, **(describe(*args, **kwargs) if describe else {})):
+                return func(*args, **kwargs)
+        return wrapped
+    return wrap
+
+def metadata(pid, tid, kind, value):
+    event = { 'name' : kind, 'ph' : 'M', 'pid' : pid, 'args' : {} }
+    if tid is not None:
+        event['tid'] = tid
+    if kind.endswith('_sort_index'):
+        event['args']['sort_index'] = value
+    else:
+        event['args']['name'] = value
+    return event
+
+def chrom_key(chrom):
+    # 1, 2, ..., 22, X, Y rather than 1, 10, 11, ...
+    return (0, int(chrom), '') if chrom.isdigit() else (1, 0, chrom)
+
+def job_slices(job):
+    # (name, begin, end) for the time a job spent queued, running and
+    # finished but not yet noticed by the poller
+    (submitted, started, ended, noticed) = (job['submitted'], job['started'], job['ended'], job['noticed'])
+    name = job['stage'] or 'job {}'.format(job['jobId'])
+    if started is None or ended is None:
+        return [(name, submitted, ended or noticed)]
+    slices = [
+        ('{} (queued)'.format(name), submitted, started),
+        (name, started, ended),
+    ]
+    if noticed is not None and noticed > ended:
+        slices.append(('{} (unnoticed)'.format(name), ended, noticed))
+    return [ s for s in slices if s[2] is not None and s[2] >= s[1] ]
+
+def job_events(jobs):
+    # a process per chromosome, with the jobs packed onto as few lanes
+    # (threads) as don't overlap, so that a shard's stages line up
+    # end to end and the gaps between them show
+    jobs = [
+        j for j in jobs
+        if j['state'] not in (None, 'LOST') and j['submitted'] is not None
+    ]
+    chroms = sorted(set(j['chrom'] for j in jobs if j['chrom']), key=chrom_key)
+    pids = dict((chrom, yaps_pid + i) for (i, chrom) in enumerate(chroms, 1))
+    names = dict((pid, 'chrom {}'.format(chrom)) for (chrom, pid) in pids.items())
+    if any(not j['chrom'] for j in jobs):
+        names[yaps_pid + len(chroms) + 1] = 'job arrays'
+
+    trace = []
+    lanes = {}
+    for job in sorted(jobs, key=lambda j: j['submitted']):
+        pid = pids.get(job['chrom'], yaps_pid + len(chroms) + 1)
+        slices = job_slices(job)
+        if not slices:
+            continue
+        (begin, end) = (slices[0][1], max(s[2] or s[1] for s in slices))
+        ends = lanes.setdefault(pid, [])
+        lane = next((i for (i, e) in enumerate(ends) if e <= begin), len(ends))
+        if lane == len(ends):
+            ends.append(end)
+        ends[lane] = end
+        args = dict((k, job[k]) for k in ('jobId', 'item', 'state', 'attempt', 'exitCode', 'maxMem', 'execHost'))
+        for (name, b, e) in slices:
+            if e is None:
+                continue
+            trace.append({
+                'name' : name, 'cat' : 'job', 'ph' : 'X',
+                'ts' : micros(b), 'dur' : micros(e - b),
+                'pid' : pid, 'tid' : lane + 1, 'args' : args,
+            })
+
+    for (pid, name) in names.items():
+        trace.append(metadata(pid, None, 'process_name', name))
+        trace.append(metadata(pid, None, 'process_sort_index', pid))
+        for lane in range(len(lanes.get(pid, []))):
+            trace.append(metadata(pid, lane + 1, 'thread_name', 'jobs' if lane == 0 else 'jobs {}'.format(lane + 1)))
+    return trace
+
+def mark_events(marks):
+    # the stage marks, as instants across the whole timeline
+    return [
+        {
+            'name' : '{} {}'.format(stage, event), 'cat' : 'stage', 'ph' : 'i', 's' : 'g',
+            'ts' : micros(at), 'pid' : yaps_pid, 'tid' : 0,
+        }
+        for (stage, event, at) in marks
+    ]
+
+def timeline(run, jobs, marks):
+    trace = list(events or [])
+    threads = dict((t.ident, t.name) for t in threading.enumerate())
+    for tid in sorted(set(e['tid'] for e in trace if e['pid'] == yaps_pid)):
+        trace.append(metadata(yaps_pid, tid, 'thread_name', threads.get(tid, 'thread {}'.format(tid))))
+    trace.append(metadata(yaps_pid, None, 'process_name', 'yaps'))
+    trace.append(metadata(yaps_pid, None, 'process_sort_index', 0))
+    trace += mark_events(marks)
+    trace += job_events(jobs)
+    return {
+        'traceEvents' : trace,
+        'displayTimeUnit' : 'ms',
+        'otherData' : { 'run' : run, 'pid' : os.getpid() },
+    }
+
+def write(path, run, jobs, marks):
+    replace(path, json.dumps(timeline(run, jobs, marks)) + '\n')